@@ -0,0 +1,118 @@
+import math
+import os
+import redis
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pytube import YouTube
+from rq import Worker
+from worker import conn
+
+# Reject new jobs when the projected queue wait goes past this, in seconds
+max_wait_seconds = int(os.getenv('ADMISSION_MAX_WAIT_SECONDS', '1800'))
+
+# Transcription seconds per second of audio, used until the workers have measured it
+default_real_time_factor = float(os.getenv('DEFAULT_REAL_TIME_FACTOR', '0.5'))
+
+# Download and summarization time on top of transcription, in seconds
+job_overhead_seconds = int(os.getenv('JOB_OVERHEAD_SECONDS', '120'))
+
+# Jobs get this multiple of their estimated runtime before RQ kills them
+job_timeout_safety_factor = float(os.getenv('JOB_TIMEOUT_SAFETY_FACTOR', '2'))
+min_job_timeout = 600
+
+stats_key = 'admission:stats'
+ewma_alpha = 0.2  # Weight of the newest measurement in the moving averages
+duration_cache_ttl = 7 * 24 * 3600
+duration_miss_ttl = 300  # Failed lookups are remembered briefly, so retries of a bad link don't each ask YouTube
+unknown_duration = b'-1'
+
+def _cached_duration(cached):
+    return int(cached) if cached != unknown_duration else None
+
+def video_duration(youtube_url, video_id):
+    cached = conn.get(f'video_duration:{video_id}')
+    if cached is not None:
+        return _cached_duration(cached)
+    try:
+        duration = YouTube(youtube_url).length
+    except Exception:
+        conn.set(f'video_duration:{video_id}', unknown_duration, ex=duration_miss_ttl)
+        return None  # Unknown, the job reports the real problem with the link
+    conn.set(f'video_duration:{video_id}', duration, ex=duration_cache_ttl)
+    return duration
+
+# video_duration for many videos: the known ones in one round trip, the rest looked up concurrently
+def video_durations(youtube_urls, video_ids, threads=8):
+    cached = conn.mget([f'video_duration:{video_id}' for video_id in video_ids]) if video_ids else []
+    durations = [_cached_duration(duration) if duration is not None else None for duration in cached]
+    missing = [index for index, duration in enumerate(cached) if duration is None]
+    if missing:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            looked_up = pool.map(lambda index: video_duration(youtube_urls[index], video_ids[index]), missing)
+            for index, duration in zip(missing, looked_up):
+                durations[index] = duration
+    return durations
+
+def _update_average(field, value):
+    with conn.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(stats_key)
+                current = pipe.hget(stats_key, field)
+                average = value if current is None else (1 - ewma_alpha) * float(current) + ewma_alpha * value
+                pipe.multi()
+                pipe.hset(stats_key, field, average)
+                pipe.execute()
+                return
+            except redis.WatchError:
+                continue  # Another worker finished at the same time, fold into its average
+
+def record_transcription(audio_seconds, transcription_seconds):
+    if audio_seconds > 0:
+        _update_average('real_time_factor', transcription_seconds / audio_seconds)
+
+def record_job(job_seconds):
+    _update_average('job_seconds', job_seconds)
+
+def real_time_factor():
+    measured = conn.hget(stats_key, 'real_time_factor')
+    return float(measured) if measured is not None else default_real_time_factor
+
+# What admission knows about a queue, read once and reused for every video of a batch
+def queue_load(queue):
+    job_seconds, factor = conn.hmget(stats_key, ['job_seconds', 'real_time_factor'])
+    return {
+        # Deferred jobs are waiting on an earlier stage and will land in this queue shortly
+        'jobs': queue.count + queue.deferred_job_registry.count,
+        'workers': max(1, Worker.count(queue=queue)),
+        'job_seconds': float(job_seconds) if job_seconds is not None else job_overhead_seconds,
+        'real_time_factor': float(factor) if factor is not None else default_real_time_factor
+    }
+
+def estimate_runtime(audio_seconds, load=None):
+    if audio_seconds is None:
+        return None
+    return audio_seconds * (load['real_time_factor'] if load else real_time_factor()) + job_overhead_seconds
+
+def job_timeout_for(audio_seconds, load=None):
+    runtime = estimate_runtime(audio_seconds, load)
+    if runtime is None:
+        return min_job_timeout
+    return max(min_job_timeout, math.ceil(runtime * job_timeout_safety_factor))
+
+def estimate_wait(queue, queued_ahead=0, load=None):
+    load = load or queue_load(queue)
+    return (load['jobs'] + queued_ahead) * load['job_seconds'] / load['workers']
+
+# Returns (admitted, wait_seconds, estimated_start, estimated_finish). queued_ahead counts jobs that are
+# about to be enqueued before this one, like the earlier videos of a batch.
+def admit(queue, audio_seconds, queued_ahead=0, load=None):
+    load = load or queue_load(queue)
+    wait_seconds = estimate_wait(queue, queued_ahead, load)
+    if wait_seconds > max_wait_seconds:
+        return False, wait_seconds, None, None
+    now = datetime.now(timezone.utc)
+    estimated_start = now + timedelta(seconds=wait_seconds)
+    runtime = estimate_runtime(audio_seconds, load)
+    estimated_finish = estimated_start + timedelta(seconds=runtime) if runtime is not None else None
+    return True, wait_seconds, estimated_start, estimated_finish
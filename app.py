@@ -1,37 +1,421 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from rq import Queue
-from rq.job import Job
-from worker import conn
-from tasks import analyze_yt_video
+from rq.job import JobStatus
+from rq.exceptions import NoSuchJobError
+from uuid import uuid4
+from worker import conn, get_model_stats
+from tasks import analyze_yt_video, download_stage, transcribe_stage, analyze_stage
+from modules import summary_backend as default_summary_backend, summary_backends
+from cache import normalize_keywords, result_cache_key, get_cached_result, get_cached_results, claim_inflight, claim_inflight_many, replace_inflight, release_inflight
+from cache import canonical_video_id, claim_pending
+from cache import result_ttl, get_result_summary, get_result_keywords, get_result_segments
+from admission import video_duration, video_durations, queue_load, job_timeout_for, admit, max_wait_seconds, min_job_timeout
+import hashlib
+import redis
+import json
+import math
+import os
+import time
+from events import stream_events
+from metrics import render_metrics, inc
+from search_index import search
+from playlists import resolve_videos, register_batch, start_batch, reconcile_batch, get_batch, batch_status, batch_hits
+from playlists import playlist_concurrency, max_playlist_concurrency, max_playlist_videos
+from pipeline_status import stage_job_ids, fetch_pipeline, pipeline_state, status_response, fetch_statuses
 
 app = Flask(__name__)
 CORS(app)
 q = Queue(connection=conn)
 
+# "stages" runs download, transcription and analysis as chained jobs on their own queues,
+# so each can be served by its own worker pool. "single" runs the whole analysis as one job.
+pipeline_mode = os.getenv('PIPELINE_MODE', 'stages')
+download_q = Queue('download', connection=conn)
+transcribe_q = Queue('transcribe', connection=conn)
+analyze_q = Queue('analyze', connection=conn)
+
+transcript_page_limit = 200
+max_transcript_page_limit = 1000
+max_search_videos = 100
+max_batch_size = int(os.getenv('MAX_BATCH_SIZE', '100'))
+duration_lookup_threads = 8
+
+def enqueue_analysis(job_id, args, job_timeout, meta, pipeline=None, hold=False):
+    if pipeline is not None:
+        return enqueue_analysis_pipelined(job_id, args, job_timeout, meta, pipeline, hold)
+    if pipeline_mode == 'single':
+        return q.enqueue(analyze_yt_video, *args, job_id=job_id, job_timeout=job_timeout, result_ttl=result_ttl, meta=meta)
+
+    # The final job keeps the task id, so clients and the caches only ever see that one
+    meta = dict(meta, task_id=job_id)
+    download_id, transcribe_id = stage_job_ids(job_id)
+    download_job = download_q.enqueue(download_stage, args[0], job_id=download_id, job_timeout=min_job_timeout, meta=meta)
+    transcribe_job = transcribe_q.enqueue(transcribe_stage, job_id=transcribe_id, depends_on=download_job, job_timeout=job_timeout, meta=meta)
+    return analyze_q.enqueue(analyze_stage, *args, job_id=job_id, depends_on=transcribe_job, job_timeout=job_timeout,
+                             result_ttl=result_ttl, meta=meta)
+
+# Saves a job that waits on a job of the same pipeline, without the reads RQ does to check on the dependency:
+# it was created in this pipeline too, so it can't have finished yet. Held jobs are saved but kept out of the
+# queues and the deferred registries, which admission counts, until a playlist releases them.
+def defer_job(queue, func, args, job_id, depends_on, job_timeout, meta, pipeline, result_ttl=None, hold=False):
+    job = queue.create_job(func, args=args, job_id=job_id, depends_on=depends_on, timeout=job_timeout, result_ttl=result_ttl,
+                           meta=meta, status=JobStatus.DEFERRED)
+    if depends_on is not None:
+        job.register_dependency(pipeline=pipeline)
+        if hold:
+            queue.deferred_job_registry.remove(job, pipeline=pipeline)
+    job.save(pipeline=pipeline)
+    return job
+
+# Same jobs as enqueue_analysis, queued on the caller's pipeline so a whole batch goes to Redis in one transaction.
+# With hold the first job is held instead of queued, see first_job_id.
+def enqueue_analysis_pipelined(job_id, args, job_timeout, meta, pipeline, hold=False):
+    if pipeline_mode == 'single':
+        if hold:
+            return defer_job(q, analyze_yt_video, args, job_id, None, job_timeout, meta, pipeline, result_ttl=result_ttl, hold=True)
+        job_data = Queue.prepare_data(analyze_yt_video, args, job_id=job_id, timeout=job_timeout, result_ttl=result_ttl, meta=meta)
+        return q.enqueue_many([job_data], pipeline=pipeline)[0]
+
+    meta = dict(meta, task_id=job_id)
+    download_id, transcribe_id = stage_job_ids(job_id)
+    if hold:
+        defer_job(download_q, download_stage, (args[0],), download_id, None, min_job_timeout, meta, pipeline, hold=True)
+    else:
+        job_data = Queue.prepare_data(download_stage, (args[0],), job_id=download_id, timeout=min_job_timeout, meta=meta)
+        download_q.enqueue_many([job_data], pipeline=pipeline)
+    defer_job(transcribe_q, transcribe_stage, (), transcribe_id, download_id, job_timeout, meta, pipeline, hold=hold)
+    return defer_job(analyze_q, analyze_stage, args, job_id, transcribe_id, job_timeout, meta, pipeline, result_ttl=result_ttl, hold=hold)
+
+# The job that starts a task's pipeline
+def first_job_id(task_id):
+    return task_id if pipeline_mode == 'single' else stage_job_ids(task_id)[0]
+
+def is_job_alive(job_id):
+    try:
+        jobs = fetch_pipeline(job_id)
+    except NoSuchJobError:
+        return claim_pending(job_id)  # Claimed by a batch that hasn't written its jobs yet
+    return pipeline_state(jobs)[0] != 'FAILED'
+
+# Transcription is the bottleneck, so that's the queue whose backlog admission measures
+def admission_queue():
+    return q if pipeline_mode == 'single' else transcribe_q
+
+def submission_args(payload):
+    case_sensitive = bool(payload.get('keyword_case_sensitive', False))
+    return (
+        payload['youtube_url'],
+        payload['summary_sentences'],
+        normalize_keywords(payload['keywords'], case_sensitive),  # As in the cache key, so the prompt matches what the result is shared by
+        payload['keyword_analysis_sentences'],
+        bool(payload.get('keyword_whole_words', False)),  # Match "art" but not "start"
+        case_sensitive,
+        payload.get('summary_backend') or default_summary_backend  # "openai" or "bart"
+    )
+
+# Everything submit() reads from Redis, for a whole batch in a few round trips instead of several per video:
+# cached results, video lengths, the queue's load, and the in-flight claims of the videos that need a job.
+# None for submissions with an unsupported backend, submit() turns those away first.
+def prefetch_submissions(args_list):
+    valid = [index for index, args in enumerate(args_list) if args[6] in summary_backends]
+    cache_keys = {index: result_cache_key(*args_list[index]) for index in valid}
+    prefetched = {index: {'cached': cached} for index, cached in zip(valid, get_cached_results([cache_keys[index] for index in valid]))}
+    fresh = [index for index in valid if prefetched[index]['cached'] is None]
+    for outcome, count in (('hit', len(valid) - len(fresh)), ('miss', len(fresh))):
+        if count:
+            inc('av_cache_requests_total', count, cache='result', outcome=outcome)
+    youtube_urls = [args_list[index][0] for index in fresh]
+    durations = video_durations(youtube_urls, [canonical_video_id(youtube_url) for youtube_url in youtube_urls], duration_lookup_threads)
+    load = queue_load(admission_queue())
+    claims = [(cache_keys[index], str(uuid4()), job_timeout_for(audio_seconds, load) + 60) for index, audio_seconds in zip(fresh, durations)]
+    for index, audio_seconds, (_, job_id, _), existing_job_id in zip(fresh, durations, claims, claim_inflight_many(claims)):
+        prefetched[index].update(audio_seconds=audio_seconds, job_id=job_id, existing_job_id=existing_job_id, load=load)
+    return [prefetched.get(index) for index in range(len(args_list))]
+
+# Returns (body, status code, headers). With a pipeline the jobs are only queued on it, queued_ahead counts
+# the batch's jobs before this one, which the queue doesn't show yet. With hold the new job waits outside the
+# queues for its playlist to release it, so it skips admission. prefetched comes from prefetch_submissions.
+def submit(args, pipeline=None, queued_ahead=0, hold=False, prefetched=None):
+    youtube_url, summary_backend = args[0], args[6]
+    if summary_backend not in summary_backends:
+        return {'error': f"Unsupported summary backend, choose one of: {', '.join(summary_backends)}"}, 400, {}
+
+    # Serve repeat submissions straight from the result cache
+    cache_key = result_cache_key(*args)
+    if prefetched is None:
+        cached = get_cached_result(cache_key)
+        inc('av_cache_requests_total', cache='result', outcome='hit' if cached is not None else 'miss')
+    else:
+        cached = prefetched['cached']
+    if cached is not None:
+        return {'task_id': cached['task_id'], 'state': 'SUCCESS', 'result': cached['result'], 'status': 'task completed', 'cached': True}, 200, {}
+
+    # Size the timeout from the video length and the measured real-time factor, and attach to an identical job
+    # that is already queued or running
+    if prefetched is None:
+        load = None
+        audio_seconds = video_duration(youtube_url, canonical_video_id(youtube_url))
+        job_timeout = job_timeout_for(audio_seconds)
+        job_id = str(uuid4())
+        existing_job_id = claim_inflight(cache_key, job_id, ttl=job_timeout + 60)
+    else:
+        load, audio_seconds, job_id, existing_job_id = (prefetched[field] for field in ('load', 'audio_seconds', 'job_id', 'existing_job_id'))
+        job_timeout = job_timeout_for(audio_seconds, load)
+    while existing_job_id is not None:
+        if is_job_alive(existing_job_id):
+            return {'task_id': existing_job_id}, 202, {}
+        existing_job_id = replace_inflight(cache_key, existing_job_id, job_id, ttl=job_timeout + 60)
+
+    if hold:
+        job = enqueue_analysis(job_id, args, job_timeout=job_timeout, meta={'audio_seconds': audio_seconds}, pipeline=pipeline, hold=True)
+        return {'task_id': job.get_id(), 'held': True}, 202, {}
+
+    # Turn the request away while the projected wait is past the SLA
+    admitted, wait_seconds, estimated_start, estimated_finish = admit(admission_queue(), audio_seconds, queued_ahead, load)
+    if not admitted:
+        release_inflight(cache_key, job_id)
+        body = {'error': 'The server is busy, please try again later.', 'estimated_wait_seconds': round(wait_seconds)}
+        return body, 429, {'Retry-After': str(max(1, math.ceil(wait_seconds - max_wait_seconds)))}
+
+    job = enqueue_analysis(job_id, args, job_timeout=job_timeout, meta={'audio_seconds': audio_seconds}, pipeline=pipeline)
+    return {
+        'task_id': job.get_id(),
+        'estimated_wait_seconds': round(wait_seconds),
+        'estimated_start': estimated_start.isoformat(),
+        'estimated_finish': estimated_finish.isoformat() if estimated_finish else None
+    }, 202, {}
+
 @app.route('/start_transcription', methods=['POST'])
 def start_transcription():
-    youtube_url = request.json['youtube_url']
-    length = request.json['summary_sentences']
-    keywords = request.json['keywords']
-    kw_analysis_length = request.json['keyword_analysis_sentences']
-    job = q.enqueue(analyze_yt_video, youtube_url, length, keywords, kw_analysis_length, job_timeout=600)
-    return jsonify({'task_id': job.get_id()}), 202
+    body, status, headers = submit(submission_args(request.json))
+    return jsonify(body), status, headers
+
+# Takes {"videos": [...]} with the same fields as /start_transcription and answers each one like it would,
+# with its status code in the entry. All new jobs reach Redis in one transaction.
+@app.route('/start_transcription_batch', methods=['POST'])
+def start_transcription_batch():
+    videos = request.json.get('videos')
+    if not isinstance(videos, list) or not 0 < len(videos) <= max_batch_size:
+        return jsonify({'error': f'videos must be a list of 1 to {max_batch_size} submissions'}), 400
+
+    parsed = []
+    for payload in videos:
+        try:
+            parsed.append(submission_args(payload))
+        except (KeyError, TypeError, AttributeError):
+            parsed.append(None)
+    unique = list({result_cache_key(*args): args for args in reversed(parsed) if args is not None}.values())[::-1]
+    prefetched = dict(zip((result_cache_key(*args) for args in unique), prefetch_submissions(unique)))
+
+    pipeline = conn.pipeline()
+    entries = []
+    by_cache_key = {}  # Identical submissions in one batch share a task, the first one's claim isn't enqueued yet
+    claimed = []
+    queued = 0
+    for args in parsed:
+        if args is None:
+            entries.append({'error': 'Each video needs youtube_url, summary_sentences, keywords and keyword_analysis_sentences', 'status_code': 400})
+            continue
+        cache_key = result_cache_key(*args)
+        if cache_key in by_cache_key:
+            entries.append(dict(by_cache_key[cache_key]))
+            continue
+        body, status, headers = submit(args, pipeline=pipeline, queued_ahead=queued, prefetched=prefetched[cache_key])
+        entry = dict(body, status_code=status, **({'retry_after': int(headers['Retry-After'])} if 'Retry-After' in headers else {}))
+        if status == 202 and 'estimated_start' in body:
+            queued += 1
+            claimed.append((cache_key, body['task_id']))
+        by_cache_key[cache_key] = entry
+        entries.append(entry)
+    try:
+        pipeline.execute()
+    except redis.RedisError:
+        release_claims(claimed)
+        return jsonify({'error': 'The submissions could not be saved, please try again.'}), 503
+    return jsonify({'tasks': entries}), 200
+
+# Gives up the claims of jobs that never reached Redis, so the next submission of those videos isn't attached to them
+def release_claims(claimed):
+    for cache_key, job_id in claimed:
+        release_inflight(cache_key, job_id)
+
+# Takes {"playlist_url": ...} with a playlist or channel link and the other fields of /start_transcription, plus
+# an optional max_videos and concurrency. Every video becomes a task of its own, at most concurrency of them in the
+# queues at a time, and /playlist_status reports on the whole playlist.
+@app.route('/start_playlist', methods=['POST'])
+def start_playlist():
+    payload = request.json
+    try:
+        args = submission_args(dict(payload, youtube_url=payload['playlist_url']))
+        concurrency = int(payload.get('concurrency', playlist_concurrency))
+        max_videos = int(payload.get('max_videos', max_playlist_videos))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'playlist_url, summary_sentences, keywords and keyword_analysis_sentences are required, concurrency and max_videos must be integers'}), 400
+    if not 0 < concurrency <= max_playlist_concurrency or not 0 < max_videos <= max_playlist_videos:
+        return jsonify({'error': f'concurrency must be between 1 and {max_playlist_concurrency} and max_videos between 1 and {max_playlist_videos}'}), 400
+    if args[6] not in summary_backends:
+        return jsonify({'error': f"Unsupported summary backend, choose one of: {', '.join(summary_backends)}"}), 400
+
+    # The playlist only ever adds its concurrency to the queue
+    admitted, wait_seconds, _, _ = admit(admission_queue(), None, concurrency - 1)
+    if not admitted:
+        body = {'error': 'The server is busy, please try again later.', 'estimated_wait_seconds': round(wait_seconds)}
+        return jsonify(body), 429, {'Retry-After': str(max(1, math.ceil(wait_seconds - max_wait_seconds)))}
+
+    try:
+        video_urls = resolve_videos(args[0], max_videos)
+    except Exception:
+        return jsonify({'error': 'Could not read the videos of this playlist or channel, please check the link and try again.'}), 400
+    if not video_urls:
+        return jsonify({'error': 'The playlist or channel has no videos.'}), 400
+
+    # Cached results, video lengths and claims for every video at once, the lengths looked up side by side
+    video_args = [(youtube_url,) + args[1:] for youtube_url in dict.fromkeys(video_urls)]
+    batch_id = str(uuid4())
+    pipeline = conn.pipeline()
+    children = []
+    for video, prefetched in zip(video_args, prefetch_submissions(video_args)):
+        body, status, _ = submit(video, pipeline=pipeline, hold=True, prefetched=prefetched)
+        child = {'youtube_url': video[0], 'task_id': body['task_id']}
+        if status == 200:
+            child['state'] = 'cached'
+        elif body.get('held'):
+            child.update(state='held', job_id=first_job_id(body['task_id']))
+        else:
+            child['state'] = 'attached'
+        children.append(child)
+    params = {'summary_sentences': args[1], 'keywords': args[2], 'keyword_analysis_sentences': args[3], 'summary_backend': args[6]}
+    register_batch(batch_id, children, concurrency, params, q.name if pipeline_mode == 'single' else analyze_q.name, pipeline)
+    try:
+        pipeline.execute()
+    except redis.RedisError:
+        release_claims([(result_cache_key(*video), child['task_id']) for video, child in zip(video_args, children) if child['state'] == 'held'])
+        return jsonify({'error': 'The playlist could not be saved, please try again.'}), 503
+    start_batch(batch_id, children, concurrency)
+
+    videos = [{'youtube_url': child['youtube_url'], 'task_id': child['task_id']} for child in children]
+    return jsonify({'batch_id': batch_id, 'total': len(children), 'concurrency': concurrency, 'videos': videos}), 202
+
+@app.route('/playlist_status/<batch_id>', methods=['GET'])
+def playlist_status(batch_id):
+    reconcile_batch(batch_id)
+    batch = get_batch(batch_id)
+    if batch is None:
+        return jsonify({'state': 'UNKNOWN', 'status': 'No playlist with this id, it may have expired.'}), 404
+    body = batch_status(batch)
+    return jsonify(body), {'SUCCESS': 200, 'FAILED': 406}.get(body['state'], 202)
+
+# Every keyword chunk across the playlist's finished videos, with the video each one came from
+@app.route('/playlist_result/<batch_id>/keywords', methods=['GET'])
+def playlist_result_keywords(batch_id):
+    batch = get_batch(batch_id)
+    if batch is None:
+        return jsonify({'error': 'No playlist with this id, it may have expired.'}), 404
+    return jsonify({'keyword_chunks': batch_hits(batch)}), 200
 
 @app.route('/task_status/<task_id>', methods=['GET'])
 def task_status(task_id):
-    job = Job.fetch(task_id, connection=conn)
-
-    if job.is_finished:
-        return jsonify({
-            'state': 'SUCCESS',
-            'result': job.result,
-            'status': job.meta.get('status', 'unknown')
-        }), 200
-    elif job.is_failed:
-        return jsonify({'state': 'FAILED', 'result': None, 'status': job.meta.get('status', 'unknown')}), 406
+    # Finished results answer from the result store, without loading the jobs
+    summary = get_result_summary(task_id)
+    jobs = []
+    if summary is None:
+        try:
+            jobs = fetch_pipeline(task_id)
+        except NoSuchJobError:
+            pass
+    body, status = status_response(summary, jobs)
+    return jsonify(body), status
+
+def entry_etag(entry):
+    return hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()[:16]
+
+# Takes task ids as ?task_ids=a,b or a JSON body {"task_ids": [...], "etags": {...}}. The response has an ETag,
+# so an If-None-Match poll of an unchanged batch gets an empty 304. Each task also carries its own etag, and
+# tasks whose etag the client sends back in "etags" come back as {"etag", "unchanged": true} only.
+@app.route('/task_status_batch', methods=['GET', 'POST'])
+def task_status_batch():
+    payload = request.get_json(silent=True) or {}
+    task_ids = payload.get('task_ids') or [task_id for task_id in request.args.get('task_ids', '').split(',') if task_id]
+    known_etags = payload.get('etags') or {}
+    if not isinstance(task_ids, list) or not 0 < len(task_ids) <= max_batch_size:
+        return jsonify({'error': f'task_ids must list 1 to {max_batch_size} task ids'}), 400
+
+    statuses = fetch_statuses(list(dict.fromkeys(task_ids)))
+    etags = {task_id: entry_etag(entry) for task_id, entry in statuses.items()}
+    batch_etag = hashlib.sha1(' '.join(etags[task_id] for task_id in task_ids).encode()).hexdigest()[:16]
+    if request.if_none_match.contains(batch_etag):
+        response = Response(status=304)
     else:
-        return jsonify({'state': 'PENDING', 'result': None, 'status': job.meta.get('status', 'Waiting for the server...')}), 202
+        tasks = {task_id: {'etag': etags[task_id], 'unchanged': True} if known_etags.get(task_id) == etags[task_id] else
+                 dict(entry, etag=etags[task_id]) for task_id, entry in statuses.items()}
+        response = jsonify({'tasks': tasks})
+    response.set_etag(batch_etag)
+    return response
+
+# Pages through the timestamped transcript, only the stored pages that overlap the range are decompressed
+@app.route('/task_result/<task_id>/transcript', methods=['GET'])
+def task_result_transcript(task_id):
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', transcript_page_limit))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    if offset < 0 or not 0 < limit <= max_transcript_page_limit:
+        return jsonify({'error': f'offset must be at least 0 and limit between 1 and {max_transcript_page_limit}'}), 400
+
+    page = get_result_segments(task_id, offset, limit)
+    if page is None:
+        return jsonify({'error': 'No result for this task, it may still be running or have expired.'}), 404
+    segments, total = page
+    next_offset = offset + len(segments) if offset + len(segments) < total else None
+    return jsonify({'segments': segments, 'offset': offset, 'total': total, 'next_offset': next_offset}), 200
+
+@app.route('/task_result/<task_id>/keywords', methods=['GET'])
+def task_result_keywords(task_id):
+    keywords = get_result_keywords(task_id)
+    if keywords is None:
+        return jsonify({'error': 'No result for this task, it may still be running or have expired.'}), 404
+    return jsonify(keywords), 200
+
+# Keyword search across every transcribed video, chunks have the same shape as transcript_filtered
+@app.route('/search', methods=['GET'])
+def search_transcripts():
+    keywords = request.args.get('keywords', '')
+    case_sensitive = request.args.get('case_sensitive', 'false').lower() in ('1', 'true')
+    sentiment = request.args.get('sentiment', 'false').lower() in ('1', 'true')
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if not keywords.strip() or not 0 < limit <= max_search_videos:
+        return jsonify({'error': f'keywords is required and limit must be between 1 and {max_search_videos}'}), 400
+
+    search_start = time.perf_counter()
+    videos = search(keywords, case_sensitive=case_sensitive, sentiment=sentiment, limit=limit)
+    return jsonify({'keywords': keywords, 'videos': videos, 'took_ms': round((time.perf_counter() - search_start) * 1000, 1)}), 200
+
+@app.route('/task_stream/<task_id>', methods=['GET'])
+def task_stream(task_id):
+    # Browsers resume from the last event they saw after a reconnect
+    last_event_id = request.headers.get('Last-Event-ID', '0')
+
+    def is_done():
+        try:
+            return pipeline_state(fetch_pipeline(task_id))[0] != 'PENDING'
+        except NoSuchJobError:
+            return True
+
+    events = stream_events(task_id, last_id=last_event_id, is_done=is_done)
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/model_stats', methods=['GET'])
+def model_stats():
+    return jsonify(get_model_stats(conn)), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics([q, download_q, transcribe_q, analyze_q]), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,150 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import struct
+import tempfile
+import time
+from uuid import uuid4
+import numpy as np
+from metrics import inc
+
+# Decoded 16 kHz mono audio by video id, so re-analysis with another model, or after the transcript expired,
+# skips the download and the decode. Entries are raw int16 PCM, ~115 MB per hour of audio, after an 8-byte
+# header with the size of the download they replace. The least recently used go once the store is over budget.
+# Put it on a volume the download and transcription workers share, the stage jobs hand audio over through it.
+audio_store_dir = os.getenv('AUDIO_STORE_DIR', 'audio_store')
+audio_store_bytes = int(os.getenv('AUDIO_STORE_BYTES', str(4 * 1024 ** 3)))
+
+# Every job downloads into a directory of its own under here, removed when it's done. A tmpfs like /dev/shm
+# keeps downloads off the disk.
+scratch_dir = os.getenv('SCRATCH_DIR', os.path.join(tempfile.gettempdir(), 'av-scratch'))
+
+header = struct.Struct('<Q')
+stale_seconds = 6 * 3600  # Temporary files and workspaces this old belong to jobs that were killed
+write_samples = 30 * 16000  # Converted and written a window at a time
+
+def audio_path(video_id):
+    name = video_id if re.fullmatch(r'[\w-]{1,64}', video_id) else hashlib.sha256(video_id.encode()).hexdigest()
+    return os.path.join(audio_store_dir, f'{name}.pcm')
+
+# Returns (float32 audio, bytes of the download it replaces), or None
+def get_audio(video_id):
+    path = audio_path(video_id)
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+        os.utime(path)  # Most recently used now
+    except FileNotFoundError:
+        return None
+    download_bytes, = header.unpack_from(data)
+    return np.frombuffer(data, dtype='<i2', offset=header.size).astype(np.float32) / 32768.0, download_bytes
+
+def stored_download_bytes(video_id):
+    try:
+        with open(audio_path(video_id), 'rb') as file:
+            return header.unpack(file.read(header.size))[0]
+    except (FileNotFoundError, struct.error):
+        return None
+
+# Passes decoded int16 windows through while writing them to a temporary file next to the entry. Only once the
+# last window is through does the file replace the entry, in one rename, so readers in any process see the old
+# entry or the whole new one. download_stats is read at the end, when the download is complete.
+def store_windows(video_id, windows, download_stats=None):
+    os.makedirs(audio_store_dir, exist_ok=True)
+    path = audio_path(video_id)
+    temp_path = f'{path}.{uuid4().hex}.tmp'
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(header.pack(0))
+            for window in windows:
+                file.write(np.asarray(window, dtype='<i2').tobytes())
+                yield window
+            file.seek(0)
+            file.write(header.pack((download_stats or {}).get('bytes', 0)))
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    evict(keep=path)
+
+def put_audio(video_id, audio, download_bytes=0):
+    windows = ((audio[start:start + write_samples] * 32768.0).round().clip(-32768, 32767).astype(np.int16)
+               for start in range(0, len(audio), write_samples))
+    for _ in store_windows(video_id, windows, {'bytes': download_bytes}):
+        pass
+
+# A pipeline's hold on an entry its transcription stage hasn't read yet. The download pool can run far ahead
+# of the transcription queue, eviction leaves pinned entries alone. Pins of pipelines that died go stale.
+def pin_path(video_id, owner):
+    owner = re.sub(r'[^\w-]', '_', owner)
+    return f'{audio_path(video_id)}.{owner}.pin'
+
+def pin(video_id, owner):
+    os.makedirs(audio_store_dir, exist_ok=True)
+    open(pin_path(video_id, owner), 'w').close()
+
+def unpin(video_id, owner):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(pin_path(video_id, owner))
+
+@contextlib.contextmanager
+def store_lock():
+    with open(os.path.join(audio_store_dir, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Drops the least recently used entries until the store fits the budget, and returns the bytes freed. Under an
+# exclusive lock, so two workers finishing together don't both evict for the same overflow. The entry just
+# written and pinned entries are kept even past the budget, a transcription stage is about to read them.
+def evict(budget=None, keep=None):
+    budget = audio_store_bytes if budget is None else budget
+    freed = 0
+    with store_lock():
+        entries = []
+        pinned = {keep}
+        for entry in os.scandir(audio_store_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.pcm'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith(('.tmp', '.pin')) and stat.st_mtime < time.time() - stale_seconds:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry.path)
+            elif entry.name.endswith('.pin'):
+                pinned.add(entry.path.split('.pcm.', 1)[0] + '.pcm')
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= budget:
+                break
+            if path in pinned:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)  # A reader that already opened it still reads it whole
+            total -= size
+            freed += size
+    if freed:
+        inc('av_audio_store_evicted_bytes_total', freed)
+    return freed
+
+# A private directory for one job's downloads, removed with everything in it however the job ends.
+# Workspaces left behind by killed jobs are cleared when a later job starts.
+@contextlib.contextmanager
+def scratch_workspace(name):
+    os.makedirs(scratch_dir, exist_ok=True)
+    for entry in os.scandir(scratch_dir):
+        with contextlib.suppress(FileNotFoundError):
+            if entry.stat().st_mtime < time.time() - stale_seconds:
+                shutil.rmtree(entry.path, ignore_errors=True)
+    path = tempfile.mkdtemp(prefix=f'{name}-', dir=scratch_dir)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,81 @@
+import argparse
+import json
+import random
+import time
+from unittest.mock import patch
+import fakeredis
+import redis
+from rq import Queue
+import app as api
+from cache import store_result, result_key
+from tasks import analyze_stage
+
+# Load test for status polling: requests and task statuses per second, one /task_status call per task against
+# /task_status_batch at growing batch sizes, with and without If-None-Match. Runs in-process against fakeredis,
+# or against a real Redis with --redis-url to include network round trips.
+
+def make_tasks(count, rng):
+    task_ids = []
+    for i in range(count):
+        task_id = f'bench-task-{i:05d}'
+        if rng.random() < 0.5:
+            segments = [{'start': s, 'end': s + 4, 'text': f'Segment {s}.'} for s in range(0, 2400, 4)]
+            store_result(f'bench-key-{i}', task_id, {'summary': 'Summary.', 'sentiment_summary': {'keywords': {}, 'timeline': []},
+                                                     'transcript_timestamped': segments, 'transcript_filtered': None, 'sentiment_analysis': None})
+        else:
+            api.analyze_q.enqueue(analyze_stage, 'https://youtu.be/dQw4w9WgXcQ', 3, '', 2, job_id=task_id, meta={'status': 'Transcribing audio...'})
+        task_ids.append(task_id)
+    return task_ids
+
+def measure(client, send, duration):
+    requests = 0
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < duration:
+        send(client)
+        requests += 1
+    return requests / (time.perf_counter() - start_time)
+
+def main(args):
+    rng = random.Random(args.seed)
+    connection = redis.Redis.from_url(args.redis_url) if args.redis_url else fakeredis.FakeRedis()
+    queues = {name: Queue(name, connection=connection) for name in ('download', 'transcribe', 'analyze')}
+    with patch('app.conn', connection), patch('cache.conn', connection), patch('metrics.conn', connection), \
+         patch('app.download_q', queues['download']), patch('app.transcribe_q', queues['transcribe']), patch('app.analyze_q', queues['analyze']):
+        task_ids = make_tasks(args.tasks, rng)
+        client = api.app.test_client()
+        results = []
+
+        rate = measure(client, lambda client: client.get(f'/task_status/{rng.choice(task_ids)}'), args.duration)
+        results.append({'endpoint': 'task_status', 'batch_size': 1, 'requests_per_second': round(rate, 1), 'tasks_per_second': round(rate, 1)})
+        print(f"task_status: {rate:.0f} req/s")
+
+        for batch_size in args.batch_sizes:
+            batch = rng.sample(task_ids, min(batch_size, len(task_ids)))
+            etag = client.post('/task_status_batch', json={'task_ids': batch}).headers['ETag']
+            for conditional in (False, True):
+                headers = {'If-None-Match': etag} if conditional else {}
+                rate = measure(client, lambda client: client.post('/task_status_batch', json={'task_ids': batch}, headers=headers), args.duration)
+                results.append({'endpoint': 'task_status_batch', 'batch_size': len(batch), 'conditional': conditional,
+                                'requests_per_second': round(rate, 1), 'tasks_per_second': round(rate * len(batch), 1)})
+                print(f"task_status_batch x{len(batch)}{' (304)' if conditional else ''}: {rate:.0f} req/s, {rate * len(batch):.0f} tasks/s")
+
+        if args.redis_url:  # Only the keys this run created
+            for task_id in task_ids:
+                queues['analyze'].remove(task_id)
+            connection.delete(*[f'rq:job:{task_id}' for task_id in task_ids], *[result_key(task_id) for task_id in task_ids],
+                              *[f'result_cache:bench-key-{i}' for i in range(len(task_ids))])
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'redis': 'real' if args.redis_url else 'fakeredis', 'results': results}, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for single and batch task status polling.")
+    parser.add_argument("--tasks", type=int, default=1000, help="Number of tasks to create, half finished and half pending.")
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 10, 50, 100], help="Batch sizes to measure, up to MAX_BATCH_SIZE.")
+    parser.add_argument("--duration", type=float, default=3, help="Seconds to measure each configuration.")
+    parser.add_argument("--redis-url", type=str, help="Real Redis to run against, e.g. redis://localhost:6379/15. The bench's own keys are deleted afterwards.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
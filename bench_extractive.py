@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import modules
+from modules import count_tokens, summarize_transcript, compress_transcript, excerpts_source, KeywordMatcher
+
+# Extractive pre-compression against the plain path: time to pick the segments of a long transcript, tokens
+# sent to the summarizer, and end-to-end summarize_transcript latency. The summarizer is the chat completions
+# API at --base-url, or by default a local stand-in that answers after a delay proportional to the prompt
+# tokens (--ms-per-1k-tokens), so the whole run is offline.
+
+def make_segments(hours, rng, keywords):
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9))) for _ in range(3000)]
+    topics = [rng.sample(vocabulary, 40) for _ in range(12)]  # Recurring themes, what TextRank should find
+    segments = []
+    start = 0.0
+    while start < hours * 3600:
+        words = [rng.choice(rng.choice(topics) if rng.random() < 0.4 else vocabulary) for _ in range(rng.randint(6, 20))]
+        if keywords and rng.random() < 0.01:
+            words.insert(rng.randrange(len(words)), rng.choice(keywords))
+        duration = rng.uniform(2, 6)
+        segments.append({'start': round(start, 2), 'end': round(start + duration, 2), 'text': ' ' + ' '.join(words).capitalize() + '.'})
+        start += duration
+    return segments
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt_tokens = sum(count_tokens(message['content']) for message in body['messages'])
+        time.sleep(prompt_tokens / 1000 * self.server.ms_per_1k_tokens / 1000)
+        payload = json.dumps({
+            'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'Summary.'}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 1, 'total_tokens': prompt_tokens + 1}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+def start_stand_in(ms_per_1k_tokens):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.ms_per_1k_tokens = ms_per_1k_tokens
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.setdefault('OPENAI_API_KEY', 'bench-key')
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{server.server_port}/v1'
+    return server
+
+def main(args):
+    rng = random.Random(args.seed)
+    keywords = [keyword.strip() for keyword in args.keywords.split(',') if keyword.strip()]
+    segments = make_segments(args.hours, rng, keywords)
+    transcript = ''.join(segment['text'] for segment in segments)
+    matcher = KeywordMatcher(args.keywords)
+    transcript_tokens = count_tokens(transcript)
+    print(f"{args.hours} h transcript: {len(segments)} segments, {transcript_tokens} tokens")
+
+    if args.base_url:
+        os.environ['OPENAI_BASE_URL'] = args.base_url
+    else:
+        server = start_stand_in(args.ms_per_1k_tokens)
+
+    results = []
+    for budget in args.budgets:
+        extract_times = []
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            excerpts = compress_transcript(transcript, segments, matcher, max_tokens=budget)
+            extract_times.append(time.perf_counter() - start_time)
+        text = transcript if excerpts is None else excerpts
+        input_tokens = count_tokens(text)
+        result = {
+            'path': 'extractive' if budget else 'full',
+            'budget_tokens': budget,
+            'extract_seconds': round(min(extract_times), 3),
+            'input_tokens': input_tokens,
+            'tokens_saved': transcript_tokens - input_tokens,
+            'keyword_mentions_kept': sum(text.count(keyword) for keyword in keywords),
+            'keyword_mentions': sum(transcript.count(keyword) for keyword in keywords)
+        }
+        if not args.skip_summary:
+            start_time = time.perf_counter()
+            source = "video transcript" if excerpts is None else excerpts_source
+            summarize_transcript(text, args.length, args.keywords, args.keyword_sentences, source=source, backend='openai')
+            result['summary_seconds'] = round(time.perf_counter() - start_time + result['extract_seconds'], 2)
+        results.append(result)
+        print(f"{result['path']} budget {budget}: extract {result['extract_seconds']}s, {input_tokens} tokens in "
+              f"({result['tokens_saved']} saved), {result['keyword_mentions_kept']}/{result['keyword_mentions']} keyword mentions" + (f", summary in {result['summary_seconds']}s" if 'summary_seconds' in result else ''))
+
+    if not args.base_url:
+        server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'hours': args.hours, 'segments': len(segments), 'transcript_tokens': transcript_tokens,
+                       'summary_chunk_tokens': modules.summary_chunk_tokens, 'results': results}, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark extractive pre-compression against summarizing the whole transcript.")
+    parser.add_argument("--hours", type=float, default=3, help="Length of the synthetic transcript.")
+    parser.add_argument("--budgets", type=int, nargs='+', default=[0, 4000, 12000], help="Extraction budgets in tokens, 0 is the plain path.")
+    parser.add_argument("--keywords", type=str, default="pricing,roadmap", help="Keywords sprinkled into the transcript and boosted.")
+    parser.add_argument("--length", type=int, default=5, help="Summary length in sentences.")
+    parser.add_argument("--keyword-sentences", type=int, default=2, help="Sentences per keyword in the summary.")
+    parser.add_argument("--repeat", type=int, default=3, help="Extraction runs per budget, the fastest is reported.")
+    parser.add_argument("--base-url", type=str, help="Chat completions API to summarize with, instead of the local stand-in.")
+    parser.add_argument("--ms-per-1k-tokens", type=float, default=150, help="Stand-in latency per 1000 prompt tokens.")
+    parser.add_argument("--skip-summary", action="store_true", help="Only measure the extraction.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic transcript.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,63 @@
+import argparse
+import json
+import random
+import time
+from modules import KeywordMatcher, filter_sentences_with_context
+
+# Compares the compiled keyword matcher against the old per-keyword substring scan
+# on synthetic transcripts, so it runs anywhere without audio or network access.
+
+def make_transcript(segment_count, vocabulary, rng):
+    return [{'start': i * 3, 'end': i * 3 + 3, 'text': ' '.join(rng.choice(vocabulary) for _ in range(12)) + '.'}
+            for i in range(segment_count)]
+
+def legacy_match_count(transcript_timestamped, keywords):
+    keywords_list = keywords.split(', ')
+    return sum(any(keyword.lower() in sentence['text'].lower() for keyword in keywords_list) for sentence in transcript_timestamped)
+
+def time_call(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+def main(args):
+    rng = random.Random(args.seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10))) for _ in range(5000)]
+    results = []
+    for segment_count in args.segments:
+        transcript_timestamped = make_transcript(segment_count, vocabulary, rng)
+        for keyword_count in args.keywords:
+            keywords = ', '.join(rng.sample(vocabulary, keyword_count))
+            legacy_time = time_call(lambda: legacy_match_count(transcript_timestamped, keywords), args.repeats)
+            build_time = time_call(lambda: KeywordMatcher(keywords), args.repeats)
+            matcher = KeywordMatcher(keywords)
+            matcher_time = time_call(lambda: filter_sentences_with_context(transcript_timestamped, matcher), args.repeats)
+            word_time = time_call(lambda: filter_sentences_with_context(transcript_timestamped, keywords, whole_words=True), args.repeats)
+            results.append({
+                'segments': segment_count,
+                'keywords': keyword_count,
+                'legacy_scan_ms': round(legacy_time * 1000, 2),
+                'matcher_build_ms': round(build_time * 1000, 2),
+                'matcher_filter_ms': round(matcher_time * 1000, 2),
+                'whole_words_filter_ms': round(word_time * 1000, 2),
+                'speedup': round(legacy_time / matcher_time, 1)
+            })
+            print(f"{segment_count} segments x {keyword_count} keywords: legacy {legacy_time * 1000:.1f} ms, "
+                  f"matcher {matcher_time * 1000:.1f} ms ({results[-1]['speedup']}x)")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark for keyword filtering on long transcripts.")
+    parser.add_argument("--segments", type=int, nargs='+', default=[1000, 10000], help="Transcript lengths in segments.")
+    parser.add_argument("--keywords", type=int, nargs='+', default=[1, 10, 100, 500], help="Keyword set sizes.")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per measurement, the fastest is reported.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic transcript.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
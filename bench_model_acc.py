@@ -1 +1,73 @@
-from fuzzywuzzy import fuzz
\ No newline at end of file
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from modules import decode_audio, sample_rate
+from worker import load_transcription_model
+
+# Word error rate of each engine/model size against the reference transcripts of the benchmark fixtures.
+# A fixture is an audio file with a .txt reference next to it, e.g. assets/bench/talk.mp3 and assets/bench/talk.txt.
+
+def normalize_words(text):
+    return re.sub(r"[^\w\s']", ' ', text.lower()).split()
+
+def word_error_rate(reference, hypothesis):
+    reference, hypothesis = normalize_words(reference), normalize_words(hypothesis)
+    if not reference:
+        return 0.0 if not hypothesis else 1.0
+    # Word-level Levenshtein distance, one row at a time
+    previous = list(range(len(hypothesis) + 1))
+    for i, reference_word in enumerate(reference, 1):
+        current = [i]
+        for j, hypothesis_word in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (reference_word != hypothesis_word)))
+        previous = current
+    return previous[-1] / len(reference)
+
+def find_fixtures(directory):
+    fixtures = []
+    for audio_path in sorted(glob.glob(os.path.join(directory, '*'))):
+        name, extension = os.path.splitext(audio_path)
+        if extension.lower() in ('.wav', '.mp3', '.mp4', '.flac', '.m4a', '.ogg', '.webm'):
+            reference_path = name + '.txt'
+            fixtures.append({'name': os.path.basename(name), 'audio': audio_path,
+                             'reference': reference_path if os.path.exists(reference_path) else None})
+    return fixtures
+
+def main(args):
+    results = []
+    for fixture in find_fixtures(args.fixtures):
+        if fixture['reference'] is None:
+            continue
+        audio = decode_audio(fixture['audio'])
+        with open(fixture['reference']) as file:
+            reference = file.read()
+        for engine in args.engines:
+            for model_size in args.models:
+                model = load_transcription_model(model_size, engine)
+                start_time = time.perf_counter()
+                hypothesis = model.transcribe(audio)['text']
+                wall_time = time.perf_counter() - start_time
+                results.append({
+                    'fixture': fixture['name'],
+                    'engine': engine,
+                    'model': model_size,
+                    'wer': round(word_error_rate(reference, hypothesis), 4),
+                    'real_time_factor': round(wall_time / (len(audio) / sample_rate), 3)
+                })
+                print(f"{fixture['name']} {engine}/{model_size}: WER {results[-1]['wer']:.2%}, RTF {results[-1]['real_time_factor']}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcription accuracy (WER) against reference transcripts.")
+    parser.add_argument("--fixtures", type=str, default="assets/bench", help="Directory with audio fixtures and .txt references.")
+    parser.add_argument("--engines", type=str, nargs='+', default=['whisper'], help="Transcription engines.")
+    parser.add_argument("--models", type=str, nargs='+', default=['small'], help="Model sizes.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,195 @@
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+import numpy as np
+import psutil
+import torch
+import modules
+from modules import decode_audio, transcribe_audio, KeywordMatcher, filter_sentences_with_context, analyze_sentiments
+from modules import score_sentiments, aggregate_sentiments, summarize_transcript, first_sentences, sample_rate
+from worker import model_registry, transcribe_engine
+from bench_model_acc import find_fixtures, word_error_rate
+
+# Headless benchmark of every pipeline stage on local fixtures, with no network access: the summarizer is a
+# stub that still goes through chunking and map-reduce. Results are JSON, and --compare flags regressions
+# against a stored baseline (exit code 1), so it can gate CI.
+
+# Higher is worse for all of them. Changes below the noise floor are never flagged.
+compared_metrics = {'wall_time': 0.05, 'cpu_time': 0.05, 'peak_rss_mb': 10, 'real_time_factor': 0.005}
+
+class StubSummarizer:
+    name = 'stub'
+    max_input_tokens = modules.summary_chunk_tokens
+
+    def summarize(self, text, length, keywords, kw_analysis_length, source):
+        return first_sentences(text, length)
+
+    def summarize_parts(self, chunks, keywords):
+        return [first_sentences(chunk, 5) for chunk in chunks]
+
+class StageMeter:
+    """Wall time, CPU time and peak RSS of one stage, including child processes like ffmpeg and the chunk pool."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.process = psutil.Process()
+
+    def rss(self):
+        total = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
+    def cpu_time(self):
+        times = self.process.cpu_times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self._cpu_start = self.cpu_time()
+        self._wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.perf_counter() - self._wall_start
+        self.cpu_time_used = self.cpu_time() - self._cpu_start
+        self._done.set()
+        self._sampler.join()
+        self.peak = max(self.peak, self.rss())
+
+    def metrics(self, audio_seconds=None):
+        metrics = {
+            'wall_time': round(self.wall_time, 3),
+            'cpu_time': round(self.cpu_time_used, 3),
+            'peak_rss_mb': round(self.peak / 1024 / 1024, 1)
+        }
+        if audio_seconds:
+            metrics['real_time_factor'] = round(self.wall_time / audio_seconds, 4)
+        return metrics
+
+def synthetic_fixture(seconds, seed):
+    # Used when no fixtures are on disk: noise with pauses, enough to exercise every stage but WER
+    rng = np.random.default_rng(seed)
+    audio = rng.normal(0, 0.05, seconds * sample_rate).astype(np.float32)
+    for start in range(20, seconds, 30):
+        audio[start * sample_rate:(start + 1) * sample_rate] = 0
+    return {'name': f'synthetic-{seconds}s', 'audio': audio, 'reference': None}
+
+def run_fixture(fixture, args):
+    stages = {}
+    if isinstance(fixture['audio'], str):
+        with StageMeter() as meter:
+            audio = decode_audio(fixture['audio'])
+        audio_seconds = len(audio) / sample_rate
+        stages['decode'] = meter.metrics(audio_seconds)
+    else:
+        audio = fixture['audio']
+        audio_seconds = len(audio) / sample_rate
+
+    with StageMeter() as meter:
+        transcript, transcript_timestamped, _ = transcribe_audio(audio, '', model_size=args.model)
+    stages['transcribe'] = meter.metrics(audio_seconds)
+
+    with StageMeter() as meter:
+        transcript_filtered = filter_sentences_with_context(transcript_timestamped, KeywordMatcher(args.keywords))
+    stages['keywords'] = meter.metrics()
+
+    with StageMeter() as meter:
+        sentiment_results = analyze_sentiments(transcript_filtered)
+        segment_scores = score_sentiments([segment['text'] for segment in transcript_timestamped])
+        aggregate_sentiments(transcript_timestamped, segment_scores, sentiment_results)
+    stages['sentiment'] = meter.metrics()
+
+    with StageMeter() as meter:
+        summarize_transcript(transcript, 5, args.keywords, 2, backend='stub')
+    stages['summarize'] = meter.metrics()
+
+    result = {'name': fixture['name'], 'audio_seconds': round(audio_seconds, 2), 'segments': len(transcript_timestamped), 'stages': stages}
+    if fixture['reference'] is not None:
+        with open(fixture['reference']) as file:
+            result['wer'] = round(word_error_rate(file.read(), transcript), 4)
+    return result
+
+# Returns one line per metric that got worse than the baseline by more than the threshold
+def compare(results, baseline, threshold, wer_threshold):
+    regressions = []
+    baseline_fixtures = {fixture['name']: fixture for fixture in baseline['fixtures']}
+    for fixture in results['fixtures']:
+        previous = baseline_fixtures.get(fixture['name'])
+        if previous is None:
+            continue
+        for stage, metrics in fixture['stages'].items():
+            for metric, noise_floor in compared_metrics.items():
+                old, new = previous['stages'].get(stage, {}).get(metric), metrics.get(metric)
+                if old is None or new is None or new - old <= noise_floor:
+                    continue
+                if new > old * (1 + threshold):
+                    regressions.append(f"{fixture['name']} {stage} {metric}: {old} -> {new}")
+        if 'wer' in fixture and 'wer' in previous and fixture['wer'] - previous['wer'] > wer_threshold:
+            regressions.append(f"{fixture['name']} wer: {previous['wer']} -> {fixture['wer']}")
+    return regressions
+
+def main(args):
+    modules.summarizers['stub'] = StubSummarizer()
+    torch.manual_seed(args.seed)
+    fixtures = find_fixtures(args.fixtures) or [synthetic_fixture(args.synthetic_seconds, args.seed)]
+
+    with StageMeter() as meter:
+        model_registry.get(args.model)
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpus': psutil.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'engine': transcribe_engine,
+            'model': args.model
+        },
+        'model_load': meter.metrics(),
+        'fixtures': []
+    }
+    for fixture in fixtures:
+        results['fixtures'].append(run_fixture(fixture, args))
+        stages = results['fixtures'][-1]['stages']
+        print(f"{fixture['name']}: " + ', '.join(f"{stage} {metrics['wall_time']}s" for stage, metrics in stages.items()))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.threshold, args.wer_threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline, non-interactive benchmark of every pipeline stage.")
+    parser.add_argument("--fixtures", type=str, default="assets/bench", help="Directory with audio fixtures and optional .txt references.")
+    parser.add_argument("--model", type=str, default=modules.default_model_size, help="Whisper model size.")
+    parser.add_argument("--keywords", type=str, default="people, time, world", help="Keywords for the keyword and sentiment stages.")
+    parser.add_argument("--synthetic-seconds", type=int, default=120, help="Length of the synthetic fixture used when there are none on disk.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--output", type=str, help="Path for the JSON results, e.g. to store as the next baseline.")
+    parser.add_argument("--compare", type=str, help="Baseline JSON to check for regressions.")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative slowdown that counts as a regression.")
+    parser.add_argument("--wer-threshold", type=float, default=0.01, help="Absolute WER increase that counts as a regression.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,93 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from contextlib import closing
+import search_index
+from search_index import connect, index_transcript, search, index_stats
+
+# Build time, size on disk and query latency of the transcript search index, on synthetic transcripts
+# with a Zipf-like vocabulary so common and rare keywords both get measured.
+
+def make_vocabulary(size, rng):
+    return [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+def make_transcript(vocabulary, cum_weights, segments, rng):
+    transcript = []
+    for position in range(segments):
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(6, 18))
+        transcript.append({'start': position * 4, 'end': position * 4 + 4, 'text': ' '.join(words).capitalize() + '.'})
+    return transcript
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main(args):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))  # Computed once, choices() is O(n) without it
+
+    with tempfile.TemporaryDirectory() as directory:
+        search_index.search_index_path = args.index or os.path.join(directory, 'index.sqlite3')
+        build_start = time.perf_counter()
+        with closing(connect()) as connection:
+            for video in range(index_stats()['videos'], args.videos):  # Picks up where a kept index stopped
+                index_transcript(f'video-{video:06d}', make_transcript(vocabulary, cum_weights, args.segments, random.Random(video)), connection)
+                if (video + 1) % 1000 == 0:
+                    print(f"Indexed {video + 1} videos in {time.perf_counter() - build_start:.1f}s")
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        build_seconds = time.perf_counter() - build_start
+        stats = index_stats()
+
+        # Keywords from the head, middle and tail of the vocabulary, two-word phrases that occur in the text,
+        # and pairs of the most common words, which appear together everywhere but rarely as a phrase
+        sample = ' '.join(segment['text'].lower().rstrip('.') for segment in make_transcript(vocabulary, cum_weights, 20, rng)).split()
+        queries = {
+            'common': vocabulary[:20],
+            'medium': vocabulary[len(vocabulary) // 10:len(vocabulary) // 10 + 20],
+            'rare': vocabulary[-20:],
+            'phrase': [f'{sample[i]} {sample[i + 1]}' for i in range(0, 40, 2)],
+            'common_pair': [f'{vocabulary[i]} {vocabulary[i + 1]}' for i in range(0, 40, 2)]
+        }
+        latencies = {}
+        for kind, keywords in queries.items():
+            search(keywords[0], limit=args.limit)  # Warm the page cache
+            timings = []
+            for keyword in keywords:
+                query_start = time.perf_counter()
+                search(keyword, sentiment=args.sentiment, limit=args.limit)
+                timings.append((time.perf_counter() - query_start) * 1000)
+            latencies[kind] = {'p50_ms': round(statistics.median(timings), 2), 'p95_ms': round(percentile(timings, 0.95), 2),
+                               'max_ms': round(max(timings), 2)}
+            print(f"{kind}: p50 {latencies[kind]['p50_ms']} ms, p95 {latencies[kind]['p95_ms']} ms")
+
+    results = {
+        'videos': stats['videos'],
+        'segments': stats['segments'],
+        'build_seconds': round(build_seconds, 2),
+        'videos_per_second': round(stats['videos'] / build_seconds, 1),
+        'index_mb': round(stats['bytes'] / 1024 / 1024, 1),
+        'query_latency': latencies
+    }
+    print(f"{results['videos']} videos, {results['segments']} segments: built in {results['build_seconds']}s, {results['index_mb']} MB")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark for the transcript search index.")
+    parser.add_argument("--videos", type=int, default=10000, help="Number of synthetic videos to index.")
+    parser.add_argument("--segments", type=int, default=150, help="Segments per video, about 10 minutes of speech.")
+    parser.add_argument("--vocabulary", type=int, default=20000, help="Distinct words in the synthetic transcripts.")
+    parser.add_argument("--index", type=str, help="Keep the index at this path and reuse it on later runs, build time then only covers new videos.")
+    parser.add_argument("--limit", type=int, default=20, help="Videos returned per query.")
+    parser.add_argument("--sentiment", action="store_true", help="Score the sentiment of every returned chunk.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
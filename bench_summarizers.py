@@ -0,0 +1,84 @@
+import argparse
+import io
+import json
+import os
+import random
+import time
+
+os.environ.setdefault('HF_HUB_OFFLINE', '1')  # Never reach for the network, the checkpoint has to be on disk
+
+import modules
+import torch
+from modules import chunk_transcript, bart_generate, quantize_for_cpu
+
+# Latency and throughput of the local BART summarizer, fp32 against int8, across batch sizes.
+# Runs fully offline on a synthetic transcript, or on --transcript if given.
+
+def make_transcript(words, rng):
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9))) for _ in range(2000)]
+    sentences = []
+    while sum(len(sentence.split()) for sentence in sentences) < words:
+        sentences.append(' '.join(rng.choice(vocabulary) for _ in range(rng.randint(6, 20))).capitalize() + '.')
+    return ' '.join(sentences)
+
+# Serialized size, parameters() misses the packed int8 weights
+def model_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return round(buffer.tell() / 1024 / 1024, 1)
+
+def load(checkpoint, quantize):
+    from transformers import BartTokenizer, BartForConditionalGeneration
+    tokenizer = BartTokenizer.from_pretrained(checkpoint, local_files_only=True)
+    model = BartForConditionalGeneration.from_pretrained(checkpoint, local_files_only=True).eval()
+    return tokenizer, quantize_for_cpu(model) if quantize else model
+
+def main(args):
+    rng = random.Random(args.seed)
+    if args.transcript:
+        with open(args.transcript) as file:
+            text = file.read()
+    else:
+        text = make_transcript(args.words, rng)
+    chunks = chunk_transcript(text, modules.BartSummarizer.max_input_tokens)[:args.chunks]
+
+    results = []
+    modules.bart_num_beams = args.num_beams
+    for quantize in (False, True):
+        modules._bart = load(args.checkpoint, quantize)
+        size_mb = model_mb(modules._bart[1])
+        bart_generate(chunks[:1], max_tokens=args.max_tokens)  # Warm-up
+        for batch_size in args.batch_sizes:
+            modules.bart_batch_size = batch_size
+            start_time = time.perf_counter()
+            bart_generate(chunks, max_tokens=args.max_tokens)
+            wall_time = time.perf_counter() - start_time
+            results.append({
+                'dtype': 'int8' if quantize else 'fp32',
+                'batch_size': batch_size,
+                'chunks': len(chunks),
+                'wall_time': round(wall_time, 2),
+                'ms_per_chunk': round(wall_time / len(chunks) * 1000, 1),
+                'chunks_per_second': round(len(chunks) / wall_time, 2),
+                'model_mb': size_mb
+            })
+            print(f"{results[-1]['dtype']} batch {batch_size}: {wall_time:.1f}s for {len(chunks)} chunks, "
+                  f"{results[-1]['chunks_per_second']} chunks/s, model {size_mb} MB")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'checkpoint': args.checkpoint, 'results': results}, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark for the local BART summarization backend.")
+    parser.add_argument("--checkpoint", type=str, default=modules.bart_checkpoint, help="Local checkpoint, e.g. ./results/checkpoint-1000.")
+    parser.add_argument("--transcript", type=str, help="Optional text file to summarize instead of a synthetic transcript.")
+    parser.add_argument("--words", type=int, default=12000, help="Length of the synthetic transcript.")
+    parser.add_argument("--chunks", type=int, default=16, help="Maximum number of chunks to summarize.")
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[1, 4, 8], help="Batch sizes to measure.")
+    parser.add_argument("--num-beams", type=int, default=4, help="Beam width for generation.")
+    parser.add_argument("--max-tokens", type=int, default=modules.bart_summary_tokens, help="Summary length cap in tokens.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic transcript.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,64 @@
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+from queue import Empty
+
+# Real-time factor and peak RSS of each transcription engine on the same fixture.
+# Every engine runs in a fresh process, so peak RSS is that engine's own and nothing leaks between runs.
+
+def run_engine(engine, model_size, fixture, results):
+    from modules import decode_audio, sample_rate
+    from worker import load_transcription_model
+    audio = decode_audio(fixture)
+    start_time = time.perf_counter()
+    model = load_transcription_model(model_size, engine)
+    load_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    result = model.transcribe(audio)
+    transcribe_time = time.perf_counter() - start_time
+    results.put({
+        'engine': engine,
+        'load_time': round(load_time, 2),
+        'transcribe_time': round(transcribe_time, 2),
+        'real_time_factor': round(transcribe_time / (len(audio) / sample_rate), 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),  # KB on Linux
+        'segments': len(result['segments']),
+        'text': result['text']
+    })
+
+def main(args):
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for engine in args.engines:
+        queue = context.Queue()
+        process = context.Process(target=run_engine, args=(engine, args.model, args.fixture, queue))
+        process.start()
+        result = None
+        while result is None and (process.is_alive() or not queue.empty()):  # Read before join, the child can't exit until the pipe is drained
+            try:
+                result = queue.get(timeout=1)
+            except Empty:
+                pass
+        process.join()
+        if result is None or process.exitcode != 0:
+            print(f"{engine}: failed with exit code {process.exitcode}")
+            continue
+        results.append(result)
+        print(f"{engine}: RTF {results[-1]['real_time_factor']}, peak RSS {results[-1]['peak_rss_mb']} MB, "
+              f"load {results[-1]['load_time']}s")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'fixture': args.fixture, 'model': args.model, 'results': results}, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark comparing transcription engines.")
+    parser.add_argument("fixture", type=str, help="Local audio file to transcribe.")
+    parser.add_argument("--engines", type=str, nargs='+', default=['whisper', 'whisper-int8', 'faster-whisper'], help="Engines to measure.")
+    parser.add_argument("--model", type=str, default="small", help="Model size.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,43 @@
+import argparse
+import json
+import time
+from modules import decode_audio, transcribe_chunks, sample_rate
+from worker import model_registry
+
+# Transcribes the same local fixture with 1..N processes and reports speedup per process count
+
+def run(audio, model_size, processes, chunk_minutes):
+    start_time = time.perf_counter()
+    segments = transcribe_chunks(audio, model_size, processes, chunk_minutes * 60)
+    return time.perf_counter() - start_time, len(segments)
+
+def main(args):
+    audio = decode_audio(args.fixture)
+    audio_seconds = len(audio) / sample_rate
+    model_registry.preload([args.model])  # Keep model load time out of the measurements
+
+    results = []
+    for processes in range(1, args.max_processes + 1):
+        wall_time, segment_count = run(audio, args.model, processes, args.chunk_minutes)
+        results.append({
+            'processes': processes,
+            'wall_time': round(wall_time, 2),
+            'speedup': round(results[0]['wall_time'] / wall_time, 2) if results else 1.0,
+            'real_time_factor': round(wall_time / audio_seconds, 3),
+            'segments': segment_count
+        })
+        print(f"{processes} process(es): {wall_time:.1f}s, speedup {results[-1]['speedup']}x, RTF {results[-1]['real_time_factor']}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'fixture': args.fixture, 'audio_seconds': audio_seconds, 'model': args.model, 'results': results}, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling benchmark for parallel chunked transcription.")
+    parser.add_argument("fixture", type=str, help="Local audio file to transcribe.")
+    parser.add_argument("--max-processes", type=int, default=4, help="Highest process count to measure.")
+    parser.add_argument("--chunk-minutes", type=float, default=2, help="Target chunk length in minutes.")
+    parser.add_argument("--model", type=str, default="small", help="Whisper model size.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,67 @@
+import argparse
+import json
+import multiprocessing
+import time
+from modules import decode_audio, sample_rate
+from worker import model_registry, node_resources, plan_topology
+
+# Jobs per hour for each worker/thread split of this node. Every worker is pinned and sized the way
+# worker.py's supervisor does it and transcribes the fixture back to back for a fixed time.
+
+def run_jobs(cpus, threads, model_size, audio, seconds, counts):
+    import os
+    import torch
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    model = model_registry.get(model_size)
+    jobs = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        model.transcribe(audio)
+        jobs += 1
+    counts.put(jobs)
+
+def measure(topology, model_size, audio, seconds):
+    context = multiprocessing.get_context('fork')  # Workers share the preloaded model, like in production
+    counts = context.Queue()
+    start_time = time.perf_counter()
+    processes = [context.Process(target=run_jobs, args=(cpus, threads, model_size, audio, seconds, counts)) for cpus, threads in topology]
+    for process in processes:
+        process.start()
+    jobs = sum(counts.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return jobs, time.perf_counter() - start_time
+
+def main(args):
+    audio = decode_audio(args.fixture)
+    model_registry.preload([args.model])
+    cores, available_ram_mb = node_resources()
+    splits = args.workers or [workers for workers in range(1, len(cores) + 1) if len(cores) % workers == 0]
+
+    results = []
+    for workers in splits:
+        topology = plan_topology(cores, available_ram_mb, 1, workers=workers)
+        jobs, wall_time = measure(topology, args.model, audio, args.seconds)
+        results.append({
+            'workers': len(topology),
+            'threads_per_worker': topology[0][1],
+            'jobs': jobs,
+            'jobs_per_hour': round(jobs / wall_time * 3600, 1),
+            'audio_hours_per_hour': round(jobs * len(audio) / sample_rate / wall_time, 2)
+        })
+        print(f"{len(topology)} worker(s) x {topology[0][1]} thread(s): {results[-1]['jobs_per_hour']} jobs/h")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'fixture': args.fixture, 'model': args.model, 'cores': len(cores), 'results': results}, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of worker/thread splits on this node.")
+    parser.add_argument("fixture", type=str, help="Local audio file, one transcription of it is one job.")
+    parser.add_argument("--workers", type=int, nargs='+', help="Worker counts to measure, defaults to every divisor of the core count.")
+    parser.add_argument("--seconds", type=float, default=300, help="How long each split runs.")
+    parser.add_argument("--model", type=str, default="small", help="Whisper model size.")
+    parser.add_argument("--output", type=str, help="Optional path for JSON results.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import redis
+import struct
+import zlib
+from pytube import extract
+from pytube.exceptions import RegexMatchError
+from worker import conn, transcriber_key
+import modules
+
+# How long finished results are served from the cache, in seconds
+result_cache_ttl = int(os.getenv('RESULT_CACHE_TTL', '3600'))
+
+# How long finished results are kept for /task_status and /task_result, in seconds
+result_ttl = int(os.getenv('RESULT_TTL', str(24 * 3600)))
+
+# Timestamped segments are stored in separately compressed pages, so a page request only inflates what it returns
+result_page_segments = int(os.getenv('RESULT_PAGE_SEGMENTS', '200'))
+
+# How long transcripts are kept for re-analysis with other parameters, in seconds
+transcript_cache_ttl = int(os.getenv('TRANSCRIPT_CACHE_TTL', str(7 * 24 * 3600)))
+
+def canonical_video_id(youtube_url):
+    try:
+        return extract.video_id(youtube_url)
+    except RegexMatchError:
+        return youtube_url.strip()  # Not a recognizable link, the job itself will reject it
+
+def normalize_keywords(keywords, case_sensitive=False):
+    if not keywords:
+        return ''
+    keywords = {keyword.strip() if case_sensitive else keyword.strip().casefold() for keyword in keywords.split(',')}
+    return ', '.join(sorted(keyword for keyword in keywords if keyword))
+
+def result_cache_key(youtube_url, length, keywords, kw_analysis_length, whole_words=False, case_sensitive=False, summary_backend=None):
+    keywords = normalize_keywords(keywords, case_sensitive)
+    params = {
+        'summary_sentences': str(length).strip(),
+        'keywords': keywords,
+        'keyword_analysis_sentences': str(kw_analysis_length).strip() if keywords else '',
+        'whole_words': bool(whole_words) if keywords else False,
+        'case_sensitive': bool(case_sensitive) if keywords else False,
+        'summary_backend': summary_backend
+    }
+    if modules.summary_extract_tokens:
+        params['extract_tokens'] = modules.summary_extract_tokens  # Excerpts make a different summary, off leaves existing keys as they were
+    key_source = canonical_video_id(youtube_url) + '|' + json.dumps(params, sort_keys=True)
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+# Segments packed as little-endian uint32 (start, end, text length) triples followed by the UTF-8 texts.
+# Whole seconds, like timestamp_segments produces them.
+def pack_segments(segments):
+    texts = [segment['text'].encode() for segment in segments]
+    values = [len(segments)] + [value for segment, text in zip(segments, texts) for value in (int(segment['start']), int(segment['end']), len(text))]
+    return zlib.compress(struct.pack(f'<{len(values)}I', *values) + b''.join(texts))
+
+def unpack_segments(blob):
+    data = zlib.decompress(blob)
+    count, = struct.unpack_from('<I', data)
+    values = struct.unpack_from(f'<{3 * count}I', data, 4)
+    position = 4 + 12 * count
+    segments = []
+    for i in range(count):
+        start, end, size = values[3 * i:3 * i + 3]
+        segments.append({'start': start, 'end': end, 'text': data[position:position + size].decode()})
+        position += size
+    return segments
+
+def pack_json(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode())
+
+def unpack_json(blob):
+    return json.loads(zlib.decompress(blob))
+
+# What /task_status returns and what RQ keeps as the job result: the summary and metadata, never the transcript
+def result_summary(result):
+    return {
+        'summary': result['summary'],
+        'sentiment_summary': result['sentiment_summary'],
+        'transcript_cached': result.get('transcript_cached', False),
+        'segment_count': len(result['transcript_timestamped']),
+        'keyword_chunk_count': len(result['transcript_filtered'] or [])
+    }
+
+def result_key(task_id):
+    return f'result:{task_id}'
+
+# One hash per task: the summary, the keyword analysis and the transcript pages, all expiring together
+def store_task_result(task_id, result):
+    segments = result['transcript_timestamped']
+    fields = {
+        'summary': pack_json(result_summary(result)),
+        'keywords': pack_json({'transcript_filtered': result['transcript_filtered'], 'sentiment_analysis': result['sentiment_analysis']})
+    }
+    for page, start in enumerate(range(0, len(segments), result_page_segments)):
+        fields[f'page:{page}'] = pack_segments(segments[start:start + result_page_segments])
+    pipe = conn.pipeline()
+    pipe.delete(result_key(task_id))
+    pipe.hset(result_key(task_id), mapping=fields)
+    pipe.expire(result_key(task_id), result_ttl)
+    pipe.execute()
+
+def get_result_summary(task_id):
+    blob = conn.hget(result_key(task_id), 'summary')
+    return unpack_json(blob) if blob is not None else None
+
+def get_result_keywords(task_id):
+    blob = conn.hget(result_key(task_id), 'keywords')
+    return unpack_json(blob) if blob is not None else None
+
+# Returns (segments, total segment count), or None once the result has expired
+def get_result_segments(task_id, offset, limit):
+    summary = get_result_summary(task_id)
+    if summary is None:
+        return None
+    end = min(offset + limit, summary['segment_count'])
+    if offset >= end:
+        return [], summary['segment_count']
+    pages = range(offset // result_page_segments, (end - 1) // result_page_segments + 1)
+    blobs = conn.hmget(result_key(task_id), [f'page:{page}' for page in pages])
+    if any(blob is None for blob in blobs):
+        return None
+    segments = [segment for blob in blobs for segment in unpack_segments(blob)]
+    first = pages[0] * result_page_segments
+    return segments[offset - first:end - first], summary['segment_count']
+
+# The cache entry only points at the task, whose stored result has the data
+def get_cached_result(cache_key):
+    task_id = conn.get(f'result_cache:{cache_key}')
+    if task_id is None:
+        return None
+    summary = get_result_summary(task_id.decode())
+    return {'task_id': task_id.decode(), 'result': summary} if summary is not None else None
+
+# get_cached_result for many keys in two round trips
+def get_cached_results(cache_keys):
+    task_ids = conn.mget([f'result_cache:{cache_key}' for cache_key in cache_keys]) if cache_keys else []
+    pipe = conn.pipeline(transaction=False)
+    for task_id in task_ids:
+        if task_id is not None:
+            pipe.hget(result_key(task_id.decode()), 'summary')
+    blobs = iter(pipe.execute())
+    results = []
+    for task_id in task_ids:
+        blob = next(blobs) if task_id is not None else None
+        results.append({'task_id': task_id.decode(), 'result': unpack_json(blob)} if blob is not None else None)
+    return results
+
+def store_result(cache_key, task_id, result):
+    store_task_result(task_id, result)
+    pipe = conn.pipeline()
+    pipe.set(f'result_cache:{cache_key}', task_id, ex=min(result_cache_ttl, result_ttl))
+    pipe.delete(f'inflight:{cache_key}')
+    pipe.execute()
+
+# A claim can be made before its job is in Redis, a batch only enqueues its jobs once every claim is made.
+# While this marker lives, a claim whose job doesn't exist yet still counts as alive.
+inflight_grace_seconds = 30
+
+def pending_key(job_id):
+    return f'inflight_pending:{job_id}'
+
+def claim_pending(job_id):
+    return bool(conn.exists(pending_key(job_id)))
+
+# Returns the id of the job already running for this key, or None if job_id now owns it
+def claim_inflight(cache_key, job_id, ttl):
+    return claim_inflight_many([(cache_key, job_id, ttl)])[0]
+
+# claim_inflight for many (cache_key, job_id, ttl) claims, in one round trip while the keys are free
+def claim_inflight_many(claims):
+    pipe = conn.pipeline(transaction=False)
+    for cache_key, job_id, ttl in claims:
+        pipe.set(pending_key(job_id), 1, ex=inflight_grace_seconds)
+        pipe.set(f'inflight:{cache_key}', job_id, nx=True, ex=ttl)
+    claimed = pipe.execute()[1::2]
+    taken = [f'inflight:{cache_key}' for (cache_key, _, _), ok in zip(claims, claimed) if not ok]
+    owners = iter(conn.mget(taken) if taken else [])
+    existing = []
+    for claim, ok in zip(claims, claimed):
+        owner = None if ok else next(owners)
+        if not ok and owner is None:
+            existing.append(claim_inflight(*claim))  # Released in between, try again
+        else:
+            existing.append(owner.decode() if owner is not None else None)
+    return existing
+
+# Hands the key over from a dead job to job_id, unless another request got there first
+def replace_inflight(cache_key, stale_job_id, job_id, ttl):
+    key = f'inflight:{cache_key}'
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            current = pipe.get(key)
+            if current is not None and current.decode() != stale_job_id:
+                pipe.unwatch()
+                return current.decode()
+            pipe.multi()
+            pipe.set(pending_key(job_id), 1, ex=inflight_grace_seconds)
+            pipe.set(key, job_id, ex=ttl)
+            pipe.execute()
+            return None
+        except redis.WatchError:
+            current = conn.get(key)
+            return current.decode() if current is not None else None
+
+# Keyed on the model size and the engine that ran it, a deployment never reuses another engine's transcripts
+def transcript_key(video_id, model_size):
+    return f'transcript:{video_id}:{transcriber_key(model_size)}'
+
+def get_cached_transcript(video_id, model_size):
+    cached = conn.get(transcript_key(video_id, model_size))
+    return json.loads(cached) if cached is not None else None
+
+def store_transcript(video_id, model_size, transcript, transcript_timestamped):
+    artifact = {
+        'transcript': transcript,
+        'transcript_timestamped': transcript_timestamped,
+        'model_size': model_size,
+        'transcriber': transcriber_key(model_size)
+    }
+    conn.set(transcript_key(video_id, model_size), json.dumps(artifact), ex=transcript_cache_ttl)
+
+# Gives up a claim that job_id made but never enqueued, leaves other owners alone
+def release_inflight(cache_key, job_id):
+    key = f'inflight:{cache_key}'
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            current = pipe.get(key)
+            if current is None or current.decode() != job_id:
+                pipe.unwatch()
+                return
+            pipe.multi()
+            pipe.delete(key, pending_key(job_id))
+            pipe.execute()
+        except redis.WatchError:
+            pass
@@ -0,0 +1,43 @@
+import json
+import os
+from worker import conn
+
+# How long a job's event stream is kept after its last event, in seconds
+event_stream_ttl = int(os.getenv('EVENT_STREAM_TTL', '3600'))
+event_stream_maxlen = 10000
+terminal_events = ('finished', 'failed')
+
+def event_stream_key(task_id):
+    return f'job_events:{task_id}'
+
+def publish_event(task_id, event, data):
+    key = event_stream_key(task_id)
+    pipe = conn.pipeline()
+    pipe.xadd(key, {'event': event, 'data': json.dumps(data)}, maxlen=event_stream_maxlen, approximate=True)
+    pipe.expire(key, event_stream_ttl)
+    pipe.execute()
+
+def read_events(task_id, last_id='0', block_ms=None):
+    response = conn.xread({event_stream_key(task_id): last_id}, block=block_ms)
+    events = []
+    for _, entries in response:
+        for event_id, fields in entries:
+            events.append((event_id.decode(), fields[b'event'].decode(), json.loads(fields[b'data'])))
+    return events
+
+def format_sse(event_id, event, data):
+    return f'id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n'
+
+# Yields server-sent events until the job reports a terminal event or is_done() says it's over
+def stream_events(task_id, last_id='0', block_ms=15000, is_done=None):
+    while True:
+        events = read_events(task_id, last_id, block_ms)
+        for event_id, event, data in events:
+            last_id = event_id
+            yield format_sse(event_id, event, data)
+            if event in terminal_events:
+                return
+        if not events:
+            if is_done is not None and is_done():
+                return
+            yield ': keep-alive\n\n'
@@ -0,0 +1,125 @@
+import time
+import redis
+from datetime import datetime, timezone
+from rq import Worker
+from worker import conn, get_model_stats
+
+# Metrics live in Redis hashes, so the work-horses RQ forks, and workers on other nodes, all add to
+# the same counters. /metrics renders them in the Prometheus text format at scrape time.
+
+duration_buckets = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+histograms = {
+    'av_stage_duration_seconds': ('Time spent in each pipeline stage', duration_buckets),
+    'av_audio_duration_seconds': ('Length of the transcribed audio', (60, 300, 600, 1200, 1800, 3600, 7200, 14400)),
+    'av_real_time_factor': ('Transcription seconds per second of audio', (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 4)),
+    'av_download_bytes': ('Bytes fetched per audio download', tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500))),
+    'av_summary_seconds': ('Time to summarize a transcript, by whether it was pre-compressed', (1, 2.5, 5, 10, 20, 30, 60, 120, 300)),
+    'av_openai_limiter_wait_seconds': ('Time a chat completion waited for the shared rate limiter', (0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+}
+counters = {
+    'av_cache_requests_total': 'Cache lookups by cache and outcome',
+    'av_jobs_total': 'Finished jobs by outcome',
+    'av_download_bytes_total': 'Bytes fetched by audio downloads',
+    'av_audio_store_saved_bytes_total': 'Download bytes avoided by reusing stored audio',
+    'av_audio_store_evicted_bytes_total': 'Bytes of stored audio evicted to stay within the budget',
+    'av_summary_input_tokens_total': 'Tokens sent to the summarizer, by whether the transcript was pre-compressed',
+    'av_summary_extracted_tokens_saved_total': 'Transcript tokens left out by extractive pre-compression',
+    'av_openai_retries_total': 'Chat completions retried, by status code or connection error',
+    'av_summary_truncations_total': 'Summary reduces cut short, by backend and whether they stopped shrinking or ran too deep'
+}
+
+def metric_key(name):
+    return f'metrics:{name}'
+
+def label_string(labels):
+    return ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+def observe(name, value, **labels):
+    labels = label_string(labels)
+    bucket = next((str(le) for le in histograms[name][1] if value <= le), '+Inf')  # Stored per bucket, summed up when rendered
+    try:
+        pipe = conn.pipeline()
+        pipe.hincrby(metric_key(name), f'{labels}|{bucket}', 1)
+        pipe.hincrbyfloat(metric_key(name), f'{labels}|sum', value)
+        pipe.hincrby(metric_key(name), f'{labels}|count', 1)
+        pipe.execute()
+    except redis.RedisError:
+        pass  # Metrics are best effort, never fail a job over them
+
+def inc(name, amount=1, **labels):
+    try:
+        conn.hincrby(metric_key(name), label_string(labels), amount)
+    except redis.RedisError:
+        pass
+
+# Times a pipeline stage across calls, stage jobs and processes, through the job's meta
+def start_stage(current_job, stage):
+    end_stage(current_job)
+    current_job.meta['stage'] = stage
+    current_job.meta['stage_started'] = time.time()
+
+def end_stage(current_job):
+    stage = current_job.meta.pop('stage', None)
+    started = current_job.meta.pop('stage_started', None)
+    if stage is not None and started is not None:
+        observe('av_stage_duration_seconds', time.time() - started, stage=stage)
+
+def _labels_block(labels, extra=None):
+    parts = [part for part in (labels, extra) if part]
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+def _render_histogram(lines, name, help_text, buckets):
+    lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    series = {}
+    for field, value in conn.hgetall(metric_key(name)).items():
+        labels, suffix = field.decode().rsplit('|', 1)
+        series.setdefault(labels, {})[suffix] = float(value)
+    for labels, values in sorted(series.items()):
+        cumulative = 0
+        for le in [str(le) for le in buckets] + ['+Inf']:
+            cumulative += values.get(le, 0)
+            le_label = f'le="{le}"'
+            lines.append(f'{name}_bucket{_labels_block(labels, le_label)} {int(cumulative)}')
+        lines.append(f'{name}_sum{_labels_block(labels)} {values.get("sum", 0)}')
+        lines.append(f'{name}_count{_labels_block(labels)} {int(values.get("count", 0))}')
+
+def _render_gauge(lines, name, help_text, samples):
+    lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+    lines += [f'{name}{_labels_block(labels)} {value}' for labels, value in samples]
+
+def oldest_job_age(queue, now):
+    job_ids = queue.get_job_ids(0, 1)
+    if not job_ids:
+        return 0
+    job = queue.fetch_job(job_ids[0])
+    if job is None or job.enqueued_at is None:
+        return 0
+    return max(0, (now - job.enqueued_at.replace(tzinfo=timezone.utc)).total_seconds())
+
+def render_metrics(queues):
+    lines = []
+    for name, (help_text, buckets) in histograms.items():
+        _render_histogram(lines, name, help_text, buckets)
+
+    for name, help_text in counters.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for labels, value in sorted(conn.hgetall(metric_key(name)).items()):
+            lines.append(f'{name}{_labels_block(labels.decode())} {int(value)}')
+
+    # Model registry counters, already kept in Redis by every worker
+    model_stats = get_model_stats(conn)
+    lines += ['# HELP av_model_cache_requests_total Whisper model lookups by outcome', '# TYPE av_model_cache_requests_total counter']
+    lines += [f'av_model_cache_requests_total{{outcome="{outcome}"}} {model_stats[counter]}' for counter, outcome in (('hits', 'hit'), ('misses', 'miss'))]
+    _render_gauge(lines, 'av_model_load_seconds', 'Last measured load time per model size',
+                  [(f'size="{key.split(":", 1)[1]}"', value) for key, value in sorted(model_stats.items()) if key.startswith('load_time:')])
+
+    now = datetime.now(timezone.utc)
+    _render_gauge(lines, 'av_queue_depth', 'Jobs waiting in each queue', [(f'queue="{queue.name}"', queue.count) for queue in queues])
+    _render_gauge(lines, 'av_queue_deferred_jobs', 'Jobs waiting on an earlier stage',
+                  [(f'queue="{queue.name}"', queue.deferred_job_registry.count) for queue in queues])
+    _render_gauge(lines, 'av_queue_started_jobs', 'Jobs running right now', [(f'queue="{queue.name}"', queue.started_job_registry.count) for queue in queues])
+    _render_gauge(lines, 'av_queue_oldest_job_age_seconds', 'Age of the oldest waiting job',
+                  [(f'queue="{queue.name}"', round(oldest_job_age(queue, now), 1)) for queue in queues])
+    _render_gauge(lines, 'av_workers', 'Workers listening on each queue',
+                  [(f'queue="{queue.name}"', Worker.count(connection=conn, queue=queue)) for queue in queues])
+    return '\n'.join(lines) + '\n'
@@ -1,53 +1,322 @@
 from pytube import YouTube
 import os
+import subprocess
+import multiprocessing
+import re
+import json
+import time
+import math
+import tempfile
+import http.client
+import urllib.request
+import itertools
+import queue
+import threading
+from collections import deque
+from uuid import uuid4
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import torch
 from dotenv import load_dotenv
 from pydub import AudioSegment
+import openai
 from openai import OpenAI
 import whisper
+from whisper.tokenizer import get_encoding
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from worker import conn, model_registry, default_model_size, spoken_language
+from metrics import inc
+import rate_limit
 
-def filter_sentences_with_context(transcript_timestamped, keywords):
-    keywords_list = keywords.split(', ')
+# Keyword Matching Module
+# All keywords are compiled into one trie-shaped regex, so a segment is checked against every keyword
+# in a single pass. Inside a matched span, only the positions where another keyword could start are
+# rescanned, to also report overlapping keywords ("art" inside "start").
+def build_trie(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # End of a keyword
+    return trie
+
+def trie_pattern(node):
+    branches = [re.escape(char) + trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    pattern = branches[0] if len(branches) == 1 and len(branches[0]) == 1 else '(?:' + '|'.join(branches) + ')'
+    return pattern + '?' if '' in node else pattern
+
+def overlap_positions(key, trie):
+    positions = []
+    for start in range(1, len(key)):
+        node = trie
+        for char in key[start:]:
+            node = node.get(char)
+            if node is None or '' in node:
+                break
+        if node is not None:
+            positions.append(start)  # A keyword starts here, ending inside the key or running past it
+    return positions
+
+class KeywordMatcher:
+    def __init__(self, keywords, whole_words=False, case_sensitive=False):
+        self.whole_words = whole_words
+        self.case_sensitive = case_sensitive
+        self.keywords = {}  # Normalized keyword -> keyword as the user wrote it, in request order
+        for keyword in (keywords or '').split(','):
+            keyword = keyword.strip()
+            if keyword:
+                self.keywords.setdefault(self.normalize(keyword), keyword)
+        self.order = {key: index for index, key in enumerate(self.keywords)}
+
+        trie = build_trie(self.keywords)
+        # At one position the regex only reports the longest keyword, remember the shorter ones it starts with
+        self.prefixes = {key: list(self._trie_prefixes(key, trie)) for key in self.keywords}
+        self.overlaps = {key: overlap_positions(key, trie) for key in self.keywords}
+
+        if self.keywords:
+            alternation = trie_pattern(trie)
+            if whole_words:
+                alternation = rf'(?<!\w){alternation}(?!\w)'
+            self.pattern = re.compile(alternation)
+        else:
+            self.pattern = None
+
+    def normalize(self, text):
+        return text if self.case_sensitive else text.casefold()
+
+    def _trie_prefixes(self, key, trie):
+        node = trie
+        for length, char in enumerate(key[:-1], start=1):
+            node = node[char]
+            if '' in node and (not self.whole_words or not re.match(r'\w', key[length])):
+                yield key[:length]
+
+    def _add_hit(self, key, hits):
+        hits.add(key)
+        hits.update(self.prefixes[key])
+
+    def find(self, text):
+        if self.pattern is None:
+            return []
+        text = self.normalize(text)
+        hits = set()
+        for match in self.pattern.finditer(text):
+            key = match.group()
+            self._add_hit(key, hits)
+            for offset in self.overlaps[key]:
+                inner = self.pattern.match(text, match.start() + offset)
+                if inner:
+                    self._add_hit(inner.group(), hits)
+        return [self.keywords[key] for key in sorted(hits, key=self.order.get)]
+
+# Accepts a keyword string or a KeywordMatcher built once for the request.
+# Every returned chunk lists the keywords that were found in it.
+def filter_sentences_with_context(transcript_timestamped, keywords, whole_words=False, case_sensitive=False):
+    matcher = keywords if isinstance(keywords, KeywordMatcher) else KeywordMatcher(keywords, whole_words, case_sensitive)
     filtered_sentences = []
     chunk = []
+    chunk_keywords = []
     chunk_start_time = None
     chunk_end_time = None
-    
+
     for i, sentence in enumerate(transcript_timestamped):
-        contains_keyword = any(keyword.lower() in sentence['text'].lower() for keyword in keywords_list)
+        hits = matcher.find(sentence['text'])
 
-        if contains_keyword:
+        if hits:
             if not chunk:
                 chunk_start_time = transcript_timestamped[i-1]['start'] if i > 0 else sentence['start']
                 if i > 0:
                     chunk.append(transcript_timestamped[i-1]['text'])
             chunk.append(sentence['text'])
+            chunk_keywords.extend(keyword for keyword in hits if keyword not in chunk_keywords)
             chunk_end_time = sentence['end']
 
         elif chunk:
             chunk.append(sentence['text'])
             chunk_end_time = sentence['end']
             chunk_text = '... ' + ' '.join(chunk) + ' ...'
-            filtered_sentences.append({"text": chunk_text, "start": chunk_start_time, "end": chunk_end_time})
+            filtered_sentences.append({"text": chunk_text, "start": chunk_start_time, "end": chunk_end_time, "keywords": chunk_keywords})
             chunk = []
+            chunk_keywords = []
             chunk_start_time = None
             chunk_end_time = None
 
     if chunk:
         chunk_text = '... ' + ' '.join(chunk) + ' ...'
         chunk_end_time = chunk_end_time if chunk_end_time else transcript_timestamped[-1]['end']
-        filtered_sentences.append({"text": chunk_text, "start": chunk_start_time, "end": chunk_end_time})
+        filtered_sentences.append({"text": chunk_text, "start": chunk_start_time, "end": chunk_end_time, "keywords": chunk_keywords})
 
     return filtered_sentences
 
-# YouTube Download Module
-def download_yt_audio(youtube_url):
+# Audio Download Module
+# Everything is resampled to 16 kHz mono speech, so the smallest audio stream at or above a bitrate floor
+# is enough. It's fetched over parallel HTTP range requests, each resuming where it stopped if it fails.
+audio_min_abr_kbps = int(os.getenv('AUDIO_MIN_ABR_KBPS', '48'))
+download_connections = int(os.getenv('DOWNLOAD_CONNECTIONS', '4'))
+download_part_bytes = 2 * 1024 * 1024  # Smallest range worth its own connection
+download_retries = 5
+download_timeout = 30
+
+def stream_kbps(stream):
+    match = re.match(r'(\d+)', stream.abr or '')
+    return int(match.group(1)) if match else 0
+
+def select_audio_stream(streams, min_kbps=None):
+    min_kbps = audio_min_abr_kbps if min_kbps is None else min_kbps
+    streams = [stream for stream in streams if stream_kbps(stream)]
+    if not streams:
+        return None
+    good_enough = [stream for stream in streams if stream_kbps(stream) >= min_kbps]
+    if good_enough:
+        return min(good_enough, key=stream_kbps)
+    return max(streams, key=stream_kbps)  # Nothing reaches the floor, take the best there is
+
+class RangeNotSupported(Exception):
+    pass
+
+# Streams bytes start..end (inclusive) of url to write(), resuming where a failed attempt stopped.
+# Returns the bytes fetched.
+def fetch_range(url, start, end, write):
+    position = start
+    attempt = 0
+    while position <= end:
+        try:
+            request = urllib.request.Request(url, headers={'Range': f'bytes={position}-{end}'})
+            with urllib.request.urlopen(request, timeout=download_timeout) as response:
+                if response.status != 206 and position != 0:
+                    raise RangeNotSupported(url)
+                while position <= end:
+                    block = response.read(256 * 1024)
+                    if not block:
+                        break
+                    block = block[:end + 1 - position]
+                    write(block)
+                    position += len(block)
+            if position <= end:
+                raise ConnectionError(f"Connection closed at byte {position} of {end + 1}")
+        except (OSError, http.client.HTTPException):
+            attempt += 1
+            if attempt > download_retries:
+                raise
+            time.sleep(min(0.1 * 2 ** attempt, 5))  # Picks up from position on the next try
+    return position - start
+
+def fetch_range_to_file(url, path, start, end):
+    with open(path, 'r+b') as file:
+        file.seek(start)
+        return fetch_range(url, start, end, file.write)
+
+def download_ranged(url, path, size, connections=None):
+    if not size:
+        raise ValueError("The audio stream reported no size")
+    connections = max(1, min(connections or download_connections, math.ceil(size / download_part_bytes)))
+    with open(path, 'wb') as file:
+        file.truncate(size)
+    part_size = math.ceil(size / connections)
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            return sum(pool.map(lambda part: fetch_range_to_file(url, path, *part), ranges)), connections
+    except RangeNotSupported:
+        return fetch_range_to_file(url, path, 0, size - 1), 1
+
+def download_yt_audio(youtube_url, output_path=None, stats=None):
     yt = YouTube(youtube_url)
-    audio_stream = yt.streams.filter(only_audio=True).first()
-    audio_filename = audio_stream.default_filename
-    audio_stream.download(filename=audio_filename)
+    audio_stream = select_audio_stream(yt.streams.filter(only_audio=True))
+    if audio_stream is None:
+        raise ValueError("The video has no audio stream available")
+    audio_filename = output_path or os.path.join(tempfile.gettempdir(), f'{uuid4().hex}.{audio_stream.subtype}')
+    start_time = time.perf_counter()
+    fetched, connections = download_ranged(audio_stream.url, audio_filename, audio_stream.filesize)
+    if stats is not None:
+        stats.update({'bytes': fetched, 'seconds': round(time.perf_counter() - start_time, 3), 'connections': connections,
+                      'abr': audio_stream.abr, 'itag': audio_stream.itag})
     return audio_filename
 
+# Streaming Download Module
+# Yields the file in order while up to `prefetch` ranges download ahead, so memory stays at
+# prefetch * part_bytes however long the video is.
+download_stream_part_bytes = 1024 * 1024
+
+def read_range(url, start, end):
+    blocks = []
+    fetch_range(url, start, end, blocks.append)
+    return b''.join(blocks)
+
+def iter_ranges(url, size, part_bytes, prefetch):
+    ranges = iter([(start, min(start + part_bytes, size) - 1) for start in range(0, size, part_bytes)])
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        pending = deque(pool.submit(read_range, url, *part) for part in itertools.islice(ranges, prefetch))
+        try:
+            while pending:
+                data = pending.popleft().result()
+                pending.extend(pool.submit(read_range, url, *part) for part in itertools.islice(ranges, 1))
+                yield data
+        finally:
+            for future in pending:
+                future.cancel()
+
+# The file from byte `start` over one plain request, for servers that ignore Range. What's before start
+# is read and dropped, a dropped connection starts over from the top.
+def iter_single_stream(url, start, size):
+    position = start
+    attempt = 0
+    while position < size:
+        try:
+            with urllib.request.urlopen(url, timeout=download_timeout) as response:
+                skipped = 0
+                while True:
+                    block = response.read(256 * 1024)
+                    if not block:
+                        break
+                    if skipped + len(block) > position:
+                        block = block[position - skipped:]
+                        position += len(block)
+                        skipped = position
+                        yield block
+                    else:
+                        skipped += len(block)
+            if position < size:
+                raise ConnectionError(f"Connection closed at byte {position} of {size}")
+        except (OSError, http.client.HTTPException):
+            attempt += 1
+            if attempt > download_retries:
+                raise
+            time.sleep(min(0.1 * 2 ** attempt, 5))
+
+def iter_download(url, size, part_bytes=download_stream_part_bytes, prefetch=None, stats=None):
+    start_time = time.perf_counter()
+    position = 0
+    try:
+        for data in iter_ranges(url, size, part_bytes, prefetch or download_connections):
+            position += len(data)
+            if stats is not None:
+                stats['bytes'] = stats.get('bytes', 0) + len(data)
+                stats['seconds'] = round(time.perf_counter() - start_time, 3)
+            yield data
+    except RangeNotSupported:
+        # Same fallback as download_ranged: the rest over one connection, in order
+        if stats is not None:
+            stats['connections'] = 1
+        for data in iter_single_stream(url, position, size):
+            if stats is not None:
+                stats['bytes'] = stats.get('bytes', 0) + len(data)
+                stats['seconds'] = round(time.perf_counter() - start_time, 3)
+            yield data
+
+# Returns (byte iterator, video length in seconds) without downloading anything yet
+def open_audio_download(youtube_url, stats=None):
+    yt = YouTube(youtube_url)
+    audio_stream = select_audio_stream(yt.streams.filter(only_audio=True))
+    if audio_stream is None:
+        raise ValueError("The video has no audio stream available")
+    if stats is not None:
+        stats.update({'bytes': 0, 'connections': download_connections, 'abr': audio_stream.abr, 'itag': audio_stream.itag})
+    return iter_download(audio_stream.url, audio_stream.filesize, stats=stats), yt.length
+
 # Audio Conversion Module
 def convert_audio(audio_filename):
     audio = AudioSegment.from_file(audio_filename, format="mp4")
@@ -55,46 +324,723 @@ def convert_audio(audio_filename):
     audio.set_channels(1).set_frame_rate(16000).export(converted_audio_filename, format="wav")
     return converted_audio_filename
 
+# Audio Decoding Module
+# ffmpeg decodes straight to 16 kHz mono PCM on a pipe, no intermediate WAV is written.
+# Memory per hour of audio: the float32 buffer is 16000 * 4 B/s = ~230 MB. While decoding, the
+# int16 windows not yet converted add up to ~115 MB more, so the peak is ~345 MB/hour, released
+# window by window. Whisper's log-mel spectrogram adds ~115 MB/hour on top during transcription.
+sample_rate = 16000
+decode_window_seconds = 30
+
+# Decodes a file, or an iterator of encoded bytes that is fed to ffmpeg's stdin as it arrives
+def stream_pcm(source, window_seconds=decode_window_seconds):
+    from_file = isinstance(source, str)
+    command = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-threads', '0', '-i', source] if from_file else \
+              ['ffmpeg', '-loglevel', 'error', '-threads', '0', '-i', 'pipe:0']
+    command += ['-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(sample_rate), '-']
+    process = subprocess.Popen(command, stdin=None if from_file else subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    feed_errors = []
+    if not from_file:
+        def feed():
+            try:
+                for block in source:
+                    process.stdin.write(block)  # Blocks while ffmpeg is behind, which holds back the download
+            except BrokenPipeError:
+                pass  # ffmpeg stopped reading, its exit code says why
+            except Exception as e:
+                feed_errors.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+        threading.Thread(target=feed, daemon=True).start()
+
+    window_bytes = window_seconds * sample_rate * 2
+    try:
+        while True:
+            data = process.stdout.read(window_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data, np.int16)
+    except GeneratorExit:
+        process.kill()  # Consumer stopped early, don't leave ffmpeg blocked on a full pipe
+        raise
+    finally:
+        process.stdout.close()
+        error_output = process.stderr.read().decode(errors='replace').strip()
+        return_code = process.wait()
+    if feed_errors:
+        raise feed_errors[0]  # A failed download explains more than ffmpeg's truncated input
+    if return_code != 0:
+        raise RuntimeError(f"ffmpeg failed to decode audio: {error_output}")
+
+# Yields fixed windows of float32 audio, memory stays at one window regardless of length
+def stream_audio(audio_filename, window_seconds=decode_window_seconds):
+    for window in stream_pcm(audio_filename, window_seconds):
+        yield window.astype(np.float32) / 32768.0
+
+def decode_audio(audio_filename):
+    windows = list(stream_pcm(audio_filename))
+    audio = np.empty(sum(len(window) for window in windows), dtype=np.float32)
+    offset = 0
+    windows.reverse()
+    while windows:
+        window = windows.pop()  # Free each int16 window as soon as it's converted
+        audio[offset:offset + len(window)] = window
+        offset += len(window)
+    audio /= 32768.0
+    return audio
+
+# Parallel Transcription Module
+# Long audio is cut at the quietest spot near every N minutes and the chunks are transcribed in
+# forked processes. Children inherit the decoded audio and the resident model copy-on-write.
+transcribe_processes = int(os.getenv('TRANSCRIBE_PROCESSES', '1'))
+transcribe_chunk_minutes = float(os.getenv('TRANSCRIBE_CHUNK_MINUTES', '10'))
+transcribe_stream_chunk_seconds = float(os.getenv('TRANSCRIBE_STREAM_CHUNK_SECONDS', '60'))  # Single-process chunks when segments are streamed
+silence_search_seconds = 15  # How far around each target boundary to look for silence
+silence_frame_seconds = 0.05
+
+_pool_audio = None  # Set only while a pool is running, read by the forked children
+
+def find_split_points(audio, chunk_seconds, search_seconds=silence_search_seconds):
+    chunk_samples = int(chunk_seconds * sample_rate)
+    search_samples = int(search_seconds * sample_rate)
+    frame_samples = int(silence_frame_seconds * sample_rate)
+    split_points = []
+    last_split = 0
+    while last_split + chunk_samples < len(audio):
+        window_start = max(last_split + frame_samples, last_split + chunk_samples - search_samples)
+        frame_count = (min(len(audio), last_split + chunk_samples + search_samples) - window_start) // frame_samples
+        if frame_count <= 0:
+            break
+        frames = audio[window_start:window_start + frame_count * frame_samples].reshape(frame_count, frame_samples)
+        quietest_frame = int(np.argmin(np.mean(np.square(frames), axis=1)))
+        last_split = window_start + quietest_frame * frame_samples + frame_samples // 2
+        split_points.append(last_split)
+    return split_points
+
+def split_audio(audio, chunk_seconds):
+    bounds = [0] + find_split_points(audio, chunk_seconds) + [len(audio)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def merge_chunk_segments(chunk_segments, chunk_bounds):
+    merged = []
+    for segments, (start, end) in zip(chunk_segments, chunk_bounds):
+        offset = start / sample_rate
+        duration = (end - start) / sample_rate
+        for entry in segments:
+            # Whisper can place a final timestamp past the end of its input, keep it inside the chunk
+            merged.append({
+                'start': offset + min(entry['start'], duration),
+                'end': offset + min(entry['end'], duration),
+                'text': entry['text']
+            })
+    return merged
+
+def _init_transcribe_process(threads):
+    torch.set_num_threads(threads)
+
+def _transcribe_chunk(model_size, start, end, language):
+    result = model_registry.get(model_size).transcribe(_pool_audio[start:end], language=language)
+    return [{'start': entry['start'], 'end': entry['end'], 'text': entry['text']} for entry in result['segments']]
+
+def transcribe_chunks(audio, model_size, processes, chunk_seconds, on_segments=None):
+    global _pool_audio
+    chunk_bounds = split_audio(audio, chunk_seconds)
+    processes = min(processes, len(chunk_bounds))
+    threads = max(1, torch.get_num_threads() // processes)  # Share what the worker was given, not the whole node
+
+    # Make sure the children fork with a warm model. The language is detected once, so no chunk can switch it.
+    language = spoken_language(model_registry.get(model_size), audio)
+    _pool_audio = audio
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_init_transcribe_process, initargs=(threads,)) as pool:
+            futures = [pool.submit(_transcribe_chunk, model_size, start, end, language) for start, end in chunk_bounds]
+            chunk_segments = []
+            for future, bounds in zip(futures, chunk_bounds):
+                chunk_segments.append(future.result())  # In order, so streamed segments never go back in time
+                if on_segments is not None:
+                    on_segments(merge_chunk_segments(chunk_segments[-1:], [bounds]), bounds[1] / len(audio))
+    finally:
+        _pool_audio = None
+    return merge_chunk_segments(chunk_segments, chunk_bounds)
+
+def transcribe_sequential_chunks(audio, model_size, chunk_seconds, on_segments):
+    model = model_registry.get(model_size)
+    segments = []
+    previous_text = None
+    language = None
+    for start, end in split_audio(audio, chunk_seconds):
+        result = model.transcribe(audio[start:end], initial_prompt=previous_text, language=language)
+        chunk = merge_chunk_segments([result['segments']], [(start, end)])
+        segments.extend(chunk)
+        previous_text = result['text'][-500:] or None  # Carry context over the cut, like Whisper does between its own windows
+        language = language or result.get('language')  # Detected once on the first chunk, a quiet or noisy cut can't flip it
+        on_segments(chunk, end / len(audio))
+    return segments
+
 # Transcription Module
-def transcribe_audio(converted_audio_filename, keywords):
-    model = whisper.load_model("small")  # Choose the model size
-    result = model.transcribe(converted_audio_filename)
-    transcript = result["text"]
-    transcript_sentences = result["segments"] # Transcript with all available parameters per sentence
-    transcript_timestamped = [{'start': int(entry['start']), 'end': int(entry['end']), 'text': entry['text'].strip()} for entry in transcript_sentences]
+def timestamp_segments(transcript_sentences):
+    return [{'start': int(entry['start']), 'end': int(entry['end']), 'text': entry['text'].strip()} for entry in transcript_sentences]
+
+# Accepts a file path or a 16 kHz mono float32 array from decode_audio.
+# on_segments(transcript_timestamped, progress) is called as soon as each part is transcribed.
+def transcribe_audio(audio, keywords, model_size=None, processes=None, on_segments=None):
+    model_size = model_size or default_model_size
+    processes = processes or transcribe_processes
+    chunk_seconds = transcribe_chunk_minutes * 60
+    is_array = isinstance(audio, np.ndarray)
+    report_segments = (lambda entries, progress: on_segments(timestamp_segments(entries), progress)) if on_segments else None
+
+    if processes > 1 and is_array and len(audio) > chunk_seconds * sample_rate:
+        transcript_sentences = transcribe_chunks(audio, model_size, processes, chunk_seconds, report_segments)
+        transcript = ''.join(entry['text'] for entry in transcript_sentences)
+    elif report_segments and is_array and len(audio) > transcribe_stream_chunk_seconds * sample_rate:
+        transcript_sentences = transcribe_sequential_chunks(audio, model_size, transcribe_stream_chunk_seconds, report_segments)
+        transcript = ''.join(entry['text'] for entry in transcript_sentences)
+    else:
+        model = model_registry.get(model_size)  # Resident model, loaded once per worker
+        result = model.transcribe(audio)
+        transcript = result["text"]
+        transcript_sentences = result["segments"] # Transcript with all available parameters per sentence
+        if report_segments:
+            report_segments(transcript_sentences, 1.0)
+    transcript_timestamped = timestamp_segments(transcript_sentences)
     transcript_filtered = filter_sentences_with_context(transcript_timestamped, keywords)
     return transcript, transcript_timestamped, transcript_filtered
 
+# Streaming Transcription Module
+# A reader thread queues decoded windows while chunks are transcribed, so download and decoding keep
+# going during transcription. The queue is bounded: a slow transcriber stalls decoding and, through the
+# pipes, the download, instead of buffering the whole video.
+streaming_ingest = os.getenv('STREAMING_INGEST', '0') == '1'
+stream_queue_windows = int(os.getenv('STREAM_QUEUE_WINDOWS', '8'))  # 8 x 30 s of int16 audio is ~7.5 MB
+
+def _queue_windows(windows, buffered, stop):
+    try:
+        for window in windows:
+            while not stop.is_set():
+                try:
+                    buffered.put(window, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                break
+        buffered.put(None)
+    except Exception as e:
+        buffered.put(e)
+    finally:
+        if hasattr(windows, 'close'):
+            windows.close()  # Kills ffmpeg if the transcriber gave up early
+
+# Transcribes int16 windows from stream_pcm as they arrive, cutting chunks at quiet points like transcribe_chunks.
+# Returns (transcript, transcript_timestamped, audio_seconds). on_segments gets timestamped segments and
+# the progress against total_seconds, when the length is known up front.
+def transcribe_stream(windows, model_size=None, chunk_seconds=None, on_segments=None, total_seconds=None):
+    model = model_registry.get(model_size or default_model_size)
+    chunk_seconds = chunk_seconds or transcribe_stream_chunk_seconds
+    fill_samples = int((chunk_seconds + silence_search_seconds) * sample_rate)  # Enough to look for a quiet cut
+    buffered = queue.Queue(maxsize=stream_queue_windows)
+    stop = threading.Event()
+    threading.Thread(target=_queue_windows, args=(windows, buffered, stop), daemon=True).start()
+
+    buffer = np.empty(0, dtype=np.float32)
+    offset = 0
+    segments = []
+    previous_text = None
+    language = None
+    done = False
+    try:
+        while not done or len(buffer):
+            while not done and len(buffer) < fill_samples:
+                item = buffered.get()
+                if item is None:
+                    done = True
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    buffer = np.concatenate([buffer, item.astype(np.float32) / 32768.0])
+            split_points = find_split_points(buffer, chunk_seconds)
+            cut = split_points[0] if split_points else len(buffer)
+            chunk, buffer = buffer[:cut], buffer[cut:]
+
+            result = model.transcribe(chunk, initial_prompt=previous_text, language=language)
+            chunk_segments = merge_chunk_segments([result['segments']], [(offset, offset + cut)])
+            segments.extend(chunk_segments)
+            previous_text = result['text'][-500:] or None
+            language = language or result.get('language')
+            offset += cut
+            if on_segments is not None:
+                progress = 1.0 if done and not len(buffer) else min(0.99, offset / sample_rate / total_seconds) if total_seconds else 0.0
+                on_segments(timestamp_segments(chunk_segments), progress)
+    finally:
+        stop.set()
+    transcript = ''.join(entry['text'] for entry in segments)
+    return transcript, timestamp_segments(segments), offset / sample_rate
+
 # Sentiment Analysis Module
+# One analyzer per process, VADER reads its lexicon only once. Very long batches are split across
+# forked processes, which inherit the loaded analyzer.
+sentiment_processes = int(os.getenv('SENTIMENT_PROCESSES', '1'))
+sentiment_pool_min_texts = 5000  # Below this a pool costs more than it saves
+sentiment_bucket_seconds = int(os.getenv('SENTIMENT_BUCKET_SECONDS', '60'))
+
+_sentiment_analyzer = None
+
+def sentiment_analyzer():
+    global _sentiment_analyzer
+    if _sentiment_analyzer is None:
+        _sentiment_analyzer = SentimentIntensityAnalyzer()
+    return _sentiment_analyzer
+
+def _score_texts(texts):
+    analyzer = sentiment_analyzer()
+    return [analyzer.polarity_scores(text) for text in texts]
+
+def score_sentiments(texts, processes=None):
+    processes = processes or sentiment_processes
+    if processes > 1 and len(texts) >= sentiment_pool_min_texts:
+        sentiment_analyzer()  # Load before forking so the children share it
+        batch_size = -(-len(texts) // processes)
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+            return [scores for batch in pool.map(_score_texts, batches) for scores in batch]
+    return _score_texts(texts)
+
 def analyze_sentiments(filtered_sentences):
-    analyzer = SentimentIntensityAnalyzer()
+    scores = score_sentiments([sentence['text'] for sentence in filtered_sentences])
     sentiment_results = []
-    for sentence in filtered_sentences:
-        sentiment = analyzer.polarity_scores(sentence['text'])
-        sentiment_results.append({'text': sentence['text'], 'sentiment': sentiment})
+    for sentence, sentiment in zip(filtered_sentences, scores):
+        result = {'text': sentence['text'], 'sentiment': sentiment}
+        result.update({key: sentence[key] for key in ('start', 'end', 'keywords') if key in sentence})
+        sentiment_results.append(result)
     return sentiment_results
 
+def _aggregate_compounds(groups, compounds, group_count):
+    counts = np.bincount(groups, minlength=group_count)
+    means = np.bincount(groups, weights=compounds, minlength=group_count) / np.maximum(counts, 1)
+    minimums = np.full(group_count, np.inf)
+    maximums = np.full(group_count, -np.inf)
+    np.minimum.at(minimums, groups, compounds)
+    np.maximum.at(maximums, groups, compounds)
+    return counts, means, minimums, maximums
+
+# Per-keyword compound statistics over the filtered chunks, and mean compound over time from all segments
+def aggregate_sentiments(transcript_timestamped, segment_scores, sentiment_results=None, bucket_seconds=None):
+    bucket_seconds = bucket_seconds or sentiment_bucket_seconds
+    aggregates = {'keywords': {}, 'timeline': []}
+
+    if transcript_timestamped:
+        starts = np.array([segment['start'] for segment in transcript_timestamped])
+        compounds = np.array([scores['compound'] for scores in segment_scores])
+        buckets = (starts // bucket_seconds).astype(np.int64)
+        counts, means, minimums, maximums = _aggregate_compounds(buckets, compounds, int(buckets.max()) + 1)
+        for bucket in np.flatnonzero(counts):
+            aggregates['timeline'].append({
+                'start': int(bucket * bucket_seconds),
+                'end': int((bucket + 1) * bucket_seconds),
+                'segments': int(counts[bucket]),
+                'compound_mean': round(float(means[bucket]), 4),
+                'compound_min': float(minimums[bucket]),
+                'compound_max': float(maximums[bucket])
+            })
+
+    pairs = [(keyword, result['sentiment']['compound']) for result in sentiment_results or [] for keyword in result.get('keywords', [])]
+    if pairs:
+        keywords = list(dict.fromkeys(keyword for keyword, _ in pairs))
+        index = {keyword: i for i, keyword in enumerate(keywords)}
+        groups = np.array([index[keyword] for keyword, _ in pairs])
+        counts, means, minimums, maximums = _aggregate_compounds(groups, np.array([compound for _, compound in pairs]), len(keywords))
+        for i, keyword in enumerate(keywords):
+            aggregates['keywords'][keyword] = {
+                'chunks': int(counts[i]),
+                'compound_mean': round(float(means[i]), 4),
+                'compound_min': float(minimums[i]),
+                'compound_max': float(maximums[i])
+            }
+
+    return aggregates
+
 # Summarization Module
-def summariza_batonga(text, length, keywords, kw_analysis_length):
-    load_dotenv()
-    openai_api_key = os.getenv('OPENAI_API_KEY')
-    client = OpenAI(api_key=openai_api_key)
+summary_model = "gpt-3.5-turbo-1106"
+
+summary_reply_tokens = 500  # Counted against the token budget for replies without a max_tokens cap
+
+# One client per process, so its connections stay open between requests and the threads of a job share them.
+# Built again in a forked work-horse, which can't use the parent's sockets, and when the settings change.
+_openai_client = None
+_openai_client_key = None
+_openai_client_lock = threading.Lock()
+
+def openai_client():
+    global _openai_client, _openai_client_key
+    with _openai_client_lock:
+        if _openai_client_key is None:
+            load_dotenv()
+        key = (os.getpid(), os.getenv('OPENAI_API_KEY'), os.getenv('OPENAI_BASE_URL'))
+        if key != _openai_client_key:
+            _openai_client = OpenAI(api_key=key[1], max_retries=0)  # Retries go through chat_completion and the shared limiter
+            _openai_client_key = key
+        return _openai_client
 
+# Sends one chat completion through the cluster-wide rate limiter. Rate limits, server errors and dropped
+# connections are retried after the wait the API asked for, or a jittered backoff.
+def chat_completion(messages, max_tokens=None):
+    tokens = sum(count_tokens(message['content']) for message in messages) + (max_tokens or summary_reply_tokens)
+    options = {'max_tokens': max_tokens} if max_tokens else {}
+    for attempt in itertools.count():
+        rate_limit.acquire(tokens)
+        try:
+            response = openai_client().chat.completions.create(model=summary_model, messages=messages, **options)
+            return response.choices[0].message.content
+        except (openai.APIConnectionError, openai.APIStatusError) as e:
+            status = getattr(e, 'status_code', None)
+            if attempt >= rate_limit.openai_max_retries or status not in (None, 408, 409, 429) and status < 500:
+                raise
+            delay = rate_limit.retry_delay(e.response.headers if status is not None else None, attempt)
+            if status == 429:
+                rate_limit.pause(delay)  # Every worker waits it out, not just this one
+            inc('av_openai_retries_total', reason=status or 'connection')
+            time.sleep(delay)
+
+def summary_messages(text, length, keywords, kw_analysis_length, source="video transcript"):
+    prompt = f"Summarize the following {source} in a strict length of {length} sentences: {text}. In the summary, avoid specifying the speaker's identity and use gender-neutral pronouns like 'they' or 'them'."
     if keywords:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",
-            messages=[
-                {"role": "system", "content": "You are a helpful video transcriber tool."},
-                {"role": "user", "content": f"Summarize the following video transcript in a strict length of {length} sentences: {text}. In the summary, avoid specifying the speaker's identity and use gender-neutral pronouns like 'they' or 'them'. After the summary, analyze how the following keywords are discussed in the video: {keywords}. Provide a separate analysis for each keyword, limited to {kw_analysis_length} sentences per keyword. Ensure there is a break between the analysis of different keywords."}
-            ]
-        )
-    else:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",
-            messages=[
-                {"role": "system", "content": "You are a helpful video transcriber tool."},
-                {"role": "user", "content": f"Summarize the following video transcript in a strict length of {length} sentences: {text}. In the summary, avoid specifying the speaker's identity and use gender-neutral pronouns like 'they' or 'them'."}
-            ]
-        )
-
-    return response.choices[0].message.content
\ No newline at end of file
+        prompt += f" After the summary, analyze how the following keywords are discussed in the video: {keywords}. Provide a separate analysis for each keyword, limited to {kw_analysis_length} sentences per keyword. Ensure there is a break between the analysis of different keywords."
+    return [
+        {"role": "system", "content": "You are a helpful video transcriber tool."},
+        {"role": "user", "content": prompt}
+    ]
+
+def summariza_batonga(text, length, keywords, kw_analysis_length, source="video transcript"):
+    return chat_completion(summary_messages(text, length, keywords, kw_analysis_length, source))
+
+# Long Transcript Summarization Module
+# Transcripts over the token budget are split on sentence boundaries, each part is summarized
+# concurrently (map) and the part summaries are summarized again until they fit (reduce).
+summary_chunk_tokens = int(os.getenv('SUMMARY_CHUNK_TOKENS', '12000'))
+summary_concurrency = int(os.getenv('SUMMARY_CONCURRENCY', '4'))
+summary_part_tokens = 600  # Output cap per part summary, keeps the reduce input small
+summary_reduce_depth = 3  # Reduce rounds before the part summaries are cut to fit instead
+
+_token_encoding = None
+
+def token_encoding():
+    global _token_encoding
+    if _token_encoding is None:
+        _token_encoding = get_encoding('gpt2')  # Bundled with whisper, no download, counts a bit high for gpt-3.5
+    return _token_encoding
+
+def count_tokens(text):
+    return len(token_encoding().encode(text))
+
+# Token counts of many texts, without the special token check encode is ~7x slower
+def count_tokens_ordinary(texts):
+    encoding = token_encoding()
+    return [len(encoding.encode_ordinary(text)) for text in texts]
+
+# The first max_tokens tokens of text
+def truncate_tokens(text, max_tokens):
+    tokens = token_encoding().encode(text)
+    return text if len(tokens) <= max_tokens else token_encoding().decode(tokens[:max_tokens])
+
+def chunk_transcript(text, max_tokens):
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for sentence in re.split(r'(?<=[.!?])\s+', text.strip()):
+        sentence_tokens = count_tokens(sentence)
+        if sentence_tokens > max_tokens:
+            # A run-on "sentence" gets cut on token boundaries instead
+            tokens = token_encoding().encode(sentence)
+            pieces = [token_encoding().decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+        else:
+            pieces = [sentence]
+        for piece in pieces:
+            piece_tokens = min(sentence_tokens, max_tokens)
+            if chunk and chunk_tokens + piece_tokens > max_tokens:
+                chunks.append(' '.join(chunk))
+                chunk = []
+                chunk_tokens = 0
+            chunk.append(piece)
+            chunk_tokens += piece_tokens
+    if chunk:
+        chunks.append(' '.join(chunk))
+    return chunks
+
+def summarize_transcript_part(text, keywords):
+    prompt = f"Summarize the following part of a longer video transcript in detail, keeping the order in which things are said: {text}. Avoid specifying the speaker's identity and use gender-neutral pronouns like 'they' or 'them'."
+    if keywords:
+        prompt += f" Keep everything that is said about the following keywords: {keywords}."
+    messages = [
+        {"role": "system", "content": "You are a helpful video transcriber tool."},
+        {"role": "user", "content": prompt}
+    ]
+    return chat_completion(messages, max_tokens=summary_part_tokens)
+
+def summarize_transcript(text, length, keywords, kw_analysis_length, source="video transcript", backend=None, depth=0):
+    summarizer = get_summarizer(backend)
+    text_tokens = count_tokens(text)
+    if text_tokens <= summarizer.max_input_tokens:
+        return summarizer.summarize(text, length, keywords, kw_analysis_length, source)
+
+    chunks = chunk_transcript(text, summarizer.max_input_tokens)
+    part_summaries = summarizer.summarize_parts(chunks, keywords)
+    combined = '\n\n'.join(part_summaries)
+    source = "summaries of consecutive parts of a video transcript"
+    shrinking = count_tokens(combined) < text_tokens
+    if not shrinking or depth + 1 >= summary_reduce_depth:
+        # Not shrinking (part summaries as long as the parts) or too many rounds: every part keeps an equal share
+        inc('av_summary_truncations_total', backend=summarizer.name, reason='depth' if shrinking else 'not_shrinking')
+        share = max(1, (summarizer.max_input_tokens - 2 * len(part_summaries)) // len(part_summaries))
+        combined = '\n\n'.join(truncate_tokens(summary, share) for summary in part_summaries)
+        return summarizer.summarize(truncate_tokens(combined, summarizer.max_input_tokens), length, keywords, kw_analysis_length, source)
+    return summarize_transcript(combined, length, keywords, kw_analysis_length, source=source, backend=backend, depth=depth + 1)
+
+# Extractive Pre-compression Module
+# With SUMMARY_EXTRACT_TOKENS set, transcripts longer than that reach the summarizer as their most central
+# segments only: TextRank over the TF-IDF cosine similarity of the segments, with segments that mention a
+# requested keyword weighted up both in the random jumps and in the final ranking. The similarity matrix is
+# never built, each power iteration goes through the sparse term matrix twice, so it's linear in the words.
+summary_extract_tokens = int(os.getenv('SUMMARY_EXTRACT_TOKENS', '0'))  # 0 summarizes the whole transcript
+extract_keyword_boost = float(os.getenv('SUMMARY_EXTRACT_KEYWORD_BOOST', '3'))
+textrank_damping = 0.85
+textrank_iterations = 100
+textrank_tolerance = 1e-6
+
+# Nonzero entries (rows, columns, weights) of the row-normalized TF-IDF matrix, and the vocabulary size
+def term_matrix(texts):
+    vocabulary = {}
+    rows, columns = [], []
+    for row, text in enumerate(texts):
+        for token in re.findall(r'\w+', text.casefold()):
+            rows.append(row)
+            columns.append(vocabulary.setdefault(token, len(vocabulary)))
+    size = max(len(vocabulary), 1)
+    cells, counts = np.unique(np.array(rows, dtype=np.int64) * size + np.array(columns, dtype=np.int64), return_counts=True)
+    rows, columns = cells // size, cells % size
+    document_frequency = np.bincount(columns, minlength=size)
+    weights = (1 + np.log(counts)) * np.log(len(texts) / np.maximum(document_frequency[columns], 1))
+    norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=len(texts)))
+    return rows, columns, weights / np.maximum(norms[rows], 1e-12), size
+
+# PageRank over the segment similarity graph, teleporting in proportion to personalization
+def textrank(texts, personalization=None):
+    count = len(texts)
+    rows, columns, weights, size = term_matrix(texts)
+    self_similarity = np.bincount(rows, weights=weights ** 2, minlength=count)
+
+    def similarity(vector):  # (X X^T - I) vector: every segment's cosine similarity to the others, weighted by vector
+        projected = np.bincount(columns, weights=weights * vector[rows], minlength=size)
+        return np.bincount(rows, weights=weights * projected[columns], minlength=count) - self_similarity * vector
+
+    teleport = np.ones(count) if personalization is None else np.asarray(personalization, dtype=np.float64)
+    teleport = teleport / teleport.sum()
+    degree = similarity(np.ones(count))
+    connected = degree > 1e-12
+    ranks = teleport.copy()
+    for _ in range(textrank_iterations):
+        spread = np.where(connected, ranks / np.where(connected, degree, 1), 0)
+        dangling = ranks[~connected].sum()  # Segments that share no words with any other jump like everyone else
+        updated = (1 - textrank_damping) * teleport + textrank_damping * (similarity(spread) + dangling * teleport)
+        converged = np.abs(updated - ranks).sum() < textrank_tolerance
+        ranks = updated
+        if converged:
+            break
+    return ranks
+
+# Indices of the highest ranked segments that fit in max_tokens, in their original order
+def extract_segments(transcript_timestamped, max_tokens, matcher=None):
+    texts = [segment['text'] for segment in transcript_timestamped]
+    weights = np.array([1 + extract_keyword_boost * bool(matcher and matcher.find(text)) for text in texts])
+    scores = textrank(texts, weights) * weights
+    tokens = [count + 1 for count in count_tokens_ordinary(texts)]  # Plus a separator
+    chosen = []
+    budget = max_tokens
+    for index in np.argsort(-scores, kind='stable'):
+        if tokens[index] <= budget:
+            chosen.append(index)
+            budget -= tokens[index]
+    return sorted(int(index) for index in chosen)
+
+# The key segments of a transcript over max_tokens, or None when it fits and goes to the summarizer whole.
+# Skipped stretches show up as "..." so the model doesn't read two excerpts as one sentence.
+excerpts_source = "key excerpts of a video transcript, in order"
+
+def compress_transcript(transcript, transcript_timestamped, matcher=None, max_tokens=None):
+    max_tokens = summary_extract_tokens if max_tokens is None else max_tokens
+    if not max_tokens or not transcript_timestamped or count_tokens(transcript) <= max_tokens:
+        return None
+    chosen = extract_segments(transcript_timestamped, max_tokens, matcher)
+    if not chosen:
+        return None  # Every segment is over the budget on its own, the plain path still chunks them
+    parts = []
+    previous = None
+    for index in chosen:
+        if previous is not None and index != previous + 1:
+            parts.append('...')
+        parts.append(transcript_timestamped[index]['text'].strip())
+        previous = index
+    return ' '.join(parts)
+
+# Summarization Backends
+# "openai" sends everything to the chat completions API, "bart" runs the checkpoint from
+# finetune_model.py on the CPU. SUMMARY_BACKEND is the deployment default, SUMMARY_BACKENDS
+# lists what requests may ask for.
+summary_backend = os.getenv('SUMMARY_BACKEND', 'openai')
+summary_backends = [name.strip() for name in os.getenv('SUMMARY_BACKENDS', summary_backend).split(',') if name.strip()]
+
+class OpenAISummarizer:
+    name = 'openai'
+
+    @property
+    def max_input_tokens(self):
+        return summary_chunk_tokens
+
+    def summarize(self, text, length, keywords, kw_analysis_length, source):
+        return summariza_batonga(text, length, keywords, kw_analysis_length, source)
+
+    def summarize_parts(self, chunks, keywords):
+        with ThreadPoolExecutor(max_workers=summary_concurrency) as pool:
+            return list(pool.map(summarize_transcript_part, chunks, [keywords] * len(chunks)))
+
+class BartSummarizer:
+    name = 'bart'
+    max_input_tokens = 1000  # BART reads 1024 tokens, with room for the special tokens. Same BPE as count_tokens.
+
+    def summarize(self, text, length, keywords, kw_analysis_length, source):
+        # BART can't follow instructions, so the keyword analysis is a summary of the sentences that mention each keyword
+        matcher = KeywordMatcher(keywords) if keywords else None
+        sentences = re.split(r'(?<=[.!?])\s+', text.strip())
+        contexts = {}
+        if matcher is not None:
+            for sentence in sentences:
+                for keyword in matcher.find(sentence):
+                    contexts.setdefault(keyword, []).append(sentence)
+
+        keyword_list = list(contexts)
+        summaries = bart_summarize([text] + [' '.join(contexts[keyword]) for keyword in keyword_list])  # One batch for all of them
+        summary = first_sentences(summaries[0], length)
+        if matcher is None:
+            return summary
+        analyses = dict(zip(keyword_list, summaries[1:]))
+        lines = [f"{keyword}: {first_sentences(analyses[keyword], kw_analysis_length)}" if keyword in analyses
+                 else f"{keyword}: The keyword is not discussed in the video."
+                 for keyword in matcher.keywords.values()]
+        return summary + '\n\n' + '\n\n'.join(lines)
+
+    def summarize_parts(self, chunks, keywords):
+        return bart_summarize(chunks)
+
+summarizers = {'openai': OpenAISummarizer(), 'bart': BartSummarizer()}
+
+def get_summarizer(backend=None):
+    backend = backend or summary_backend
+    if backend not in summarizers:
+        raise ValueError(f"Unknown summary backend: {backend}")
+    return summarizers[backend]
+
+def first_sentences(text, count):
+    return ' '.join(re.split(r'(?<=[.!?])\s+', text.strip())[:int(count)])
+
+# Local Summarization Module (BART)
+# The checkpoint is loaded once, quantized to int8 for CPU inference if asked, and fed in length-sorted
+# batches. With BART_SERVER=1 jobs don't load it at all: they push their texts to a Redis list and one
+# summary server process per worker host batches texts from every job it finds there together.
+bart_checkpoint = os.getenv('BART_CHECKPOINT', 'facebook/bart-large-cnn')  # e.g. ./results/checkpoint-1000 from finetune_model.py
+bart_quantize = os.getenv('BART_QUANTIZE', '1') == '1'
+bart_batch_size = int(os.getenv('BART_BATCH_SIZE', '8'))
+bart_batch_wait_ms = int(os.getenv('BART_BATCH_WAIT_MS', '50'))  # How long the server waits for more texts to fill a batch
+bart_num_beams = int(os.getenv('BART_NUM_BEAMS', '4'))
+bart_summary_tokens = 142  # Same target length finetune_model.py trains on
+bart_server = os.getenv('BART_SERVER', '1') == '1'
+bart_server_timeout = int(os.getenv('BART_SERVER_TIMEOUT', '600'))
+bart_request_key = 'bart:requests'
+bart_reply_ttl = 300
+
+_bart = None
+
+def quantize_for_cpu(model):
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def bart_model():
+    global _bart
+    if _bart is None:
+        from transformers import BartTokenizer, BartForConditionalGeneration  # Only the BART backend needs transformers
+        tokenizer = BartTokenizer.from_pretrained(bart_checkpoint)
+        model = BartForConditionalGeneration.from_pretrained(bart_checkpoint).eval()
+        _bart = (tokenizer, quantize_for_cpu(model) if bart_quantize else model)
+    return _bart
+
+def bart_generate(texts, max_tokens=bart_summary_tokens):
+    tokenizer, model = bart_model()
+    # Similar lengths go together so the batches carry little padding
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    summaries = [None] * len(texts)
+    for start in range(0, len(order), bart_batch_size):
+        batch = order[start:start + bart_batch_size]
+        inputs = tokenizer([texts[i] for i in batch], max_length=1024, truncation=True, padding=True, return_tensors='pt')
+        with torch.inference_mode():
+            output = model.generate(**inputs, max_length=max_tokens, num_beams=bart_num_beams, early_stopping=True)
+        for i, summary in zip(batch, tokenizer.batch_decode(output, skip_special_tokens=True)):
+            summaries[i] = summary.strip()
+    return summaries
+
+def bart_summarize(texts):
+    if not bart_server:
+        return bart_generate(texts)
+    reply_key = f'bart:reply:{uuid4().hex}'
+    conn.rpush(bart_request_key, json.dumps({'reply': reply_key, 'texts': texts}))
+    reply = conn.blpop(reply_key, timeout=bart_server_timeout)
+    if reply is None:
+        raise RuntimeError("No summary server answered, is a worker running with SUMMARY_BACKENDS including bart?")
+    reply = json.loads(reply[1])
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+    return reply['summaries']
+
+# Answers whatever requests are queued, up to bart_batch_size texts, as one generate pass. Returns the text count.
+def serve_bart_batch(connection, block_seconds=5):
+    first = connection.blpop(bart_request_key, timeout=block_seconds)
+    if first is None:
+        return 0
+    requests = [json.loads(first[1])]
+    deadline = time.monotonic() + bart_batch_wait_ms / 1000
+    while sum(len(request['texts']) for request in requests) < bart_batch_size and time.monotonic() < deadline:
+        item = connection.lpop(bart_request_key)
+        if item is None:
+            time.sleep(0.005)
+            continue
+        requests.append(json.loads(item))
+
+    texts = [text for request in requests for text in request['texts']]
+    try:
+        summaries = bart_generate(texts)
+        replies = []
+        for request in requests:
+            replies.append({'summaries': summaries[:len(request['texts'])]})
+            summaries = summaries[len(request['texts']):]
+    except Exception as e:
+        replies = [{'error': f"The summary server failed: {e}"}] * len(requests)
+
+    pipe = connection.pipeline()
+    for request, reply in zip(requests, replies):
+        pipe.rpush(request['reply'], json.dumps(reply))
+        pipe.expire(request['reply'], bart_reply_ttl)
+    pipe.execute()
+    return len(texts)
+
+bart_server_retry_seconds = 1  # Pause after a failed batch, so a Redis outage isn't a busy loop
+
+def serve_bart_summaries(connection):
+    bart_model()
+    while True:
+        try:
+            serve_bart_batch(connection)
+        except Exception as e:
+            # A bad request or a Redis hiccup costs that batch only, the jobs waiting on it time out
+            print(f"Summary server batch failed: {e}")
+            time.sleep(bart_server_retry_seconds)
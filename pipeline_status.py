@@ -0,0 +1,64 @@
+from rq.job import Job, JobStatus
+from worker import conn
+from cache import result_key, unpack_json
+
+# Where a task stands, read from its stored summary or its pipeline jobs. Shared by the web app and by
+# the playlist sweep that runs next to the workers.
+
+def stage_job_ids(task_id):
+    return [f'{task_id}:download', f'{task_id}:transcribe']
+
+# Stage jobs in pipeline order, ending with the final job. Raises NoSuchJobError for unknown tasks.
+def fetch_pipeline(task_id):
+    final_job = Job.fetch(task_id, connection=conn)
+    stage_jobs = [job for job in Job.fetch_many(stage_job_ids(task_id), connection=conn) if job is not None]
+    return stage_jobs + [final_job]
+
+# Returns (state, status) for the whole pipeline, from the statuses the jobs were loaded with
+def pipeline_state(jobs):
+    for job in jobs:
+        if job.get_status(refresh=False) in (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED):
+            return 'FAILED', job.meta.get('status', 'unknown')
+    if jobs[-1].get_status(refresh=False) == JobStatus.FINISHED:
+        return 'SUCCESS', jobs[-1].meta.get('status', 'unknown')
+    # Report the latest stage that has said anything
+    status = next((job.meta['status'] for job in reversed(jobs) if 'status' in job.meta), 'Waiting for the server...')
+    return 'PENDING', status
+
+# Returns (body, status code) from a task's stored summary, or from its pipeline jobs while it has none
+def status_response(summary, jobs):
+    if summary is not None:
+        return {'state': 'SUCCESS', 'result': summary, 'status': 'task completed'}, 200
+    if not jobs:
+        return {'state': 'UNKNOWN', 'result': None, 'status': 'No task with this id, it may have expired.'}, 404
+    state, status = pipeline_state(jobs)
+    if state == 'SUCCESS':
+        return {'state': 'SUCCESS', 'result': jobs[-1].result, 'status': status}, 200
+    elif state == 'FAILED':
+        return {'state': 'FAILED', 'result': None, 'status': status}, 406
+    else:
+        return {'state': 'PENDING', 'result': None, 'status': status}, 202
+
+# Summaries and every stage job of every task in one round trip
+def fetch_statuses(task_ids):
+    pipe = conn.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.hget(result_key(task_id), 'summary')
+        for job_id in stage_job_ids(task_id) + [task_id]:
+            pipe.hgetall(Job.key_for(job_id))
+    replies = iter(pipe.execute())
+
+    statuses = {}
+    for task_id in task_ids:
+        summary = next(replies)
+        jobs = []
+        for job_id in stage_job_ids(task_id) + [task_id]:
+            data = next(replies)
+            if data:
+                job = Job(job_id, connection=conn)
+                job.restore(data)
+                jobs.append(job)
+        final_job_found = bool(jobs) and jobs[-1].id == task_id
+        body, status = status_response(unpack_json(summary) if summary is not None else None, jobs if final_job_found else [])
+        statuses[task_id] = dict(body, status_code=status)
+    return statuses
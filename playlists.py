@@ -0,0 +1,276 @@
+import itertools
+import json
+import os
+import time
+import redis
+from pytube import Playlist, Channel
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
+from worker import conn
+from cache import result_ttl, pack_json, unpack_json, get_result_summary, get_result_keywords
+from modules import summarize_transcript
+from pipeline_status import fetch_statuses
+
+# Playlist and channel analysis: every video becomes an ordinary task, held in Redis and released into the queues
+# a few at a time as earlier ones finish, so one playlist never has more than its concurrency in the queues.
+# The aggregate is folded in as each video finishes, only the summary of summaries waits for the last one.
+max_playlist_videos = int(os.getenv('MAX_PLAYLIST_VIDEOS', '200'))
+playlist_concurrency = int(os.getenv('PLAYLIST_CONCURRENCY', '2'))
+max_playlist_concurrency = int(os.getenv('MAX_PLAYLIST_CONCURRENCY', '8'))
+# Workers look over the unfinished playlists this often, for videos whose work-horse was killed before it could report
+playlist_sweep_seconds = int(os.getenv('PLAYLIST_SWEEP_SECONDS', '30'))
+active_batches_key = 'batches:active'
+
+def resolve_videos(url, max_videos=None):
+    source = Playlist(url) if 'list=' in url else Channel(url)
+    return list(itertools.islice(source.video_urls, max_videos or max_playlist_videos))
+
+def batch_key(batch_id, part=None):
+    return f'batch:{batch_id}' + (f':{part}' if part else '')
+
+def task_batches_key(task_id):
+    return f'task_batches:{task_id}'
+
+# children: [{'youtube_url', 'task_id', 'state'}] with state 'cached', 'attached' or 'held', held ones also carry the
+# 'job_id' to enqueue when a slot frees up. params are the summary settings for the summary of summaries.
+def register_batch(batch_id, children, concurrency, params, queue_name, pipeline):
+    videos = [{'youtube_url': child['youtube_url'], 'task_id': child['task_id']} for child in children]
+    keys = [batch_key(batch_id, part) for part in (None, 'pending', 'held', 'attached')]
+    pipeline.hset(keys[0], mapping={'videos': pack_json(videos), 'total': len(children), 'completed': 0, 'concurrency': concurrency,
+                                    'params': json.dumps(params), 'queue': queue_name, 'created_at': time.time()})
+    pipeline.sadd(keys[1], *{child['task_id'] for child in children})
+    held = [child['job_id'] for child in children if child['state'] == 'held']
+    if held:
+        pipeline.rpush(keys[2], *held)
+    attached = [child['task_id'] for child in children if child['state'] == 'attached']
+    if attached:
+        pipeline.sadd(keys[3], *attached)
+    for child in children:
+        pipeline.sadd(task_batches_key(child['task_id']), batch_id)
+        pipeline.expire(task_batches_key(child['task_id']), result_ttl)
+    for key in keys:
+        pipeline.expire(key, result_ttl)
+    pipeline.sadd(active_batches_key, batch_id)
+
+# Counts the videos that were already done, then fills the first slots
+def start_batch(batch_id, children, concurrency):
+    for child in children:
+        if child['state'] == 'cached':
+            complete_child(batch_id, child['task_id'])
+    dispatch_held(batch_id, concurrency)
+
+# Moves up to count held jobs into their queues
+def dispatch_held(batch_id, count):
+    for _ in range(count):
+        job_id = conn.lpop(batch_key(batch_id, 'held'))
+        if job_id is None:
+            return
+        try:
+            job = Job.fetch(job_id.decode(), connection=conn)
+        except NoSuchJobError:
+            continue  # Expired while it waited, the status poll counts it as failed
+        task_id = job.meta.get('task_id', job.id)
+        job.set_status(JobStatus.QUEUED)  # Held jobs are saved as deferred, enqueue_job leaves those alone
+        pipe = conn.pipeline()
+        Queue(job.origin, connection=conn).enqueue_job(job, pipeline=pipe)
+        for dependent in held_dependents(job):
+            Queue(dependent.origin, connection=conn).deferred_job_registry.add(dependent, pipeline=pipe)  # Admission counts them from now on
+        pipe.sadd(batch_key(batch_id, 'dispatched'), task_id)
+        pipe.expire(batch_key(batch_id, 'dispatched'), result_ttl)
+        pipe.execute()
+
+# The later stages of a held pipeline, which wait on its first job
+def held_dependents(job):
+    dependent_ids = [dependent_id.decode() for dependent_id in conn.smembers(job.dependents_key)]
+    dependents = [dependent for dependent in Job.fetch_many(dependent_ids, connection=conn) if dependent is not None]
+    return dependents + [later for dependent in dependents for later in held_dependents(dependent)]
+
+# Tasks the batch is waiting on that are in the queues, the ones a status poll checks
+def running_tasks(batch_id):
+    pipe = conn.pipeline()
+    pipe.sunion(batch_key(batch_id, 'dispatched'), batch_key(batch_id, 'attached'))
+    pipe.smembers(batch_key(batch_id, 'pending'))
+    running, pending = pipe.execute()
+    return sorted(task_id.decode() for task_id in running & pending)
+
+# Playlists still waiting on videos, the ones that expired meanwhile are dropped
+def active_batches():
+    batch_ids = [batch_id.decode() for batch_id in conn.smembers(active_batches_key)]
+    pipe = conn.pipeline()
+    for batch_id in batch_ids:
+        pipe.exists(batch_key(batch_id))
+    expired = [batch_id for batch_id, exists in zip(batch_ids, pipe.execute()) if not exists]
+    if expired:
+        conn.srem(active_batches_key, *expired)
+    return [batch_id for batch_id in batch_ids if batch_id not in expired]
+
+# Called by the worker that finishes or fails a task, and by status polls for tasks that died without saying so
+def notify_batches(task_id):
+    for batch_id in conn.smembers(task_batches_key(task_id)):
+        complete_child(batch_id.decode(), task_id)
+
+def complete_child(batch_id, task_id):
+    if not conn.srem(batch_key(batch_id, 'pending'), task_id):
+        return  # Already counted
+    fold_child(batch_id, task_id)
+    pipe = conn.pipeline()
+    pipe.srem(batch_key(batch_id, 'dispatched'), task_id)
+    pipe.hincrby(batch_key(batch_id), 'completed', 1)  # After the fold, so the last one sees every video in the aggregate
+    pipe.hget(batch_key(batch_id), 'total')
+    dispatched, completed, total = pipe.execute()
+    if dispatched:
+        dispatch_held(batch_id, 1)  # Its slot goes to the next video
+    if completed == int(total):
+        conn.srem(active_batches_key, batch_id)
+        finish_batch(batch_id)
+
+# Counts the videos whose worker died without reporting back, the others were counted as they finished.
+# RQ marks a killed work-horse's job failed, and a dead worker's jobs once another worker cleans its registries.
+def reconcile_batch(batch_id):
+    running = running_tasks(batch_id)
+    if running:
+        for task_id, entry in fetch_statuses(running).items():
+            if entry['state'] != 'PENDING':
+                complete_child(batch_id, task_id)
+
+def reconcile_batches():
+    for batch_id in active_batches():
+        reconcile_batch(batch_id)
+
+# Runs next to every worker, so playlists keep going whether or not anyone polls them
+def sweep_playlists():
+    while True:
+        try:
+            reconcile_batches()
+        except Exception as e:
+            print(f"Playlist sweep failed: {e}")
+        time.sleep(playlist_sweep_seconds)
+
+def empty_aggregate():
+    return {'succeeded': 0, 'failed': 0, 'tasks': {}, 'keywords': {}}
+
+# Adds one video's outcome to the running aggregate. Keyword statistics are kept as sums, so the order videos
+# finish in doesn't matter.
+def merge_result(aggregate, task_id, summary):
+    if summary is None:
+        aggregate['failed'] += 1
+        aggregate['tasks'][task_id] = 'FAILED'
+        return aggregate
+    aggregate['succeeded'] += 1
+    aggregate['tasks'][task_id] = 'SUCCESS'
+    for keyword, stats in summary['sentiment_summary']['keywords'].items():
+        total = aggregate['keywords'].setdefault(keyword, {'videos': 0, 'chunks': 0, 'compound_sum': 0.0,
+                                                           'compound_min': stats['compound_min'], 'compound_max': stats['compound_max']})
+        total['videos'] += 1
+        total['chunks'] += stats['chunks']
+        total['compound_sum'] += stats['compound_mean'] * stats['chunks']
+        total['compound_min'] = min(total['compound_min'], stats['compound_min'])
+        total['compound_max'] = max(total['compound_max'], stats['compound_max'])
+    return aggregate
+
+# The per-video summaries and keyword chunks go in hashes of their own, only the small statistics are rewritten per video
+def fold_child(batch_id, task_id):
+    summary = get_result_summary(task_id)
+    if summary is not None:
+        keywords = get_result_keywords(task_id)
+        pipe = conn.pipeline()
+        pipe.hset(batch_key(batch_id, 'summaries'), task_id, summary['summary'])
+        pipe.hset(batch_key(batch_id, 'hits'), task_id, pack_json((keywords or {}).get('sentiment_analysis') or []))
+        for part in ('summaries', 'hits'):
+            pipe.expire(batch_key(batch_id, part), result_ttl)
+        pipe.execute()
+
+    key = batch_key(batch_id, 'aggregate')
+    with conn.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                blob = pipe.get(key)
+                aggregate = merge_result(unpack_json(blob) if blob is not None else empty_aggregate(), task_id, summary)
+                pipe.multi()
+                pipe.set(key, pack_json(aggregate), ex=result_ttl)
+                pipe.execute()
+                return
+            except redis.WatchError:
+                continue  # Another video finished at the same time, merge into its version
+
+def finish_batch(batch_id):
+    Queue(conn.hget(batch_key(batch_id), 'queue').decode(), connection=conn).enqueue(summarize_batch, batch_id, result_ttl=result_ttl)
+
+# Summary of the video summaries in playlist order, runs as a job once every video is done
+def summarize_batch(batch_id):
+    batch = get_batch(batch_id)
+    if batch is None:
+        return None
+    params = batch['params']
+    by_task = {task_id.decode(): summary.decode() for task_id, summary in conn.hgetall(batch_key(batch_id, 'summaries')).items()}
+    summaries = [by_task[video['task_id']] for video in batch['videos'] if video['task_id'] in by_task]
+    if not summaries:
+        conn.hset(batch_key(batch_id), 'summary_error', 'No video in the playlist could be analyzed.')
+        return None
+    try:
+        summary = summarize_transcript('\n\n'.join(summaries), params['summary_sentences'], params['keywords'], params['keyword_analysis_sentences'],
+                                       source="summaries of the videos in a playlist", backend=params['summary_backend'])
+    except Exception as e:
+        conn.hset(batch_key(batch_id), 'summary_error', f"An error occurred while summarizing the playlist: {e}")
+        raise
+    conn.hset(batch_key(batch_id), 'summary', summary)
+    return summary
+
+def get_batch(batch_id):
+    pipe = conn.pipeline()
+    pipe.hgetall(batch_key(batch_id))
+    pipe.get(batch_key(batch_id, 'aggregate'))
+    pipe.llen(batch_key(batch_id, 'held'))
+    fields, aggregate, held = pipe.execute()
+    if not fields:
+        return None
+    return {
+        'batch_id': batch_id,
+        'videos': unpack_json(fields[b'videos']),
+        'total': int(fields[b'total']),
+        'completed': int(fields[b'completed']),
+        'concurrency': int(fields[b'concurrency']),
+        'params': json.loads(fields[b'params']),
+        'summary': fields[b'summary'].decode() if b'summary' in fields else None,
+        'summary_error': fields[b'summary_error'].decode() if b'summary_error' in fields else None,
+        'waiting': held,
+        'aggregate': unpack_json(aggregate) if aggregate is not None else empty_aggregate()
+    }
+
+# What /playlist_status returns: progress over the whole playlist and the aggregate so far
+def batch_status(batch):
+    aggregate = batch['aggregate']
+    if batch['completed'] < batch['total']:
+        state, status = 'PENDING', f"{batch['completed']} of {batch['total']} videos analyzed"
+    elif batch['summary'] is not None:
+        state, status = 'SUCCESS', 'playlist completed'
+    elif batch['summary_error'] is not None:
+        state, status = 'FAILED', batch['summary_error']
+    else:
+        state, status = 'PENDING', 'Summarizing the playlist...'
+    return {
+        'batch_id': batch['batch_id'],
+        'state': state,
+        'status': status,
+        'total': batch['total'],
+        'completed': batch['completed'],
+        'succeeded': aggregate['succeeded'],
+        'failed': aggregate['failed'],
+        'waiting': batch['waiting'],
+        'running': batch['total'] - batch['completed'] - batch['waiting'],
+        'progress': round(100 * batch['completed'] / batch['total'], 1),
+        'videos': [dict(video, state=aggregate['tasks'].get(video['task_id'], 'PENDING')) for video in batch['videos']],
+        'keywords': {keyword: {'videos': stats['videos'], 'chunks': stats['chunks'],
+                               'compound_mean': round(stats['compound_sum'] / max(stats['chunks'], 1), 4),
+                               'compound_min': stats['compound_min'], 'compound_max': stats['compound_max']}
+                     for keyword, stats in aggregate['keywords'].items()},
+        'summary': batch['summary']
+    }
+
+# Every keyword chunk of the playlist, in playlist order, each with the video it came from
+def batch_hits(batch):
+    blobs = conn.hmget(batch_key(batch['batch_id'], 'hits'), [video['task_id'] for video in batch['videos']])
+    return [dict(chunk, youtube_url=video['youtube_url'], task_id=video['task_id'])
+            for video, blob in zip(batch['videos'], blobs) if blob is not None for chunk in unpack_json(blob)]
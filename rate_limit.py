@@ -0,0 +1,112 @@
+import email.utils
+import os
+import random
+import re
+import time
+import redis
+from worker import conn
+from metrics import observe
+
+# Cluster-wide pacing for the chat completions API. Requests and tokens per minute are two token buckets in
+# one Redis hash that every worker takes from, so a wave of jobs reaching the summary together is spread out
+# instead of answered with 429s. Each bucket holds a minute's worth and refills continuously. A 429 pauses
+# every worker for as long as the API asked. Set the limits a little under the account's, 0 turns one off.
+openai_rpm = int(os.getenv('OPENAI_RPM', '3000'))
+openai_tpm = int(os.getenv('OPENAI_TPM', '150000'))
+openai_max_retries = int(os.getenv('OPENAI_MAX_RETRIES', '6'))
+backoff_base = 1  # Seconds, doubled per attempt when the API gives no hint
+backoff_cap = 60
+
+bucket_key = 'ratelimit:openai'
+pause_key = 'ratelimit:openai:paused'
+max_sleep = 1  # Longest nap between looks at the bucket, a pause or a config change may have happened since
+
+# Levels of both buckets after refilling since the last update
+def _levels(state, now):
+    elapsed = max(0.0, now - float(state.get(b'updated', now)))
+    levels = {}
+    for name, limit in (('requests', openai_rpm), ('tokens', openai_tpm)):
+        level = float(state[name.encode()]) if name.encode() in state else limit
+        levels[name] = min(limit, level + elapsed * limit / 60)
+    return levels
+
+# Takes one request and tokens from the buckets, waiting until both have enough. Returns the seconds waited.
+# A request over the whole token bucket goes through once the bucket is full, it could never fit otherwise.
+def acquire(tokens):
+    started = time.time()
+    if not openai_rpm and not openai_tpm:
+        return 0.0
+    try:
+        with conn.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(bucket_key, pause_key)
+                    paused_ms = pipe.pttl(pause_key)
+                    state = pipe.hgetall(bucket_key)
+                    now = time.time()
+                    levels = _levels(state, now)
+                    wait = max(paused_ms / 1000, 0)
+                    if openai_rpm:
+                        wait = max(wait, (1 - levels['requests']) * 60 / openai_rpm)
+                    if openai_tpm:
+                        wait = max(wait, (min(tokens, openai_tpm) - levels['tokens']) * 60 / openai_tpm)
+                    if wait > 0:
+                        pipe.reset()
+                        time.sleep(min(wait, max_sleep))
+                        continue
+                    pipe.multi()
+                    pipe.hset(bucket_key, mapping={'requests': levels['requests'] - 1, 'tokens': levels['tokens'] - min(tokens, openai_tpm),
+                                                   'updated': now})
+                    pipe.expire(bucket_key, 120)  # Full again after a minute anyway
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue  # Another worker took from the bucket first, look again
+    except redis.RedisError:
+        pass  # Best effort, a Redis hiccup shouldn't fail the summary
+    waited = time.time() - started
+    observe('av_openai_limiter_wait_seconds', waited)
+    return waited
+
+# Holds back every worker for the given seconds, extending a pause that's already running
+def pause(seconds):
+    try:
+        if conn.pttl(pause_key) < seconds * 1000:
+            conn.set(pause_key, 1, px=max(1, int(seconds * 1000)))
+    except redis.RedisError:
+        pass
+
+# "1s", "6m0s", "20ms", as in the x-ratelimit-reset-* headers
+def parse_duration(value):
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    return sum(float(amount) * units[unit] for amount, unit in parts) if parts else None
+
+# Seconds the API asked us to wait, or None
+def header_delay(headers):
+    if not headers:
+        return None
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(headers['retry-after']).timestamp() - time.time())  # The HTTP date form
+            except (TypeError, ValueError):
+                pass
+    resets = [parse_duration(headers[name]) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens') if name in headers]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+# What the API asked for plus up to 25% jitter, so the workers it paused don't all come back at once.
+# Without a hint, full jitter over an exponentially growing window.
+def retry_delay(headers, attempt):
+    delay = header_delay(headers)
+    if delay is not None:
+        return min(backoff_cap, delay * random.uniform(1, 1.25))
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
@@ -0,0 +1,181 @@
+import heapq
+import os
+import re
+import sqlite3
+import time
+import numpy as np
+from contextlib import closing
+from modules import KeywordMatcher, analyze_sentiments
+
+# Inverted index over every finished transcript: token -> video -> segment positions, in a local SQLite file.
+# Workers add each transcript as it's stored, /search reads it. WAL lets the web process read while a worker writes.
+search_index_path = os.getenv('SEARCH_INDEX_PATH', 'search_index.sqlite3')
+search_busy_timeout = 30  # Seconds a writer waits for another one to finish
+
+schema = '''
+CREATE TABLE IF NOT EXISTS videos (id INTEGER PRIMARY KEY, video_id TEXT UNIQUE NOT NULL, segment_count INTEGER NOT NULL, indexed_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS segments (video INTEGER NOT NULL, position INTEGER NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL,
+                                     text TEXT NOT NULL, PRIMARY KEY (video, position)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS postings (token TEXT NOT NULL, video INTEGER NOT NULL, segments INTEGER NOT NULL, positions BLOB NOT NULL,
+                                     PRIMARY KEY (token, video)) WITHOUT ROWID;
+'''
+
+_ready_paths = set()
+
+def connect(path=None):
+    path = path or search_index_path
+    connection = sqlite3.connect(path, timeout=search_busy_timeout)
+    if path not in _ready_paths:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(schema)
+        _ready_paths.add(path)
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+def tokenize(text):
+    return re.findall(r'\w+', text.casefold())
+
+def pack_positions(positions):
+    return np.asarray(positions, dtype='<u4').tobytes()
+
+def unpack_positions(blob):
+    return np.frombuffer(blob, dtype='<u4').astype(np.int64)
+
+# Postings are segment position * 1024 + word offset in the segment, so phrases are matched by adjacency
+# without reading any text
+word_slots = 1024
+
+def segment_postings(transcript_timestamped):
+    postings = {}
+    for position, segment in enumerate(transcript_timestamped):
+        for offset, token in enumerate(tokenize(segment['text'])):
+            postings.setdefault(token, []).append(position * word_slots + min(offset, word_slots - 1))
+    return postings
+
+def _delete_video(connection, video):
+    old_tokens = {token for (text,) in connection.execute('SELECT text FROM segments WHERE video = ?', (video,)) for token in tokenize(text)}
+    connection.executemany('DELETE FROM postings WHERE token = ? AND video = ?', [(token, video) for token in old_tokens])  # By key, no scan
+    connection.execute('DELETE FROM segments WHERE video = ?', (video,))
+
+# Adds or replaces one video, in a single transaction so searches never see half of it
+def index_transcript(video_id, transcript_timestamped, connection=None):
+    if connection is None:
+        with closing(connect()) as connection:
+            return index_transcript(video_id, transcript_timestamped, connection)
+    with connection:
+        row = connection.execute('SELECT id FROM videos WHERE video_id = ?', (video_id,)).fetchone()
+        if row is not None:
+            video = row[0]
+            _delete_video(connection, video)
+            connection.execute('UPDATE videos SET segment_count = ?, indexed_at = ? WHERE id = ?', (len(transcript_timestamped), time.time(), video))
+        else:
+            video = connection.execute('INSERT INTO videos (video_id, segment_count, indexed_at) VALUES (?, ?, ?)',
+                                       (video_id, len(transcript_timestamped), time.time())).lastrowid
+        connection.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?)',
+                               [(video, position, segment['start'], segment['end'], segment['text'])
+                                for position, segment in enumerate(transcript_timestamped)])
+        connection.executemany('INSERT INTO postings VALUES (?, ?, ?, ?)',
+                               [(token, video, len({slot // word_slots for slot in slots}), pack_positions(slots))
+                                for token, slots in segment_postings(transcript_timestamped).items()])
+
+# Segment counts and posting lists of the keyword's tokens, in phrase order, for the videos that have all of them
+def _keyword_postings(connection, keyword):
+    tokens = tokenize(keyword)
+    videos = None
+    for token in dict.fromkeys(tokens):
+        rows = {video: (segments, blob) for video, segments, blob in
+                connection.execute('SELECT video, segments, positions FROM postings WHERE token = ?', (token,))}
+        videos = {video: {token: row} for video, row in rows.items()} if videos is None else \
+                 {video: dict(found, **{token: rows[video]}) for video, found in videos.items() if video in rows}
+        if not videos:
+            return {}
+    return {video: [found[token] for token in tokens] for video, found in (videos or {}).items()}
+
+# Segment positions where the keyword's tokens follow each other, case and punctuation are checked against the text later
+def _candidate_positions(video, keyword_postings):
+    positions = set()
+    for postings in keyword_postings:
+        if video in postings:
+            rows = postings[video]
+            starts = unpack_positions(rows[0][1])
+            for distance, (_, blob) in enumerate(rows[1:], start=1):
+                starts = np.intersect1d(starts, unpack_positions(blob) - distance, assume_unique=True)
+            positions.update((starts // word_slots).tolist())
+    return positions
+
+# Same chunks as filter_sentences_with_context: runs of matching segments with one segment of context on each side
+def context_chunks(segments, hits):
+    chunks = []
+    positions = sorted(hits)
+    run = []
+    for position in positions + [None]:
+        if run and (position is None or position != run[-1] + 1):
+            before = segments.get(run[0] - 1)
+            after = segments.get(run[-1] + 1)
+            parts = ([before] if before else []) + [segments[p] for p in run] + ([after] if after else [])
+            keywords = []
+            for p in run:
+                keywords.extend(keyword for keyword in hits[p] if keyword not in keywords)
+            chunks.append({'text': '... ' + ' '.join(part['text'] for part in parts) + ' ...', 'start': parts[0]['start'],
+                           'end': parts[-1]['end'], 'keywords': keywords})
+            run = []
+        if position is not None:
+            run.append(position)
+    return chunks
+
+# Returns [{'video_id', 'transcript_filtered', 'sentiment_analysis'}], videos with the most matching segments first.
+# Matches whole words, the index has no way to find "art" inside "start".
+def search(keywords, case_sensitive=False, sentiment=False, limit=20, path=None):
+    matcher = KeywordMatcher(keywords, whole_words=True, case_sensitive=case_sensitive)
+    if not matcher.keywords:
+        return []
+    with closing(connect(path)) as connection:
+        keyword_postings = [_keyword_postings(connection, keyword) for keyword in matcher.keywords.values()]
+
+        # Best-first over upper bounds on each video's matching segments: the fewest segments any token is in, then
+        # the segments where the tokens are adjacent, then the verified matches. Only the videos that can still make the top `limit`
+        # get their postings unpacked and their segments read, so a common word costs about as much as a rare one.
+        bounds = {}
+        for postings in keyword_postings:
+            for video, rows in postings.items():
+                bounds[video] = bounds.get(video, 0) + min(segments for segments, _ in rows)
+        heap = [(-bound, video, 0, None) for video, bound in bounds.items()]
+        heapq.heapify(heap)
+        results = []
+        while heap and len(results) < limit:
+            _, video, stage, data = heapq.heappop(heap)
+            if stage == 0:
+                positions = _candidate_positions(video, keyword_postings)
+                if positions:
+                    heapq.heappush(heap, (-len(positions), video, 1, positions))
+            elif stage == 1:
+                wanted = {p + offset for p in data for offset in (-1, 0, 1)}
+                rows = connection.execute('SELECT position, start, end, text FROM segments WHERE video = ? AND position BETWEEN ? AND ?',
+                                          (video, min(wanted), max(wanted)))  # One range scan beats a lookup per position
+                segments = {position: {'start': start, 'end': end, 'text': text} for position, start, end, text in rows if position in wanted}
+                hits = {p: matcher.find(segments[p]['text']) for p in data if p in segments}
+                hits = {p: found for p, found in hits.items() if found}  # Drops token matches that aren't the phrase, or differ in case
+                if hits:
+                    heapq.heappush(heap, (-len(hits), video, 2, (segments, hits)))
+            else:
+                results.append((video,) + data)
+
+        video_ids = dict(connection.execute(f"SELECT id, video_id FROM videos WHERE id IN ({','.join('?' * len(results))})",
+                                            [video for video, _, _ in results]))
+
+    matches = []
+    for video, segments, hits in results:
+        chunks = context_chunks(segments, hits)
+        matches.append({
+            'video_id': video_ids[video],
+            'transcript_filtered': chunks,
+            'sentiment_analysis': analyze_sentiments(chunks) if sentiment else None
+        })
+    return matches
+
+def index_stats(path=None):
+    with closing(connect(path)) as connection:
+        videos, segments = connection.execute('SELECT COUNT(*), COALESCE(SUM(segment_count), 0) FROM videos').fetchone()
+    path = path or search_index_path
+    size = sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+    return {'videos': videos, 'segments': segments, 'bytes': size}
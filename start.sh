@@ -6,8 +6,8 @@ source venv/bin/activate
 # Start Redis
 redis-server &
 
-# Start the RQ worker in the background
-rq worker &
+# Start the RQ worker in the background (preloads Whisper models before forking)
+python worker.py &
 
 # Start the Flask application
 python app.py
@@ -1,88 +1,331 @@
 from rq import get_current_job
+from rq.job import Job
 import os
-from modules import download_yt_audio, convert_audio, transcribe_audio, summariza_batonga, analyze_sentiments
+import sqlite3
+import time
+from modules import summary_backend as default_summary_backend, compress_transcript, excerpts_source, count_tokens, download_yt_audio, decode_audio, transcribe_audio, streaming_ingest, open_audio_download, stream_pcm, transcribe_stream, summarize_transcript, analyze_sentiments, filter_sentences_with_context, KeywordMatcher, score_sentiments, aggregate_sentiments, sample_rate
+from cache import result_cache_key, store_result, result_summary, canonical_video_id, get_cached_transcript, store_transcript
+from worker import default_model_size
+from events import publish_event
+from admission import record_transcription, record_job
+from metrics import start_stage, end_stage, observe, inc
+from search_index import index_transcript
+from playlists import notify_batches
+from audio_store import get_audio, stored_download_bytes, put_audio, store_windows, scratch_workspace, pin, unpin
 
-def analyze_yt_video(youtube_url, length, keywords, kw_analysis_length):
-    current_job = get_current_job()
-    
-    # Step 1: Download audio
-    current_job.meta['status'] = 'Downloading audio...'
+# Stage jobs carry the id the client knows in their meta, single jobs are that id
+def task_id_of(current_job):
+    return current_job.meta.get('task_id', current_job.id)
+
+def set_status(current_job, status, stage, timed=True):
+    if timed:
+        start_stage(current_job, stage)
+    else:
+        end_stage(current_job)
+    current_job.meta['status'] = status
     current_job.save_meta()
-    try:  
-        audio_filename = download_yt_audio(youtube_url)
-    except Exception as e:
-        error_str = str(e).lower()
-        if 'match' in error_str or 'unavailable' in error_str:
-            error_message = "The provided video link is invalid. Please check the link and try again."
-        else:
-            error_message = f"An error occurred while downloading the video: {e}"
-        current_job.meta['status'] = error_message
-        current_job.save_meta()
-        raise RuntimeError(error_message)
+    publish_event(task_id_of(current_job), 'stage', {'stage': stage, 'status': status})
 
-    # Step 2: Convert audio to WAV
-    current_job.meta['status'] = 'Converting audio...'
+# The later stages of a failed one would wait in the deferred registries forever, where admission counts them
+def cancel_later_stages(current_job):
+    dependent_ids = current_job.dependent_ids
+    while dependent_ids:
+        jobs = [job for job in Job.fetch_many(dependent_ids, connection=current_job.connection) if job is not None]
+        dependent_ids = [dependent_id for job in jobs for dependent_id in job.dependent_ids]
+        for job in jobs:
+            if not job.is_canceled:
+                job.cancel()
+
+def fail(current_job, error_message):
+    end_stage(current_job)
+    cancel_later_stages(current_job)
+    inc('av_jobs_total', outcome='failed')
+    current_job.meta['status'] = error_message
     current_job.save_meta()
+    publish_event(task_id_of(current_job), 'failed', {'status': error_message})
+    notify_batches(task_id_of(current_job))
+    return RuntimeError(error_message)
+
+def publish_segments(current_job, segments, progress):
+    publish_event(task_id_of(current_job), 'segments', {'segments': segments, 'progress': round(progress * 100, 1)})
+
+def download_error_message(e):
+    error_str = str(e).lower()
+    if 'match' in error_str or 'unavailable' in error_str:
+        return "The provided video link is invalid. Please check the link and try again."
+    return f"An error occurred while downloading the video: {e}"
+
+def record_download(current_job, download_stats):
+    if download_stats:
+        current_job.meta['download'] = download_stats  # Saved with the next status update
+        observe('av_download_bytes', download_stats['bytes'])
+        inc('av_download_bytes_total', download_stats['bytes'])
+
+def record_transcription_time(audio_seconds, transcription_seconds):
+    record_transcription(audio_seconds, transcription_seconds)  # Feeds the admission estimates
+    observe('av_audio_duration_seconds', audio_seconds)
+    if audio_seconds > 0:
+        observe('av_real_time_factor', transcription_seconds / audio_seconds)
+
+def record_audio_lookup(download_bytes):
+    inc('av_cache_requests_total', cache='audio', outcome='hit' if download_bytes is not None else 'miss')
+    if download_bytes:
+        inc('av_audio_store_saved_bytes_total', download_bytes)
+
+# Steps 1-2: Download audio into the job's scratch directory, decode it to 16 kHz mono samples in memory
+# and keep them in the audio store. The download is gone when this returns, whatever happened.
+def download_and_decode(current_job, youtube_url, video_id):
+    with scratch_workspace(task_id_of(current_job)) as workspace:
+        set_status(current_job, 'Downloading audio...', 'download')
+        download_stats = {}
+        try:
+            audio_filename = download_yt_audio(youtube_url, os.path.join(workspace, 'audio'), stats=download_stats)
+        except Exception as e:
+            raise fail(current_job, download_error_message(e))
+        record_download(current_job, download_stats)
+
+        set_status(current_job, 'Converting audio...', 'convert')
+        try:
+            audio = decode_audio(audio_filename)
+        except Exception as e:
+            error_message = f"An error occurred while converting the audio: {e}"
+            raise fail(current_job, error_message)
+    put_audio(video_id, audio, download_stats.get('bytes', 0))
+    return audio
+
+def transcribe_decoded_audio(current_job, audio):
+    # Step 3: Transcribe audio, keyword filtering happens later against the request's matcher
+    set_status(current_job, 'Transcribing audio... This may take a while.', 'transcribe')
+    transcription_start = time.perf_counter()
     try:
-        converted_audio_filename = convert_audio(audio_filename)
+        transcript, transcript_timestamped, _ = transcribe_audio(
+            audio, '', on_segments=lambda segments, progress: publish_segments(current_job, segments, progress))
     except Exception as e:
-        error_message = f"An error occurred while converting the audio: {e}"
-        current_job.meta['status'] = error_message
-        current_job.save_meta()
-        raise RuntimeError(error_message)
+        error_message = f"An error occurred while transcribing audio: {e}"
+        raise fail(current_job, error_message)
+    record_transcription_time(len(audio) / sample_rate, time.perf_counter() - transcription_start)
 
-    # Step 3: Transcribe audio
-    current_job.meta['status'] = 'Transcribing audio... This may take a while.'
-    current_job.save_meta()
+    return transcript, transcript_timestamped
+
+# Steps 1-3 overlapped, with STREAMING_INGEST=1: ranges download ahead into ffmpeg's stdin, decoded windows
+# queue up for the transcriber, and the first segments go out while the rest is still downloading.
+# The windows are written to the audio store on the way through.
+def stream_and_transcribe(current_job, youtube_url, video_id):
+    set_status(current_job, 'Transcribing audio as it downloads...', 'transcribe')
+    download_stats = {}
     try:
-        transcript, transcript_timestamped, transcript_filtered = transcribe_audio(converted_audio_filename, keywords)
+        audio_bytes, length = open_audio_download(youtube_url, stats=download_stats)
+    except Exception as e:
+        raise fail(current_job, download_error_message(e))
+
+    transcription_start = time.perf_counter()
+    try:
+        transcript, transcript_timestamped, audio_seconds = transcribe_stream(
+            store_windows(video_id, stream_pcm(audio_bytes), download_stats), total_seconds=length,
+            on_segments=lambda segments, progress: publish_segments(current_job, segments, progress))
     except Exception as e:
         error_message = f"An error occurred while transcribing audio: {e}"
-        current_job.meta['status'] = error_message
-        current_job.save_meta()
-        raise RuntimeError(error_message)
+        raise fail(current_job, error_message)
+    record_download(current_job, download_stats)
+    record_transcription_time(audio_seconds, time.perf_counter() - transcription_start)  # Includes download waits
 
-    # Step 4: Analyze sentiment
-    if keywords:
-        try:
-            current_job.meta['status'] = 'Extracting sentiment...'
-            current_job.save_meta()
-            sentiment_results = analyze_sentiments(transcript_filtered)
-        except Exception as e:
-            error_message = f"An error occurred while analyzing sentiment: {e}"
-            current_job.meta['status'] = error_message
-            current_job.save_meta()
-            raise RuntimeError(error_message)
+    return transcript, transcript_timestamped
 
-    # Step 5: Summarize transcript
+# Steps 1-3, from stored audio when an earlier job downloaded this video
+def transcribe_video(current_job, youtube_url, video_id):
+    stored = get_audio(video_id)
+    record_audio_lookup(stored[1] if stored is not None else None)
+    if stored is not None:
+        audio = stored[0]
+    elif streaming_ingest:
+        return stream_and_transcribe(current_job, youtube_url, video_id)
+    else:
+        audio = download_and_decode(current_job, youtube_url, video_id)
+    return transcribe_decoded_audio(current_job, audio)
+
+def save_transcript(video_id, transcript, transcript_timestamped):
+    store_transcript(video_id, default_model_size, transcript, transcript_timestamped)
     try:
-        current_job.meta['status'] = 'Summarizing transcript...'
-        current_job.save_meta()
-        summary = summariza_batonga(transcript, length, keywords, kw_analysis_length)
+        index_transcript(video_id, transcript_timestamped)  # Searchable from now on
+    except sqlite3.Error:
+        pass  # Best effort, the video is indexed again the next time it's transcribed
+
+def reuse_transcript(current_job, cached_transcript):
+    set_status(current_job, 'Reusing the existing transcript...', 'transcribe', timed=False)
+    publish_segments(current_job, cached_transcript['transcript_timestamped'], 1.0)
+    return cached_transcript['transcript'], cached_transcript['transcript_timestamped']
+
+# Latency and input size of both summary paths, side by side in /metrics
+def record_summary(transcript, excerpts, seconds):
+    path = 'full' if excerpts is None else 'extractive'
+    input_tokens = count_tokens(transcript if excerpts is None else excerpts)
+    observe('av_summary_seconds', seconds, path=path)
+    inc('av_summary_input_tokens_total', input_tokens, path=path)
+    if excerpts is not None:
+        inc('av_summary_extracted_tokens_saved_total', count_tokens(transcript) - input_tokens)
+
+def analyze_transcript(current_job, transcript, transcript_timestamped, length, keywords, kw_analysis_length, whole_words, case_sensitive, summary_backend):
+    matcher = KeywordMatcher(keywords, whole_words, case_sensitive)  # Built once, reused for every segment
+    transcript_filtered = filter_sentences_with_context(transcript_timestamped, matcher)
+
+    # Step 4: Analyze sentiment of the keyword chunks, and of every segment for the timeline
+    try:
+        set_status(current_job, 'Extracting sentiment...', 'sentiment')
+        sentiment_results = analyze_sentiments(transcript_filtered) if keywords else None
+        segment_scores = score_sentiments([segment['text'] for segment in transcript_timestamped])
+        sentiment_summary = aggregate_sentiments(transcript_timestamped, segment_scores, sentiment_results)
     except Exception as e:
-        if 'token' in str(e).lower():
-            error_message = "An error occurred while summarizing the video: Maximum word count exceeded. Support for unlimited video length is coming in the next update, but in the meantime please try analyzing a shorter video. Sorry for the inconvenience."
+        error_message = f"An error occurred while analyzing sentiment: {e}"
+        raise fail(current_job, error_message)
+
+    # Step 5: Summarize transcript
+    try:
+        set_status(current_job, 'Summarizing transcript...', 'summarize')
+        started = time.time()
+        excerpts = compress_transcript(transcript, transcript_timestamped, matcher)  # Key segments only, past SUMMARY_EXTRACT_TOKENS
+        if excerpts is None:
+            summary = summarize_transcript(transcript, length, keywords, kw_analysis_length, backend=summary_backend)  # Long transcripts are summarized in parts
         else:
-            error_message = f"An error occurred while summarizing the transcript: {e}"
-        current_job.meta['status'] = error_message
-        current_job.save_meta()
-        raise RuntimeError(error_message)
+            summary = summarize_transcript(excerpts, length, keywords, kw_analysis_length, source=excerpts_source, backend=summary_backend)
+        record_summary(transcript, excerpts, time.time() - started)
+    except Exception as e:
+        error_message = f"An error occurred while summarizing the transcript: {e}"
+        raise fail(current_job, error_message)
 
     # Return empty sentiment results if no keywords were provided
     if not keywords:
         sentiment_results = None
         transcript_filtered = None
 
-    # Cleanup
-    os.remove(audio_filename)
-    os.remove(converted_audio_filename)
-
-    current_job.meta['status'] = 'task completed'
-    current_job.save_meta()
-
     return {
         'transcript_timestamped': transcript_timestamped,
         'transcript_filtered': transcript_filtered,
         'sentiment_analysis': sentiment_results,
+        'sentiment_summary': sentiment_summary,
         'summary': summary
-    }
\ No newline at end of file
+    }
+
+def finish_task(current_job, result, youtube_url, length, keywords, kw_analysis_length, whole_words, case_sensitive, summary_backend, job_seconds):
+    # Cache the result for repeat submissions and release the in-flight claim
+    task_id = task_id_of(current_job)
+    store_result(result_cache_key(youtube_url, length, keywords, kw_analysis_length, whole_words, case_sensitive, summary_backend), task_id, result)
+
+    record_job(job_seconds)
+    end_stage(current_job)
+    inc('av_jobs_total', outcome='finished')
+
+    current_job.meta['status'] = 'task completed'
+    current_job.save_meta()
+    publish_event(task_id, 'finished', {'status': 'task completed'})
+    notify_batches(task_id)  # Playlists waiting on this video fold it in and start their next one
+
+    return result_summary(result)  # RQ keeps this as the job result, the full result lives in the result store
+
+# Whole analysis in one job, used with PIPELINE_MODE=single
+def analyze_yt_video(youtube_url, length, keywords, kw_analysis_length, whole_words=False, case_sensitive=False, summary_backend=None):
+    current_job = get_current_job()
+    job_start = time.perf_counter()
+    summary_backend = summary_backend or default_summary_backend
+
+    # Steps 1-3: Reuse the transcript from an earlier run of this video, or download and transcribe it
+    video_id = canonical_video_id(youtube_url)
+    cached_transcript = get_cached_transcript(video_id, default_model_size)
+    inc('av_cache_requests_total', cache='transcript', outcome='hit' if cached_transcript is not None else 'miss')
+    if cached_transcript is not None:
+        transcript, transcript_timestamped = reuse_transcript(current_job, cached_transcript)
+    else:
+        transcript, transcript_timestamped = transcribe_video(current_job, youtube_url, video_id)
+        save_transcript(video_id, transcript, transcript_timestamped)
+
+    result = analyze_transcript(current_job, transcript, transcript_timestamped, length, keywords, kw_analysis_length, whole_words, case_sensitive, summary_backend)
+    result['transcript_cached'] = cached_transcript is not None
+    return finish_task(current_job, result, youtube_url, length, keywords, kw_analysis_length, whole_words, case_sensitive, summary_backend,
+                       time.perf_counter() - job_start)
+
+# Stage jobs, chained with RQ dependencies and routed to their own queues.
+# Each stage hands the next one a small artifact reference, never the audio or the transcript itself:
+# the download stage leaves the decoded audio in the audio store, which both worker pools share.
+# The artifact goes into the next job's meta rather than staying in this job's result, which RQ may
+# expire while the next job still waits in its queue.
+
+def hand_over(current_job, artifact):
+    for job in Job.fetch_many(current_job.dependent_ids, connection=current_job.connection):
+        if job is not None:
+            job.meta['artifact'] = artifact
+            job.save_meta()
+    return artifact
+
+def handed_artifact(current_job):
+    artifact = current_job.meta.get('artifact')
+    if artifact is None:
+        raise fail(current_job, "The previous stage's output was lost, please try again.")
+    return artifact
+
+def download_stage(youtube_url):
+    current_job = get_current_job()
+    return hand_over(current_job, download_artifact(current_job, youtube_url))
+
+def download_artifact(current_job, youtube_url):
+    video_id = canonical_video_id(youtube_url)
+    artifact = {'video_id': video_id, 'youtube_url': youtube_url}
+    artifact['transcript_cached'] = get_cached_transcript(video_id, default_model_size) is not None
+    inc('av_cache_requests_total', cache='transcript', outcome='hit' if artifact['transcript_cached'] else 'miss')
+    if artifact['transcript_cached']:
+        return artifact
+    download_bytes = stored_download_bytes(video_id)
+    record_audio_lookup(download_bytes)
+    if download_bytes is None and streaming_ingest:
+        artifact['stream'] = True  # The transcribe stage downloads while it transcribes
+        return artifact
+
+    pin(video_id, task_id_of(current_job))  # Until the transcribe stage has read it
+    if download_bytes is None:
+        try:
+            download_and_decode(current_job, youtube_url, video_id)
+        except BaseException:
+            unpin(video_id, task_id_of(current_job))
+            raise
+        end_stage(current_job)
+        current_job.save_meta()
+    return artifact
+
+# Admission estimates the wait in this stage's queue, so the job time it averages is this stage's own runtime,
+# never the time the pipeline spent queued
+def transcribe_stage():
+    current_job = get_current_job()
+    stage_start = time.perf_counter()
+    artifact = handed_artifact(current_job)
+    if artifact['transcript_cached']:
+        cached_transcript = get_cached_transcript(artifact['video_id'], default_model_size)
+        if cached_transcript is not None:
+            reuse_transcript(current_job, cached_transcript)
+            return hand_over(current_job, dict(artifact, job_seconds=time.perf_counter() - stage_start))
+        raise fail(current_job, "The cached transcript expired, please try again.")
+
+    if artifact.get('stream'):
+        transcript, transcript_timestamped = stream_and_transcribe(current_job, artifact['youtube_url'], artifact['video_id'])
+    else:
+        try:
+            stored = get_audio(artifact['video_id'])
+        finally:
+            unpin(artifact['video_id'], task_id_of(current_job))
+        # Only gone if the pin went stale, or the store was cleared: download it again rather than fail the task
+        audio = stored[0] if stored is not None else download_and_decode(current_job, artifact['youtube_url'], artifact['video_id'])
+        transcript, transcript_timestamped = transcribe_decoded_audio(current_job, audio)
+    save_transcript(artifact['video_id'], transcript, transcript_timestamped)
+    end_stage(current_job)
+    return hand_over(current_job, dict(artifact, job_seconds=time.perf_counter() - stage_start))
+
+def analyze_stage(youtube_url, length, keywords, kw_analysis_length, whole_words=False, case_sensitive=False, summary_backend=None):
+    current_job = get_current_job()
+    summary_backend = summary_backend or default_summary_backend
+    artifact = handed_artifact(current_job)
+    cached_transcript = get_cached_transcript(artifact['video_id'], default_model_size)
+    if cached_transcript is None:
+        raise fail(current_job, "The transcript expired before it could be analyzed, please try again.")
+
+    result = analyze_transcript(current_job, cached_transcript['transcript'], cached_transcript['transcript_timestamped'],
+                                length, keywords, kw_analysis_length, whole_words, case_sensitive, summary_backend)
+    result['transcript_cached'] = artifact['transcript_cached']
+    return finish_task(current_job, result, youtube_url, length, keywords, kw_analysis_length, whole_words, case_sensitive, summary_backend,
+                       artifact['job_seconds'])
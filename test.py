@@ -1,24 +1,101 @@
 import pytest
+import fakeredis
+import redis
 from unittest.mock import patch, Mock, MagicMock
-from modules import download_yt_audio, convert_audio, filter_sentences_with_context, transcribe_audio, summariza_batonga, analyze_sentiments
+from modules import download_yt_audio, convert_audio, filter_sentences_with_context, transcribe_audio, summariza_batonga, analyze_sentiments, decode_audio, stream_audio
+from modules import find_split_points, merge_chunk_segments, chunk_transcript, count_tokens, summarize_transcript, KeywordMatcher
+from modules import textrank, extract_segments, compress_transcript
+from modules import score_sentiments, aggregate_sentiments, sentiment_analyzer
+from modules import select_audio_stream, download_ranged, iter_download, stream_pcm, transcribe_stream
+from modules import BartSummarizer, bart_summarize, serve_bart_batch, serve_bart_summaries, quantize_for_cpu
+import io
+import os
+import json
+import time
+import threading
+import numpy as np
+import torch
+import whisper
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pytube.exceptions import RegexMatchError, VideoUnavailable
+from worker import ModelRegistry, Supervisor, spoken_language, plan_topology, physical_cores, parse_cpu_list, run_worker, FasterWhisperModel, quantize_whisper, load_transcription_model, model_nbytes
+from cache import result_cache_key, store_result, store_transcript, get_cached_transcript, get_result_segments, get_result_keywords
+from cache import pack_segments, unpack_segments, claim_inflight, release_inflight
+from tasks import analyze_yt_video
+from rq import Queue, SimpleWorker
+from rq.job import JobStatus
+from events import publish_event, read_events
+import app as api
+from bench_model_acc import word_error_rate
+from bench_pipeline import compare
+from search_index import index_transcript, search, index_stats
+from admission import record_transcription, record_job, job_timeout_for, estimate_runtime, video_duration, video_durations, stats_key, queue_load
+import audio_store
+import rate_limit
+from rq.job import Job
+from playlists import get_batch, active_batches, reconcile_batches
+from metrics import metric_key
+import modules
+
+class RangeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        payload = server.payload
+        start, end = 0, len(payload) - 1
+        range_header = self.headers.get('Range')
+        if range_header and server.supports_ranges:
+            start, end = (int(value) for value in range_header.split('=')[1].split('-'))
+        with server.lock:
+            server.requests.append(range_header)
+            cut = server.failures > 0 and end - start > 1000
+            if cut:
+                server.failures -= 1
+        body = payload[start:end + 1]
+        self.send_response(206 if range_header and server.supports_ranges else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if cut:
+            self.wfile.write(body[:len(body) // 2])  # Drop the connection halfway through
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def range_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.payload = os.urandom(5 * 1024 * 1024 + 123)
+    server.supports_ranges = True
+    server.failures = 0
+    server.requests = []
+    server.lock = threading.Lock()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/audio'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
 
 # Test for successful audio download
-def test_download_yt_audio_success():
+def test_download_yt_audio_success(range_server, tmp_path):
+    streams = [Mock(abr='160kbps', subtype='webm', itag=251, url=range_server.url, filesize=len(range_server.payload)),
+               Mock(abr='48kbps', subtype='webm', itag=249, url=range_server.url, filesize=len(range_server.payload)),
+               Mock(abr='128kbps', subtype='mp4', itag=140, url=range_server.url, filesize=len(range_server.payload))]
     with patch('modules.YouTube') as mock_youtube:
-        # Mock the YouTube object and its method chain
-        mock_audio_stream = Mock()
-        mock_audio_stream.default_filename = 'test_audio.mp4'
-        mock_audio_stream.download.return_value = None  # download() doesn't return anything
-        mock_youtube.return_value.streams.filter.return_value.first.return_value = mock_audio_stream
+        mock_youtube.return_value.streams.filter.return_value = streams
+        stats = {}
 
         # Act
-        result = download_yt_audio('https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+        result = download_yt_audio('https://www.youtube.com/watch?v=dQw4w9WgXcQ', str(tmp_path / 'audio.webm'), stats=stats)
 
         # Assert
-        assert result == 'test_audio.mp4'
+        assert result == str(tmp_path / 'audio.webm')
         mock_youtube.assert_called_once_with('https://www.youtube.com/watch?v=dQw4w9WgXcQ')
-        mock_audio_stream.download.assert_called_once_with(filename='test_audio.mp4')
+        mock_youtube.return_value.streams.filter.assert_called_once_with(only_audio=True)
+        with open(result, 'rb') as file:
+            assert file.read() == range_server.payload
+        assert stats['itag'] == 249 and stats['bytes'] == len(range_server.payload)
 
 # Test for handling invalid URL
 def test_download_yt_audio_regex_error():
@@ -72,7 +149,8 @@ def test_filter_sentences_with_context():
         {
             "end": 19,
             "start": 0,
-            "text": "... Wow, what an audience. But if I'm being honest, I don't care what you think of my talk. I don't. ..."
+            "text": "... Wow, what an audience. But if I'm being honest, I don't care what you think of my talk. I don't. ...",
+            "keywords": ["talk"]
         }
     ]
 
@@ -140,9 +218,11 @@ def test_transcribe_audio():
     ]
 
     with patch('modules.whisper.load_model') as mock_load_model, \
+         patch('modules.model_registry', ModelRegistry(memory_budget_mb=1024)), \
          patch('modules.filter_sentences_with_context', return_value=mock_filtered_sentences) as mock_filter:
         # Setting up the mock model
         mock_model = Mock()
+        mock_model.state_dict.return_value = {}
         mock_load_model.return_value = mock_model
         mock_model.transcribe.return_value = mock_transcribe_result
 
@@ -222,4 +302,1362 @@ def test_summariza_batonga():
         assert result == mock_response_content, "The function should return the mocked response content"
 
         # Verify that the OpenAI client was called correctly
-        mock_client.chat.completions.create.assert_called_once()
\ No newline at end of file
+        mock_client.chat.completions.create.assert_called_once()
+
+def mock_whisper_model(nbytes):
+    model = torch.nn.Module()
+    model.register_buffer('weights', torch.zeros(nbytes, dtype=torch.uint8))
+    return model
+
+# Test that resident models are reused instead of reloaded
+def test_model_registry_reuses_loaded_model():
+    registry = ModelRegistry(memory_budget_mb=1024)
+    with patch('worker.whisper.load_model', side_effect=lambda size: mock_whisper_model(1024)) as mock_load_model:
+        registry.preload(['small'])
+        first = registry.get('small')
+        second = registry.get('small')
+
+    assert first is second
+    mock_load_model.assert_called_once_with('small')
+    stats = registry.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 0
+    assert 'small' in stats['load_times']
+
+# Test that the least recently used model is evicted past the memory budget
+def test_model_registry_evicts_least_recently_used():
+    registry = ModelRegistry(memory_budget_mb=2)
+    with patch('worker.whisper.load_model', side_effect=lambda size: mock_whisper_model(1024 * 1024)):
+        registry.preload(['base', 'small'])
+        registry.get('base')  # 'small' is now the least recently used
+        registry.get('medium')
+
+    stats = registry.stats()
+    assert stats['resident'] == ['base', 'medium']
+    assert stats['evictions'] == 1
+    assert stats['misses'] == 1
+
+# Test that equivalent submissions share one cache key
+def test_result_cache_key_normalizes_params():
+    key = result_cache_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 3, 'Talk, audience', 2)
+
+    assert key == result_cache_key('https://youtu.be/dQw4w9WgXcQ', '3', 'audience,talk ', 2)
+    assert key == result_cache_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s', 3, 'talk, audience', '2')
+    assert key != result_cache_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 4, 'talk, audience', 2)
+    assert key != result_cache_key('https://www.youtube.com/watch?v=aaaaaaaaaaa', 3, 'talk, audience', 2)
+    with patch('modules.summary_extract_tokens', 4000):
+        assert key != result_cache_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 3, 'talk, audience', 2)
+
+@pytest.fixture
+def fake_redis(tmp_path):
+    fake_conn = fakeredis.FakeRedis()
+    with patch('search_index.search_index_path', str(tmp_path / 'search_index.sqlite3')), patch('cache.conn', fake_conn), patch('app.conn', fake_conn), patch('events.conn', fake_conn), \
+         patch('admission.conn', fake_conn), patch('admission.Worker.count', return_value=1), patch('metrics.conn', fake_conn), \
+         patch('playlists.conn', fake_conn), patch('pipeline_status.conn', fake_conn), patch('rate_limit.conn', fake_conn), patch('audio_store.audio_store_dir', str(tmp_path / 'audio_store')), \
+         patch('audio_store.scratch_dir', str(tmp_path / 'scratch')), patch('admission.YouTube', return_value=Mock(length=300)):
+        yield fake_conn
+
+transcription_request = {
+    'youtube_url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'summary_sentences': 3,
+    'keywords': 'talk',
+    'keyword_analysis_sentences': 2
+}
+
+# Test that a repeat submission is answered from the result cache
+def test_start_transcription_returns_cached_result(fake_redis):
+    cached_result = {'summary': 'Cached summary', 'sentiment_summary': {'keywords': {}, 'timeline': []}, 'transcript_cached': False,
+                     'transcript_timestamped': cached_transcript_timestamped, 'transcript_filtered': None, 'sentiment_analysis': None}
+    store_result(result_cache_key('https://youtu.be/dQw4w9WgXcQ', 3, 'talk', 2, summary_backend='openai'), 'finished-job', cached_result)
+
+    with patch('app.q') as mock_queue:
+        response = api.app.test_client().post('/start_transcription', json=transcription_request)
+
+    assert response.status_code == 200
+    assert response.json['task_id'] == 'finished-job'
+    assert response.json['result']['summary'] == 'Cached summary'
+    assert response.json['result']['segment_count'] == 3
+    assert 'transcript_timestamped' not in response.json['result']
+    assert response.json['cached'] is True
+    mock_queue.enqueue.assert_not_called()
+
+# Test that segments survive the packed, compressed encoding
+def test_pack_segments_round_trip():
+    segments = [{'start': 0, 'end': 3, 'text': 'Grüße aus Köln.'}, {'start': 3, 'end': 70000, 'text': ''}]
+    assert unpack_segments(pack_segments(segments)) == segments
+    assert unpack_segments(pack_segments([])) == []
+
+# Test that the transcript endpoint pages across stored pages and validates its parameters
+def test_task_result_transcript_pages(fake_redis):
+    segments = [{'start': i, 'end': i + 1, 'text': f'Segment {i}.'} for i in range(25)]
+    result = {'summary': 'Summary', 'sentiment_summary': {'keywords': {}, 'timeline': []}, 'transcript_cached': False,
+              'transcript_timestamped': segments, 'transcript_filtered': None, 'sentiment_analysis': None}
+    with patch('cache.result_page_segments', 10):
+        store_result('key', 'finished-job', result)
+        client = api.app.test_client()
+        page = client.get('/task_result/finished-job/transcript?offset=8&limit=5').json
+        last = client.get('/task_result/finished-job/transcript?offset=20&limit=10').json
+
+    assert page['segments'] == segments[8:13]
+    assert page['total'] == 25
+    assert page['next_offset'] == 13
+    assert last['segments'] == segments[20:]
+    assert last['next_offset'] is None
+    assert fake_redis.ttl('result:finished-job') > 0
+    assert client.get('/task_status/finished-job').json['result']['segment_count'] == 25
+    assert client.get('/task_result/finished-job/transcript?limit=0').status_code == 400
+    assert client.get('/task_result/finished-job/transcript?offset=x').status_code == 400
+    assert client.get('/task_result/unknown-job/transcript').status_code == 404
+
+# Test that concurrent identical submissions attach to the job already running
+def test_start_transcription_attaches_to_inflight_job(fake_redis):
+    with patch('app.q') as mock_queue, patch('app.pipeline_mode', 'single'), \
+         patch('pipeline_status.Job.fetch', return_value=Mock(get_status=Mock(return_value=JobStatus.STARTED), meta={})):
+        mock_queue.count = 0
+        mock_queue.deferred_job_registry.count = 0
+        mock_queue.enqueue.side_effect = lambda *args, job_id, **kwargs: Mock(get_id=Mock(return_value=job_id))
+        client = api.app.test_client()
+        first = client.post('/start_transcription', json=transcription_request)
+        second = client.post('/start_transcription', json=transcription_request)
+
+    assert first.status_code == 202 and second.status_code == 202
+    assert first.json['task_id'] == second.json['task_id']
+    mock_queue.enqueue.assert_called_once()
+
+# Test that the job gets the keywords in the normalized form the result is cached under
+def test_start_transcription_normalizes_keywords(fake_redis):
+    with patch('app.q') as mock_queue, patch('app.pipeline_mode', 'single'):
+        mock_queue.count = 0
+        mock_queue.deferred_job_registry.count = 0
+        mock_queue.enqueue.side_effect = lambda *args, job_id, **kwargs: Mock(get_id=Mock(return_value=job_id))
+        client = api.app.test_client()
+        client.post('/start_transcription', json=dict(transcription_request, keywords='Talk, Audience '))
+        client.post('/start_transcription', json=dict(transcription_request, keywords='Talk, Audience', keyword_case_sensitive=True))
+
+    assert [call.args[3] for call in mock_queue.enqueue.call_args_list] == ['audience, talk', 'Audience, Talk']
+
+# Test that a failed in-flight job is replaced by a fresh one
+def test_start_transcription_replaces_failed_inflight_job(fake_redis):
+    with patch('app.q') as mock_queue, patch('app.pipeline_mode', 'single'), \
+         patch('pipeline_status.Job.fetch', return_value=Mock(get_status=Mock(return_value=JobStatus.FAILED), meta={})):
+        mock_queue.count = 0
+        mock_queue.deferred_job_registry.count = 0
+        mock_queue.enqueue.side_effect = lambda *args, job_id, **kwargs: Mock(get_id=Mock(return_value=job_id))
+        client = api.app.test_client()
+        first = client.post('/start_transcription', json=transcription_request)
+        second = client.post('/start_transcription', json=transcription_request)
+
+    assert first.json['task_id'] != second.json['task_id']
+    assert mock_queue.enqueue.call_count == 2
+
+cached_transcript_timestamped = [
+    {"start": 0, "end": 14, "text": "Wow, what an audience."},
+    {"start": 14, "end": 18, "text": "But if I'm being honest, I don't care what you think of my talk."},
+    {"start": 18, "end": 19, "text": "I don't."}
+]
+
+# Test that a cached transcript skips download, conversion and transcription
+def test_analyze_yt_video_reuses_cached_transcript(fake_redis):
+    store_transcript('dQw4w9WgXcQ', 'small', 'Full transcript text', cached_transcript_timestamped)
+
+    with patch('tasks.get_current_job', return_value=Mock(id='job-1', meta={})), \
+         patch('tasks.default_model_size', 'small'), \
+         patch('tasks.download_yt_audio') as mock_download, \
+         patch('tasks.transcribe_audio') as mock_transcribe, \
+         patch('tasks.summarize_transcript', return_value='Mocked summary') as mock_summarize:
+        result = analyze_yt_video('https://youtu.be/dQw4w9WgXcQ', 3, 'talk', 2)
+
+    assert result['transcript_cached'] is True
+    assert result['segment_count'] == 3
+    assert result['keyword_chunk_count'] == 1
+    assert result['summary'] == 'Mocked summary'
+    assert get_result_segments('job-1', 0, 10) == (cached_transcript_timestamped, 3)
+    assert len(get_result_keywords('job-1')['transcript_filtered']) == 1
+    mock_download.assert_not_called()
+    mock_transcribe.assert_not_called()
+    mock_summarize.assert_called_once_with('Full transcript text', 3, 'talk', 2, backend='openai')
+
+# Test that a fresh transcription is stored for later runs
+def test_analyze_yt_video_stores_transcript(fake_redis):
+    with patch('tasks.get_current_job', return_value=Mock(id='job-1', meta={})), \
+         patch('tasks.default_model_size', 'small'), \
+         patch('tasks.download_yt_audio', return_value='audio.mp4'), \
+         patch('tasks.decode_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'):
+        result = analyze_yt_video('https://youtu.be/dQw4w9WgXcQ', 3, '', 2)
+
+    assert result['transcript_cached'] is False
+    cached = get_cached_transcript('dQw4w9WgXcQ', 'small')
+    assert cached['transcript'] == 'Full transcript text'
+    assert cached['model_size'] == 'small'
+    with patch('worker.transcribe_engine', 'faster-whisper'):
+        assert get_cached_transcript('dQw4w9WgXcQ', 'small') is None  # Another engine's transcripts aren't reused
+    with patch('worker.transcribe_engine', 'whisper-int8'):
+        assert get_cached_transcript('dQw4w9WgXcQ', 'small') is None
+
+# Test that a video whose transcript is gone is transcribed again from the stored audio, without a download
+def test_analyze_yt_video_reuses_stored_audio(fake_redis, tmp_path):
+    audio = np.linspace(-1, 32767 / 32768, 16000 * 3, dtype=np.float32)  # The range decode_audio produces
+    def download(youtube_url, output_path=None, stats=None):
+        stats['bytes'] = 12345
+        return fake_download(tmp_path)(youtube_url, output_path, stats)
+
+    with patch('tasks.get_current_job', return_value=Mock(id='job-1', meta={})), \
+         patch('tasks.download_yt_audio', side_effect=download) as mock_download, \
+         patch('tasks.decode_audio', return_value=audio), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])) as mock_transcribe, \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'):
+        analyze_yt_video('https://youtu.be/dQw4w9WgXcQ', 3, '', 2)
+        fake_redis.delete(*fake_redis.keys('transcript:*'))
+        analyze_yt_video('https://youtu.be/dQw4w9WgXcQ', 3, '', 2)
+
+    assert mock_download.call_count == 1
+    assert np.abs(mock_transcribe.call_args[0][0] - audio).max() < 1 / 32768  # Stored as int16
+    assert not os.listdir(tmp_path / 'scratch')
+    assert fake_redis.hget('metrics:av_cache_requests_total', 'cache="audio",outcome="hit"') == b'1'
+    assert fake_redis.hget('metrics:av_audio_store_saved_bytes_total', '') == b'12345'
+
+# Test that the audio store evicts the least recently used entries past its budget, and keeps the newest
+def test_audio_store_evicts_least_recently_used(tmp_path):
+    with patch('audio_store.audio_store_dir', str(tmp_path)), patch('audio_store.audio_store_bytes', 3 * (8 + 32000)), patch('audio_store.inc'):
+        for video_id in ('first', 'second', 'third'):
+            audio_store.put_audio(video_id, np.zeros(16000, dtype=np.float32), 100)
+        os.utime(tmp_path / 'second.pcm', (0, 0))
+        assert audio_store.get_audio('first')[1] == 100  # Used, so newer than second
+        audio_store.put_audio('fourth', np.zeros(16000, dtype=np.float32))
+        assert audio_store.get_audio('second') is None
+        assert all(audio_store.get_audio(video_id) is not None for video_id in ('first', 'third', 'fourth'))
+        audio_store.put_audio('huge', np.zeros(16000 * 10, dtype=np.float32))
+        assert sorted(os.listdir(tmp_path)) == ['.lock', 'huge.pcm']  # Over the budget alone, but just written
+
+        audio_store.pin('huge', 'task-1')  # Waiting for its transcription stage
+        audio_store.put_audio('next', np.zeros(16000, dtype=np.float32))
+        assert audio_store.get_audio('huge') is not None
+        audio_store.unpin('huge', 'task-1')
+        os.utime(tmp_path / 'huge.pcm', (0, 0))
+        audio_store.put_audio('last', np.zeros(16000, dtype=np.float32))
+        assert sorted(os.listdir(tmp_path)) == ['.lock', 'last.pcm', 'next.pcm']
+
+# Test that streaming ingest transcribes without a downloaded file and records the download
+def test_analyze_yt_video_streaming_ingest(fake_redis):
+    current_job = Mock(id='job-1', meta={})
+    with patch('tasks.get_current_job', return_value=current_job), \
+         patch('tasks.default_model_size', 'small'), \
+         patch('tasks.streaming_ingest', True), \
+         patch('tasks.download_yt_audio') as mock_download, \
+         patch('tasks.open_audio_download', return_value=(iter([b'audio']), 60)), \
+         patch('tasks.stream_pcm', return_value=iter([])), \
+         patch('tasks.transcribe_stream', return_value=('Full transcript text', cached_transcript_timestamped, 60.0)) as mock_stream, \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'):
+        result = analyze_yt_video('https://youtu.be/dQw4w9WgXcQ', 3, '', 2)
+
+    mock_download.assert_not_called()
+    assert mock_stream.call_args.kwargs['total_seconds'] == 60
+    assert result['segment_count'] == 3
+    assert get_cached_transcript('dQw4w9WgXcQ', 'small')['transcript'] == 'Full transcript text'
+
+def mock_ffmpeg(samples, return_code=0, error_output=b''):
+    process = Mock()
+    process.stdout = io.BytesIO(np.asarray(samples, dtype=np.int16).tobytes())
+    process.stderr = io.BytesIO(error_output)
+    process.wait.return_value = return_code
+    return process
+
+# Test that downloaded bytes are fed to ffmpeg's stdin while PCM is read back
+def test_stream_pcm_from_bytes():
+    process = mock_ffmpeg(np.arange(16000 * 2) % 1000)
+    process.stdin = io.BytesIO()
+    process.stdin.close = Mock()
+    with patch('modules.subprocess.Popen', return_value=process) as mock_popen:
+        windows = list(stream_pcm(iter([b'abc', b'def']), window_seconds=1))
+
+    assert [len(window) for window in windows] == [16000, 16000]
+    command = mock_popen.call_args[0][0]
+    assert command[command.index('-i') + 1] == 'pipe:0'
+    assert '-nostdin' not in command
+    process.stdin.close.assert_called_once()
+    assert process.stdin.getvalue() == b'abcdef'
+
+# Test that a failed download is reported instead of ffmpeg's complaint about truncated input
+def test_stream_pcm_download_error():
+    def audio_bytes():
+        yield b'abc'
+        raise ConnectionError('connection reset')
+
+    process = mock_ffmpeg([], return_code=1, error_output=b'Invalid data found')
+    process.stdin = io.BytesIO()
+    with patch('modules.subprocess.Popen', return_value=process):
+        with pytest.raises(ConnectionError, match='connection reset'):
+            list(stream_pcm(audio_bytes()))
+
+# Test that ffmpeg's PCM output is decoded into a float32 buffer without a WAV file
+def test_decode_audio():
+    samples = [0, 16384, -16384, 32767, -32768]
+    with patch('modules.subprocess.Popen', return_value=mock_ffmpeg(samples)) as mock_popen:
+        audio = decode_audio('test_audio.mp4')
+
+    assert audio.dtype == np.float32
+    np.testing.assert_allclose(audio, np.array(samples) / 32768.0)
+    command = mock_popen.call_args[0][0]
+    assert command[command.index('-ar') + 1] == '16000'
+    assert command[command.index('-ac') + 1] == '1'
+    assert command[-1] == '-'
+
+# Test that streaming yields fixed-size windows
+def test_stream_audio_windows():
+    samples = np.arange(16000 * 2 + 100) % 1000
+    with patch('modules.subprocess.Popen', return_value=mock_ffmpeg(samples)):
+        windows = list(stream_audio('test_audio.mp4', window_seconds=1))
+
+    assert [len(window) for window in windows] == [16000, 16000, 100]
+
+# Test that an ffmpeg failure surfaces as an error
+def test_decode_audio_ffmpeg_error():
+    with patch('modules.subprocess.Popen', return_value=mock_ffmpeg([], return_code=1, error_output=b'Invalid data found')):
+        with pytest.raises(RuntimeError, match='Invalid data found'):
+            decode_audio('broken.mp4')
+
+# Test that split points land in the silent gaps closest to each chunk boundary
+def test_find_split_points_prefers_silence():
+    rng = np.random.default_rng(0)
+    audio = rng.uniform(-0.5, 0.5, 16000 * 100).astype(np.float32)
+    audio[16000 * 28:16000 * 29] = 0  # Silence near the 30 s boundary
+    audio[16000 * 62:16000 * 63] = 0  # Silence near the 60 s boundary
+
+    split_points = find_split_points(audio, chunk_seconds=30, search_seconds=5)
+
+    assert 16000 * 28 <= split_points[0] < 16000 * 29
+    assert 16000 * 62 <= split_points[1] < 16000 * 63
+    assert all(later > earlier for earlier, later in zip(split_points, split_points[1:]))
+    assert split_points[-1] < len(audio)
+
+# Test that chunk segments are offset back onto the full timeline
+def test_merge_chunk_segments():
+    chunk_segments = [
+        [{'start': 0.0, 'end': 4.5, 'text': ' First chunk.'}],
+        [{'start': 0.0, 'end': 2.0, 'text': ' Second chunk.'}, {'start': 2.0, 'end': 9.0, 'text': ' Ends late.'}]
+    ]
+    chunk_bounds = [(0, 16000 * 5), (16000 * 5, 16000 * 12)]
+
+    merged = merge_chunk_segments(chunk_segments, chunk_bounds)
+
+    assert merged == [
+        {'start': 0.0, 'end': 4.5, 'text': ' First chunk.'},
+        {'start': 5.0, 'end': 7.0, 'text': ' Second chunk.'},
+        {'start': 7.0, 'end': 12.0, 'text': ' Ends late.'}
+    ]
+
+class FakeWhisperModel:
+    def transcribe(self, audio, **kwargs):
+        duration = len(audio) / 16000
+        return {'text': ' chunk', 'segments': [{'start': 0.0, 'end': duration, 'text': f' {duration:.0f} seconds'}],
+                'language': kwargs.get('language') or 'en'}
+
+    def spoken_language(self, audio):
+        return 'en'
+
+# Test that long audio is transcribed in parallel chunks and merged in order
+def test_transcribe_audio_parallel_chunks():
+    registry = ModelRegistry(memory_budget_mb=1024)
+    registry.models['small'] = (FakeWhisperModel(), 0)
+    audio = np.ones(16000 * 150, dtype=np.float32)
+    audio[16000 * 59:16000 * 61] = 0
+    audio[16000 * 119:16000 * 121] = 0
+
+    with patch('modules.model_registry', registry), patch('modules.transcribe_chunk_minutes', 1):
+        transcript, transcript_timestamped, _ = transcribe_audio(audio, 'seconds', model_size='small', processes=2)
+
+    assert [entry['start'] for entry in transcript_timestamped] == [0, 59, 119]
+    assert transcript_timestamped[-1]['end'] == 150
+    assert transcript == ' 59 seconds 60 seconds 31 seconds'
+
+class GermanWhisperModel(FakeWhisperModel):
+    def transcribe(self, audio, **kwargs):
+        return {'text': f" {kwargs.get('language')}", 'segments': [{'start': 0.0, 'end': 1.0, 'text': f" {kwargs.get('language')}"}], 'language': 'de'}
+
+    def spoken_language(self, audio):
+        return 'de'
+
+# Test that parallel chunks are all transcribed in the language detected once for the whole audio
+def test_transcribe_audio_parallel_chunks_share_language():
+    registry = ModelRegistry(memory_budget_mb=1024)
+    registry.models['small'] = (GermanWhisperModel(), 0)
+    audio = np.ones(16000 * 150, dtype=np.float32)
+
+    with patch('modules.model_registry', registry), patch('modules.transcribe_chunk_minutes', 1):
+        transcript, _, _ = transcribe_audio(audio, '', model_size='small', processes=2)
+
+    assert transcript == ' de de de'
+
+class FakeChatCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.requests.append(body)
+            self.server.client_ports.add(self.client_address[1])
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+            rate_limited = self.server.rate_limited > 0
+            self.server.rate_limited -= rate_limited
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.active -= 1
+
+        if rate_limited:
+            payload = json.dumps({'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}}).encode()
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.send_header('retry-after-ms', str(self.server.retry_after_ms))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        prompt = body['messages'][-1]['content']
+        content = 'Part summary.' if 'part of a longer video transcript' in prompt else 'Final summary.'
+        payload = json.dumps({
+            'id': 'chatcmpl-test',
+            'object': 'chat.completion',
+            'created': 0,
+            'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+# Local stand-in for the chat-completions endpoint
+@pytest.fixture
+def chat_completions_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeChatCompletionsHandler)
+    server.requests = []
+    server.lock = threading.Lock()
+    server.active = 0
+    server.max_active = 0
+    server.delay = 0.05
+    server.client_ports = set()
+    server.rate_limited = 0  # This many requests are answered with a 429 first
+    server.retry_after_ms = 100
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    environment = {'OPENAI_API_KEY': 'test-key', 'OPENAI_BASE_URL': f'http://127.0.0.1:{server.server_port}/v1'}
+    with patch.dict(os.environ, environment):
+        yield server
+    server.shutdown()
+    server.server_close()
+
+long_transcript = ' '.join(f'Sentence number {i} is about the talk and the audience.' for i in range(60))
+
+# Test that transcripts are split on sentences within the token budget
+def test_chunk_transcript():
+    chunks = chunk_transcript(long_transcript, max_tokens=50)
+
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 50 for chunk in chunks)
+    assert ' '.join(chunks) == long_transcript
+
+# Test that a transcript over the budget is summarized in parts and then reduced
+def test_summarize_transcript_map_reduce(chat_completions_server):
+    with patch('modules.summary_chunk_tokens', 100), patch('modules.summary_concurrency', 2):
+        summary = summarize_transcript(long_transcript, 3, 'talk', 2)
+
+    part_count = len(chunk_transcript(long_transcript, 100))
+    requests = chat_completions_server.requests
+    assert summary == 'Final summary.'
+    assert len(requests) == part_count + 1
+    assert chat_completions_server.max_active <= 2
+    final_prompt = requests[-1]['messages'][-1]['content']
+    assert 'strict length of 3 sentences' in final_prompt
+    assert 'limited to 2 sentences per keyword' in final_prompt
+    assert 'Part summary.' in final_prompt
+
+class StubSummarizer:
+    name = 'stub'
+    max_input_tokens = 100
+
+    def __init__(self):
+        self.inputs = []
+
+    def summarize(self, text, length, keywords, kw_analysis_length, source):
+        self.inputs.append(text)
+        return 'Final summary.'
+
+    def summarize_parts(self, chunks, keywords):
+        return ['Part summary that runs on. ' * 30 for _ in chunks]  # Longer than the parts themselves
+
+# Test that a reduce that stops shrinking its input cuts the part summaries instead of recursing
+def test_summarize_transcript_stops_when_reduce_grows(fake_redis):
+    summarizer = StubSummarizer()
+    with patch.dict('modules.summarizers', {'stub': summarizer}):
+        summary = summarize_transcript(long_transcript, 3, '', 2, backend='stub')
+
+    assert summary == 'Final summary.'
+    assert len(summarizer.inputs) == 1
+    assert count_tokens(summarizer.inputs[0]) <= StubSummarizer.max_input_tokens
+    assert len(summarizer.inputs[0].split('\n\n')) == len(chunk_transcript(long_transcript, 100))
+    assert fake_redis.hgetall(metric_key('av_summary_truncations_total')) == {b'backend="stub",reason="not_shrinking"': b'1'}
+
+# Test that a transcript within the budget goes out in a single request
+def test_summarize_transcript_single_request(chat_completions_server):
+    summary = summarize_transcript('A short talk.', 3, '', 2)
+
+    assert summary == 'Final summary.'
+    assert len(chat_completions_server.requests) == 1
+
+# Test that segments sharing the recurring topic outrank unrelated ones, and that keywords pull their segments up
+def test_textrank_extraction():
+    texts = ['The budget for the new bridge was approved.', 'Bridge construction will start once the budget clears.',
+             'The bridge budget covers steel and labor.', 'My cat likes the sofa.', 'Pancakes need flour and eggs.']
+    ranks = textrank(texts)
+    assert min(ranks[:3]) > max(ranks[3:])
+
+    segments = [{'start': i, 'end': i + 1, 'text': text} for i, text in enumerate(texts)]
+    assert extract_segments(segments, 30) == [0, 1, 2]
+    assert extract_segments(segments, 12, KeywordMatcher('pancakes')) == [4]
+
+# Test that only transcripts over the budget are compressed, within the budget and with gaps marked
+def test_compress_transcript():
+    segments = [{'start': i, 'end': i + 1, 'text': f' Point {i % 7} about the talk and the audience number {i}.'} for i in range(600)]
+    segments[450]['text'] = ' The speaker finally mentions pricing.'
+    transcript = ''.join(segment['text'] for segment in segments)
+
+    assert compress_transcript(transcript, segments, max_tokens=0) is None
+    assert compress_transcript(transcript, segments, max_tokens=count_tokens(transcript)) is None
+
+    started = time.time()
+    excerpts = compress_transcript(transcript, segments, KeywordMatcher('pricing'), max_tokens=300)
+    assert time.time() - started < 1
+    assert count_tokens(excerpts) <= 300
+    assert 'pricing' in excerpts and '...' in excerpts
+
+    long_segments = [{'start': 0, 'end': 60, 'text': ' A very long run-on segment.' * 50}] * 3
+    assert compress_transcript(''.join(segment['text'] for segment in long_segments), long_segments, max_tokens=100) is None
+
+# Test that every request of a process goes through one client and one kept-alive connection
+def test_openai_client_is_shared(chat_completions_server, fake_redis):
+    with patch('modules._openai_client_key', None), patch('modules.OpenAI', wraps=modules.OpenAI) as mock_openai:
+        for _ in range(3):
+            assert summariza_batonga('A short talk.', 3, '', 2) == 'Final summary.'
+
+    assert mock_openai.call_count == 1
+    assert len(chat_completions_server.requests) == 3
+    assert len(chat_completions_server.client_ports) == 1
+
+# Test that rate-limited requests are retried after the wait the API asked for, holding back every worker
+def test_chat_completion_retries_rate_limited_requests(chat_completions_server, fake_redis):
+    chat_completions_server.rate_limited = 2
+
+    started = time.time()
+    assert summariza_batonga('A short talk.', 3, '', 2) == 'Final summary.'
+
+    assert time.time() - started >= 0.2
+    assert len(chat_completions_server.requests) == 3
+    assert fake_redis.hgetall(metric_key('av_openai_retries_total')) == {b'reason="429"': b'2'}
+
+# Test that the shared bucket paces requests once it runs dry, and that the wait is measured
+def test_rate_limiter_paces_requests(fake_redis):
+    with patch('rate_limit.openai_rpm', 600), patch('rate_limit.openai_tpm', 0):  # 10 requests a second
+        fake_redis.hset(rate_limit.bucket_key, mapping={'requests': 0, 'tokens': 0, 'updated': time.time()})
+        waited = sum(rate_limit.acquire(100) for _ in range(3))
+
+    assert 0.25 <= waited < 1
+    histogram = fake_redis.hgetall(metric_key('av_openai_limiter_wait_seconds'))
+    assert int(histogram[b'|count']) == 3
+    assert float(histogram[b'|sum']) == pytest.approx(waited)
+
+# Test that retry delays follow the rate-limit headers, and back off with jitter without them
+def test_retry_delay():
+    assert rate_limit.header_delay({'retry-after-ms': '250'}) == 0.25
+    assert rate_limit.header_delay({'retry-after': '3'}) == 3
+    assert rate_limit.header_delay({'x-ratelimit-reset-requests': '20ms', 'x-ratelimit-reset-tokens': '1m2.5s'}) == 62.5
+    assert rate_limit.header_delay({}) is None
+    assert 2 <= rate_limit.retry_delay({'retry-after': '2'}, 0) <= 2.5
+    assert all(0 <= rate_limit.retry_delay(None, attempt) <= min(rate_limit.backoff_cap, 2 ** attempt) for attempt in range(10))
+
+# Test that the job publishes stage transitions and segments as it goes
+def test_analyze_yt_video_publishes_events(fake_redis):
+    def fake_transcribe(audio, keywords, on_segments):
+        on_segments(cached_transcript_timestamped[:2], 0.5)
+        on_segments(cached_transcript_timestamped[2:], 1.0)
+        return 'Full transcript text', cached_transcript_timestamped, []
+
+    with patch('tasks.get_current_job', return_value=Mock(id='job-1', meta={})), \
+         patch('tasks.default_model_size', 'small'), \
+         patch('tasks.download_yt_audio', return_value='audio.mp4'), \
+         patch('tasks.decode_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+         patch('tasks.transcribe_audio', side_effect=fake_transcribe), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'), \
+         patch('tasks.os.remove'):
+        analyze_yt_video('https://youtu.be/dQw4w9WgXcQ', 3, '', 2)
+
+    events = read_events('job-1')
+    stages = [data['stage'] for _, event, data in events if event == 'stage']
+    segments = [data for _, event, data in events if event == 'segments']
+    assert stages == ['download', 'convert', 'transcribe', 'sentiment', 'summarize']
+    assert [data['progress'] for data in segments] == [50.0, 100.0]
+    assert segments[0]['segments'] == cached_transcript_timestamped[:2]
+    assert events[-1][1] == 'finished'
+
+# Test that the SSE endpoint replays the stream and closes after the terminal event
+def test_task_stream(fake_redis):
+    publish_event('job-2', 'stage', {'stage': 'download', 'status': 'Downloading audio...'})
+    publish_event('job-2', 'segments', {'segments': cached_transcript_timestamped, 'progress': 100.0})
+    publish_event('job-2', 'failed', {'status': 'Something broke'})
+
+    response = api.app.test_client().get('/task_stream/job-2')
+
+    assert response.mimetype == 'text/event-stream'
+    body = response.get_data(as_text=True)
+    assert [line for line in body.splitlines() if line.startswith('event:')] == ['event: stage', 'event: segments', 'event: failed']
+
+    last_event_id = read_events('job-2')[0][0]
+    resumed = api.app.test_client().get('/task_stream/job-2', headers={'Last-Event-ID': last_event_id}).get_data(as_text=True)
+    assert 'event: stage' not in resumed
+
+# Test that segments are streamed chunk by chunk with context and language carried across cuts
+def test_transcribe_audio_streams_sequential_chunks():
+    registry = ModelRegistry(memory_budget_mb=1024)
+    model = FakeWhisperModel()
+    model.transcribe = Mock(side_effect=FakeWhisperModel().transcribe)
+    registry.models['small'] = (model, 0)
+    audio = np.ones(16000 * 90, dtype=np.float32)
+    audio[16000 * 49:16000 * 51] = 0
+    reported = []
+
+    with patch('modules.model_registry', registry), patch('modules.transcribe_stream_chunk_seconds', 50):
+        _, transcript_timestamped, _ = transcribe_audio(audio, 'seconds', model_size='small', processes=1,
+                                                         on_segments=lambda segments, progress: reported.append((segments, progress)))
+
+    assert [progress for _, progress in reported] == [pytest.approx(49 / 90, abs=0.01), 1.0]
+    assert [segment for segments, _ in reported for segment in segments] == transcript_timestamped
+    assert model.transcribe.call_args_list[0].kwargs['language'] is None
+    assert model.transcribe.call_args_list[1].kwargs['initial_prompt'] == ' chunk'
+    assert model.transcribe.call_args_list[1].kwargs['language'] == 'en'
+
+# Test that streamed windows are cut at quiet points and reported as they are transcribed
+def test_transcribe_stream_chunks_windows():
+    registry = ModelRegistry(memory_budget_mb=1024)
+    model = FakeWhisperModel()
+    model.transcribe = Mock(side_effect=FakeWhisperModel().transcribe)
+    registry.models['small'] = (model, 0)
+    audio = np.full(16000 * 90, 8000, dtype=np.int16)
+    audio[16000 * 49:16000 * 51] = 0
+    windows = (audio[start:start + 16000 * 10] for start in range(0, len(audio), 16000 * 10))
+    reported = []
+
+    with patch('modules.model_registry', registry), patch('modules.stream_queue_windows', 2):
+        transcript, transcript_timestamped, audio_seconds = transcribe_stream(
+            windows, model_size='small', chunk_seconds=50, total_seconds=90,
+            on_segments=lambda segments, progress: reported.append((segments, progress)))
+
+    assert audio_seconds == 90
+    assert [entry['start'] for entry in transcript_timestamped] == [0, 49]
+    assert transcript == ' 49 seconds 41 seconds'
+    assert [progress for _, progress in reported] == [pytest.approx(49 / 90, abs=0.01), 1.0]
+    assert model.transcribe.call_args_list[1].kwargs['initial_prompt'] == ' chunk'
+    assert model.transcribe.call_args_list[1].kwargs['language'] == 'en'
+
+# Test that a decoding failure in the middle of a stream surfaces to the transcriber
+def test_transcribe_stream_reader_error():
+    registry = ModelRegistry(memory_budget_mb=1024)
+    registry.models['small'] = (FakeWhisperModel(), 0)
+
+    def windows():
+        yield np.zeros(16000, dtype=np.int16)
+        raise RuntimeError('ffmpeg failed to decode audio')
+
+    with patch('modules.model_registry', registry):
+        with pytest.raises(RuntimeError, match='ffmpeg failed'):
+            transcribe_stream(windows(), model_size='small', chunk_seconds=50)
+
+# Test that the matcher finds overlapping keywords and honours its modes
+def test_keyword_matcher_modes():
+    substring = KeywordMatcher('art, Start, talk, talks')
+    assert substring.find('Let us start the talks') == ['art', 'Start', 'talk', 'talks']
+    assert KeywordMatcher('sun, sunset, settle').find('Sunsettle') == ['sun', 'sunset', 'settle']
+
+    whole_words = KeywordMatcher('art, talk, talks', whole_words=True)
+    assert whole_words.find('Let us start the talks') == ['talks']
+    assert whole_words.find('A talk about art.') == ['art', 'talk']
+
+    case_sensitive = KeywordMatcher('Art, C++', case_sensitive=True)
+    assert case_sensitive.find('art in c++') == []
+    assert case_sensitive.find('Art in C++') == ['Art', 'C++']
+
+    assert KeywordMatcher('').find('anything') == []
+
+# Test that each returned chunk lists the keywords it matched
+def test_filter_sentences_reports_keywords():
+    transcript_timestamped = [
+        {"start": 0, "end": 5, "text": "We start with art."},
+        {"start": 5, "end": 9, "text": "Then some music."},
+        {"start": 9, "end": 12, "text": "Nothing here."},
+        {"start": 12, "end": 15, "text": "Filler."},
+        {"start": 15, "end": 20, "text": "More Music at the end."}
+    ]
+    matcher = KeywordMatcher('art, music', whole_words=True)
+
+    result = filter_sentences_with_context(transcript_timestamped, matcher)
+
+    assert [(chunk['start'], chunk['end'], chunk['keywords']) for chunk in result] == [(0, 12, ['art', 'music']), (12, 20, ['music'])]
+
+# Test that the analyzer is shared and pooled scoring matches serial scoring
+def test_score_sentiments_batch():
+    texts = ['I love this talk.', 'This is terrible.', 'The sky is blue.'] * 4
+
+    with patch('modules.sentiment_pool_min_texts', 1):
+        pooled = score_sentiments(texts, processes=2)
+    serial = score_sentiments(texts, processes=1)
+
+    assert pooled == serial
+    assert serial[0]['compound'] > 0 > serial[1]['compound']
+    assert sentiment_analyzer() is sentiment_analyzer()
+
+# Test per-keyword and timeline aggregates
+def test_aggregate_sentiments():
+    transcript_timestamped = [
+        {'start': 0, 'end': 10, 'text': 'a'},
+        {'start': 30, 'end': 40, 'text': 'b'},
+        {'start': 130, 'end': 140, 'text': 'c'}
+    ]
+    segment_scores = [{'compound': 0.5}, {'compound': -0.1}, {'compound': 0.9}]
+    sentiment_results = [
+        {'text': 'x', 'keywords': ['talk', 'art'], 'sentiment': {'compound': 0.6}},
+        {'text': 'y', 'keywords': ['talk'], 'sentiment': {'compound': -0.2}}
+    ]
+
+    aggregates = aggregate_sentiments(transcript_timestamped, segment_scores, sentiment_results, bucket_seconds=60)
+
+    assert aggregates['keywords']['talk'] == {'chunks': 2, 'compound_mean': 0.2, 'compound_min': -0.2, 'compound_max': 0.6}
+    assert aggregates['keywords']['art']['chunks'] == 1
+    assert [(bucket['start'], bucket['segments'], bucket['compound_mean']) for bucket in aggregates['timeline']] == [(0, 2, 0.2), (120, 1, 0.9)]
+    assert aggregates['timeline'][0]['compound_min'] == -0.1
+
+# Test that the timeout scales with the video length and the measured real-time factor
+def test_job_timeout_uses_measured_real_time_factor(fake_redis):
+    record_transcription(audio_seconds=1000, transcription_seconds=2000)
+
+    assert estimate_runtime(3600) == 3600 * 2 + 120
+    assert job_timeout_for(3600) == (3600 * 2 + 120) * 2
+    assert job_timeout_for(10) == 600
+    assert job_timeout_for(None) == 600
+
+# Test that a moving average update that races another worker's is retried on top of it
+def test_record_job_retries_concurrent_update(fake_redis):
+    pipeline = fake_redis.pipeline
+
+    def racing_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        multi = pipe.multi
+
+        def racing_multi():
+            if not fake_redis.hexists(stats_key, 'job_seconds'):
+                fake_redis.hset(stats_key, 'job_seconds', 100)  # Lands between this worker's read and write
+            multi()
+        pipe.multi = racing_multi
+        return pipe
+
+    with patch.object(fake_redis, 'pipeline', side_effect=racing_pipeline):
+        record_job(600)
+
+    assert float(fake_redis.hget(stats_key, 'job_seconds')) == pytest.approx(0.8 * 100 + 0.2 * 600)
+
+# Test that a failed duration lookup is remembered briefly instead of asked again for every submission
+def test_video_duration_caches_failed_lookups(fake_redis):
+    with patch('admission.YouTube', side_effect=Exception('Video unavailable')) as mock_youtube:
+        assert video_duration('https://youtu.be/aaaaaaaaaaa', 'aaaaaaaaaaa') is None
+        assert video_duration('https://youtu.be/aaaaaaaaaaa', 'aaaaaaaaaaa') is None
+        assert video_durations(['https://youtu.be/aaaaaaaaaaa'], ['aaaaaaaaaaa']) == [None]
+
+    mock_youtube.assert_called_once()
+    assert 0 < fake_redis.ttl('video_duration:aaaaaaaaaaa') <= 300
+
+# Test that the 202 response carries the estimates and the job gets a sized timeout
+def test_start_transcription_returns_estimates(fake_redis):
+    with patch('app.q') as mock_queue, patch('app.pipeline_mode', 'single'):
+        mock_queue.count = 0
+        mock_queue.deferred_job_registry.count = 0
+        mock_queue.enqueue.side_effect = lambda *args, job_id, **kwargs: Mock(get_id=Mock(return_value=job_id))
+        response = api.app.test_client().post('/start_transcription', json=transcription_request)
+
+    assert response.status_code == 202
+    assert response.json['estimated_wait_seconds'] == 0
+    assert response.json['estimated_start'] is not None
+    assert response.json['estimated_finish'] is not None
+    assert mock_queue.enqueue.call_args.kwargs['job_timeout'] == 600  # 300 s at the default factor of 0.5, plus overhead, doubled
+    assert mock_queue.enqueue.call_args.kwargs['meta'] == {'audio_seconds': 300}
+
+# Test that a request is rejected with Retry-After when the backlog is past the SLA
+def test_start_transcription_rejects_when_overloaded(fake_redis):
+    record_job(600)
+
+    with patch('app.q') as mock_queue, patch('app.pipeline_mode', 'single'), \
+         patch('app.max_wait_seconds', 1800), patch('admission.max_wait_seconds', 1800):
+        mock_queue.count = 5
+        mock_queue.deferred_job_registry.count = 0
+        response = api.app.test_client().post('/start_transcription', json=transcription_request)
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == str(5 * 600 - 1800)
+    mock_queue.enqueue.assert_not_called()
+    assert not fake_redis.keys('inflight:*')
+
+@pytest.fixture
+def stage_queues(fake_redis, tmp_path):
+    queues = {name: Queue(name, connection=fake_redis) for name in ('download', 'transcribe', 'analyze')}
+    with patch('app.download_q', queues['download']), patch('app.transcribe_q', queues['transcribe']), \
+         patch('app.analyze_q', queues['analyze']), patch('app.pipeline_mode', 'stages'), \
+         patch('tasks.default_model_size', 'small'):
+        yield queues
+
+def run_stage_workers(queues, connection):
+    SimpleWorker([queues['analyze'], queues['transcribe'], queues['download']], connection=connection).work(burst=True)
+
+def fake_download(tmp_path):
+    def download(youtube_url, output_path=None, stats=None):
+        audio_filename = output_path or str(tmp_path / 'audio.mp4')
+        open(audio_filename, 'wb').close()
+        return audio_filename
+    return download
+
+# Test that the stage jobs chain through their own queues and report as one task
+def test_stage_pipeline_runs_as_one_task(stage_queues, fake_redis, tmp_path):
+    with patch('admission.max_wait_seconds', 1800):
+        response = api.app.test_client().post('/start_transcription', json=transcription_request)
+    task_id = response.json['task_id']
+
+    assert response.status_code == 202
+    assert stage_queues['download'].job_ids == [f'{task_id}:download']
+    assert stage_queues['transcribe'].deferred_job_registry.get_job_ids() == [f'{task_id}:transcribe']
+    assert stage_queues['analyze'].deferred_job_registry.get_job_ids() == [task_id]
+    assert api.app.test_client().get(f'/task_status/{task_id}').json['state'] == 'PENDING'
+
+    with patch('tasks.download_yt_audio', side_effect=fake_download(tmp_path)), \
+         patch('tasks.decode_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'):
+        run_stage_workers(stage_queues, fake_redis)
+
+    status = api.app.test_client().get(f'/task_status/{task_id}')
+    assert status.status_code == 200
+    assert status.json['result']['summary'] == 'Mocked summary'
+    assert status.json['result']['keyword_chunk_count'] == 1
+    assert len(api.app.test_client().get(f'/task_result/{task_id}/keywords').json['transcript_filtered']) == 1
+    assert api.app.test_client().get(f'/task_result/{task_id}/transcript').json['segments'] == cached_transcript_timestamped
+    found = api.app.test_client().get('/search?keywords=talk').json['videos']
+    assert [video['video_id'] for video in found] == ['dQw4w9WgXcQ']  # Indexed when the transcript was stored
+    assert not os.listdir(tmp_path / 'scratch')  # The download is gone once it's decoded
+    assert sorted(os.listdir(tmp_path / 'audio_store')) == ['.lock', 'dQw4w9WgXcQ.pcm']  # Kept for the next analysis of this video
+    stages = [data['stage'] for _, event, data in read_events(task_id) if event == 'stage']
+    assert stages == ['download', 'convert', 'transcribe', 'sentiment', 'summarize']
+    assert read_events(task_id)[-1][1] == 'finished'
+
+# Test that a batch is enqueued in one go, deduplicated, and polled with conditional batch status requests
+def test_batch_submission_and_status(stage_queues, fake_redis, tmp_path):
+    other_video = dict(transcription_request, youtube_url='https://www.youtube.com/watch?v=aaaaaaaaaaa')
+    client = api.app.test_client()
+    with patch('admission.max_wait_seconds', 1800):
+        response = client.post('/start_transcription_batch', json={'videos': [transcription_request, transcription_request, other_video, {'keywords': ''}]})
+    tasks = response.json['tasks']
+
+    assert [task['status_code'] for task in tasks] == [202, 202, 202, 400]
+    assert tasks[0]['task_id'] == tasks[1]['task_id'] != tasks[2]['task_id']
+    assert tasks[2]['estimated_wait_seconds'] > tasks[0]['estimated_wait_seconds']  # Queued behind the first one
+    task_ids = [tasks[0]['task_id'], tasks[2]['task_id']]
+    assert sorted(stage_queues['download'].job_ids) == sorted(f'{task_id}:download' for task_id in task_ids)
+    assert sorted(stage_queues['analyze'].deferred_job_registry.get_job_ids()) == sorted(task_ids)
+
+    pending = client.get(f'/task_status_batch?task_ids={task_ids[0]},{task_ids[1]},missing-task')
+    assert [pending.json['tasks'][task_id]['state'] for task_id in task_ids] == ['PENDING', 'PENDING']
+    assert pending.json['tasks']['missing-task']['status_code'] == 404
+    assert client.get(f'/task_status_batch?task_ids={task_ids[0]},{task_ids[1]},missing-task',
+                      headers={'If-None-Match': pending.headers['ETag']}).status_code == 304
+
+    with patch('tasks.download_yt_audio', side_effect=fake_download(tmp_path)), \
+         patch('tasks.decode_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'):
+        run_stage_workers(stage_queues, fake_redis)
+
+    etags = {task_id: pending.json['tasks'][task_id]['etag'] for task_id in task_ids}
+    finished = client.post('/task_status_batch', json={'task_ids': task_ids, 'etags': etags})
+    assert finished.headers['ETag'] != pending.headers['ETag']
+    assert [finished.json['tasks'][task_id]['result']['summary'] for task_id in task_ids] == ['Mocked summary'] * 2
+    etags = {task_id: finished.json['tasks'][task_id]['etag'] for task_id in task_ids}
+    assert client.post('/task_status_batch', json={'task_ids': task_ids, 'etags': etags}).json['tasks'][task_ids[0]] == \
+        {'etag': etags[task_ids[0]], 'unchanged': True}
+
+# Test that a claim whose batch hasn't written its job yet isn't replaced, and that a failed write gives the claims up
+def test_batch_claims_before_and_after_the_write(stage_queues, fake_redis):
+    client = api.app.test_client()
+    cache_key = result_cache_key(*api.submission_args(transcription_request))
+    claim_inflight(cache_key, 'claimed-job', ttl=600)
+    with patch('admission.max_wait_seconds', 1800):
+        assert client.post('/start_transcription', json=transcription_request).json == {'task_id': 'claimed-job'}
+    release_inflight(cache_key, 'claimed-job')
+
+    def failing_pipeline(*args, **kwargs):
+        pipe = fake_redis.pipeline(*args, **kwargs)
+        pipe.execute = Mock(side_effect=redis.ConnectionError('Redis went away'))
+        return pipe
+
+    with patch('admission.max_wait_seconds', 1800), patch('app.conn', Mock(wraps=fake_redis, pipeline=failing_pipeline)):
+        response = client.post('/start_transcription_batch', json={'videos': [transcription_request]})
+    assert response.status_code == 503
+    assert fake_redis.keys('inflight:*') == []
+    with patch('admission.max_wait_seconds', 1800):
+        assert 'estimated_start' in client.post('/start_transcription', json=transcription_request).json  # A new job, not the lost one
+
+# Test that audio gone from the store by the transcription stage is downloaded again instead of failing the task
+def test_stage_pipeline_downloads_evicted_audio_again(stage_queues, fake_redis, tmp_path):
+    with patch('admission.max_wait_seconds', 1800):
+        task_id = api.app.test_client().post('/start_transcription', json=transcription_request).json['task_id']
+
+    with patch('tasks.download_yt_audio', side_effect=fake_download(tmp_path)) as mock_download, \
+         patch('tasks.decode_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+         patch('tasks.get_audio', return_value=None), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'):
+        run_stage_workers(stage_queues, fake_redis)
+
+    assert mock_download.call_count == 2
+    assert api.app.test_client().get(f'/task_status/{task_id}').json['state'] == 'SUCCESS'
+    assert not [name for name in os.listdir(tmp_path / 'audio_store') if name.endswith('.pin')]
+
+# Test that the later stages still run after the earlier stage jobs have expired from Redis
+def test_stage_pipeline_survives_expired_upstream_jobs(stage_queues, fake_redis, tmp_path):
+    with patch('admission.max_wait_seconds', 1800):
+        task_id = api.app.test_client().post('/start_transcription', json=transcription_request).json['task_id']
+
+    with patch('tasks.download_yt_audio', side_effect=fake_download(tmp_path)), \
+         patch('tasks.decode_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'):
+        SimpleWorker([stage_queues['download']], connection=fake_redis).work(burst=True)
+        fake_redis.delete(f'rq:job:{task_id}:download')  # Its result expired while the next stage was queued
+        SimpleWorker([stage_queues['transcribe']], connection=fake_redis).work(burst=True)
+        fake_redis.delete(f'rq:job:{task_id}:transcribe')
+        run_stage_workers(stage_queues, fake_redis)
+
+    status = api.app.test_client().get(f'/task_status/{task_id}')
+    assert status.json['state'] == 'SUCCESS'
+    assert status.json['result']['summary'] == 'Mocked summary'
+    assert not [name for name in os.listdir(tmp_path / 'audio_store') if name.endswith('.pin')]
+
+# Test that admission learns the transcription job's own runtime, not the time the pipeline spent in other stages and queues
+def test_stage_pipeline_records_transcribe_runtime(stage_queues, fake_redis, tmp_path):
+    with patch('admission.max_wait_seconds', 1800):
+        api.app.test_client().post('/start_transcription', json=transcription_request)
+
+    def slow_download(youtube_url, output_path=None, stats=None):
+        time.sleep(0.3)
+        return fake_download(tmp_path)(youtube_url, output_path, stats)
+
+    with patch('tasks.download_yt_audio', side_effect=slow_download), \
+         patch('tasks.decode_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'), \
+         patch('tasks.record_job') as mock_record_job:
+        run_stage_workers(stage_queues, fake_redis)
+
+    mock_record_job.assert_called_once()
+    assert mock_record_job.call_args[0][0] < 0.3
+
+# Test that a playlist keeps one video in the queues at a time, counts a failed video, and aggregates the rest
+def test_playlist_fan_out(stage_queues, fake_redis, tmp_path):
+    video_urls = [f'https://www.youtube.com/watch?v={video_id * 11}' for video_id in 'abc']
+    waiting = []
+    def download(youtube_url, output_path=None, stats=None):
+        waiting.append((stage_queues['download'].count, fake_redis.llen(f'batch:{batch_id}:held')))
+        if youtube_url == video_urls[1]:
+            raise VideoUnavailable('bbbbbbbbbbb')
+        return fake_download(tmp_path)(youtube_url, output_path, stats)
+
+    client = api.app.test_client()
+    request = dict(transcription_request, playlist_url='https://www.youtube.com/playlist?list=PL123', concurrency=1)
+    with patch('admission.max_wait_seconds', 1800), patch('app.resolve_videos', return_value=video_urls + video_urls[:1]):
+        response = client.post('/start_playlist', json=request)
+    batch_id = response.json['batch_id']
+
+    assert response.status_code == 202
+    assert response.json['total'] == 3  # The repeated video counts once
+    assert len(stage_queues['download'].job_ids) == 1
+    assert client.get(f'/playlist_status/{batch_id}').json['waiting'] == 2
+
+    with patch('tasks.download_yt_audio', side_effect=download), \
+         patch('tasks.decode_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'), \
+         patch('playlists.summarize_transcript', return_value='Playlist summary') as mock_summarize:
+        run_stage_workers(stage_queues, fake_redis)
+
+    assert waiting == [(0, 2), (0, 1), (0, 0)]  # Nothing else queued while a video runs
+    status = client.get(f'/playlist_status/{batch_id}')
+    assert status.status_code == 200
+    assert (status.json['completed'], status.json['succeeded'], status.json['failed']) == (3, 2, 1)
+    assert [video['state'] for video in status.json['videos']] == ['SUCCESS', 'FAILED', 'SUCCESS']
+    assert status.json['keywords']['talk']['videos'] == 2
+    assert status.json['summary'] == 'Playlist summary'
+    assert mock_summarize.call_args[0][0] == 'Mocked summary\n\nMocked summary'
+    chunks = client.get(f'/playlist_result/{batch_id}/keywords').json['keyword_chunks']
+    assert [chunk['youtube_url'] for chunk in chunks] == [video_urls[0], video_urls[2]]
+    assert batch_id not in active_batches()  # Nothing left for the sweep
+
+# Test that the sweep counts a video whose work-horse was killed and starts the next one, without anyone polling
+def test_playlist_sweep_recovers_killed_videos(stage_queues, fake_redis):
+    video_urls = [f'https://www.youtube.com/watch?v={video_id * 11}' for video_id in 'ab']
+    request = dict(transcription_request, playlist_url='https://www.youtube.com/playlist?list=PL123', concurrency=1)
+    with patch('admission.max_wait_seconds', 1800), patch('app.resolve_videos', return_value=video_urls):
+        batch_id = api.app.test_client().post('/start_playlist', json=request).json['batch_id']
+
+    first_job_id = stage_queues['download'].job_ids[0]
+    stage_queues['download'].remove(first_job_id)
+    Job.fetch(first_job_id, connection=fake_redis).set_status(JobStatus.FAILED)  # What RQ records for a killed work-horse
+    reconcile_batches()
+
+    batch = get_batch(batch_id)
+    assert (batch['completed'], batch['waiting'], batch['aggregate']['failed']) == (1, 0, 1)
+    assert len(stage_queues['download'].job_ids) == 1 and stage_queues['download'].job_ids[0] != first_job_id
+    assert batch_id in active_batches()
+
+# Test that an unknown task id gets a status instead of an error
+def test_task_status_unknown_task(fake_redis):
+    response = api.app.test_client().get('/task_status/missing-task')
+    assert response.status_code == 404
+    assert response.json['state'] == 'UNKNOWN'
+
+# Test that a failed stage fails the whole task and the later stages never run
+def test_stage_pipeline_reports_failed_stage(stage_queues, fake_redis):
+    with patch('admission.max_wait_seconds', 1800):
+        task_id = api.app.test_client().post('/start_transcription', json=transcription_request).json['task_id']
+
+    with patch('tasks.download_yt_audio', side_effect=VideoUnavailable('dQw4w9WgXcQ')), \
+         patch('tasks.summarize_transcript') as mock_summarize:
+        run_stage_workers(stage_queues, fake_redis)
+
+    status = api.app.test_client().get(f'/task_status/{task_id}')
+    assert status.status_code == 406
+    assert status.json['status'] == "The provided video link is invalid. Please check the link and try again."
+    mock_summarize.assert_not_called()
+    assert not api.is_job_alive(task_id)
+    assert [queue.deferred_job_registry.count for queue in (stage_queues['transcribe'], stage_queues['analyze'])] == [0, 0]
+    assert queue_load(stage_queues['transcribe'])['jobs'] == 0  # Admission doesn't wait on stages that will never run
+
+search_transcript = [
+    {'start': 0, 'end': 5, 'text': 'Welcome to the talk.'},
+    {'start': 5, 'end': 9, 'text': 'Machine learning is everywhere.'},
+    {'start': 9, 'end': 12, 'text': 'Learning machines, too.'},
+    {'start': 12, 'end': 15, 'text': 'Filler.'},
+    {'start': 15, 'end': 20, 'text': 'More machine learning at the end.'}
+]
+
+# Test that search returns the same chunks as filtering the transcript in memory, across videos
+def test_search_matches_in_memory_filter(tmp_path):
+    path = str(tmp_path / 'index.sqlite3')
+    with patch('search_index.search_index_path', path):
+        index_transcript('video-a', search_transcript)
+        index_transcript('video-b', [{'start': 0, 'end': 3, 'text': 'Nothing about it.'}, {'start': 3, 'end': 6, 'text': 'A talk on learning.'}])
+
+        for keywords in ('machine learning', 'talk, learning', 'machines'):
+            results = {video['video_id']: video['transcript_filtered'] for video in search(keywords)}
+            assert results['video-a'] == filter_sentences_with_context(search_transcript, keywords, whole_words=True)
+        assert [video['video_id'] for video in search('learning')] == ['video-a', 'video-b']
+        assert search('learn') == []  # Whole words only
+        assert search('Machine', case_sensitive=True)[0]['transcript_filtered'][0]['start'] == 0
+        assert search('talk', sentiment=True)[0]['sentiment_analysis'][0]['keywords'] == ['talk']
+        assert index_stats()['videos'] == 2
+
+# Test that indexing a video again replaces its old segments and postings
+def test_search_reindex_replaces_video(tmp_path):
+    with patch('search_index.search_index_path', str(tmp_path / 'index.sqlite3')):
+        index_transcript('video-a', search_transcript)
+        index_transcript('video-a', [{'start': 0, 'end': 4, 'text': 'Only cooking now.'}])
+
+        assert search('machine') == []
+        assert search('cooking')[0]['transcript_filtered'] == [{'text': '... Only cooking now. ...', 'start': 0, 'end': 4, 'keywords': ['cooking']}]
+        assert index_stats()['segments'] == 1
+
+# Test that the BART backend summarizes the text and every keyword's sentences in one batch
+def test_bart_summarizer_batches_keyword_analysis():
+    def fake_generate(texts):
+        return [f"Summary of {len(text)} chars. Second sentence. Third sentence." for text in texts]
+
+    with patch('modules.bart_server', False), patch('modules.bart_generate', side_effect=fake_generate) as mock_generate:
+        summary = BartSummarizer().summarize('I like art. The talk was long. Art is good.', 1, 'art, talk, dance', 2, 'video transcript')
+
+    mock_generate.assert_called_once_with(['I like art. The talk was long. Art is good.', 'I like art. Art is good.', 'The talk was long.'])
+    assert summary.split('\n\n') == [
+        'Summary of 43 chars.',
+        'art: Summary of 24 chars. Second sentence.',
+        'talk: Summary of 18 chars. Second sentence.',
+        'dance: The keyword is not discussed in the video.'
+    ]
+
+# Test that the summary server answers texts from several jobs with one generate pass
+def test_bart_server_batches_requests_from_several_jobs():
+    fake_conn = fakeredis.FakeRedis()
+    results = {}
+
+    def job(name, texts):
+        results[name] = bart_summarize(texts)
+
+    with patch('modules.conn', fake_conn), patch('modules.bart_server', True), \
+         patch('modules.bart_generate', side_effect=lambda texts: [text.upper() for text in texts]) as mock_generate:
+        threads = [threading.Thread(target=job, args=('first', ['a', 'b'])), threading.Thread(target=job, args=('second', ['c']))]
+        for thread in threads:
+            thread.start()
+        while fake_conn.llen('bart:requests') < 2:
+            time.sleep(0.01)
+        served = serve_bart_batch(fake_conn, block_seconds=1)
+        for thread in threads:
+            thread.join(timeout=5)
+
+    assert served == 3
+    mock_generate.assert_called_once()
+    assert sorted(mock_generate.call_args.args[0]) == ['a', 'b', 'c']
+    assert results == {'first': ['A', 'B'], 'second': ['C']}
+
+# Test that a malformed request or a Redis error fails one batch and the summary server keeps serving
+def test_bart_server_survives_failed_batches():
+    fake_conn = fakeredis.FakeRedis()
+    fake_conn.rpush('bart:requests', 'not json')
+    outcomes = [redis.ConnectionError('Connection refused'), KeyboardInterrupt()]
+
+    def flaky_batch(connection, **kwargs):
+        if fake_conn.llen('bart:requests'):
+            return serve_bart_batch(connection, **kwargs)
+        raise outcomes.pop(0)
+
+    with patch('modules.bart_model'), patch('modules.bart_server_retry_seconds', 0), \
+         patch('modules.serve_bart_batch', side_effect=flaky_batch) as mock_batch:
+        with pytest.raises(KeyboardInterrupt):
+            serve_bart_summaries(fake_conn)
+
+    assert mock_batch.call_count == 3
+
+# Test that int8 dynamic quantization keeps a BART model generating
+def test_quantize_for_cpu():
+    from transformers import BartConfig, BartForConditionalGeneration
+    config = BartConfig(vocab_size=64, d_model=16, encoder_layers=1, decoder_layers=1, encoder_attention_heads=2, decoder_attention_heads=2,
+                        encoder_ffn_dim=32, decoder_ffn_dim=32, max_position_embeddings=64)
+    model = quantize_for_cpu(BartForConditionalGeneration(config).eval())
+
+    assert type(model.model.encoder.layers[0].fc1).__name__ == 'Linear' and 'quantized' in type(model.model.encoder.layers[0].fc1).__module__
+    output = model.generate(input_ids=torch.tensor([[0, 5, 6, 7, 2]]), max_length=8, num_beams=1)
+    assert output.shape[0] == 1
+
+# Test that a request can't ask for a backend the deployment doesn't run
+def test_start_transcription_rejects_unknown_summary_backend(fake_redis):
+    with patch('app.q') as mock_queue:
+        response = api.app.test_client().post('/start_transcription', json=dict(transcription_request, summary_backend='bart'))
+
+    assert response.status_code == 400
+    mock_queue.enqueue.assert_not_called()
+
+def tiny_whisper_model():
+    from whisper.model import ModelDimensions, Whisper
+    dims = ModelDimensions(n_mels=80, n_audio_ctx=1500, n_audio_state=32, n_audio_head=2, n_audio_layer=1,
+                           n_vocab=51865, n_text_ctx=448, n_text_state=32, n_text_head=2, n_text_layer=1)
+    model = Whisper(dims).eval()
+    with torch.no_grad():
+        for param in model.parameters():
+            torch.nn.init.normal_(param, std=0.02)
+    return model
+
+# Test that the int8 engine shrinks the model and still returns Whisper-shaped segments
+def test_quantize_whisper():
+    torch.manual_seed(0)
+    model = tiny_whisper_model()
+    fp32_bytes = model_nbytes(model)
+    model = quantize_whisper(model)
+
+    assert model_nbytes(model) < fp32_bytes
+    result = model.transcribe(np.random.default_rng(0).normal(0, 0.1, 16000).astype(np.float32), fp16=False, temperature=0.0)
+    assert isinstance(result['text'], str)
+    assert all({'start', 'end', 'text'} <= set(segment) for segment in result['segments'])
+
+# Test that the language of a long recording is detected from its first 30 s, as a language code
+def test_spoken_language_on_whisper_model():
+    torch.manual_seed(0)
+    language = spoken_language(tiny_whisper_model(), np.random.default_rng(0).normal(0, 0.1, 16000 * 40).astype(np.float32))
+
+    assert language in whisper.tokenizer.LANGUAGES
+
+# Test that faster-whisper output is reshaped into what the pipeline expects
+def test_faster_whisper_model_shape():
+    model = FasterWhisperModel.__new__(FasterWhisperModel)
+    model.model = Mock()
+    segments = [Mock(start=0.0, end=2.5, text=' Hello there.'), Mock(start=2.5, end=4.0, text=' Bye.')]
+    model.model.transcribe.return_value = (iter(segments), Mock(language='en'))
+
+    result = model.transcribe(np.zeros(16000, dtype=np.float32), initial_prompt='Earlier text')
+
+    assert result == {'text': ' Hello there. Bye.', 'language': 'en',
+                      'segments': [{'start': 0.0, 'end': 2.5, 'text': ' Hello there.'}, {'start': 2.5, 'end': 4.0, 'text': ' Bye.'}]}
+    assert model.model.transcribe.call_args.kwargs['initial_prompt'] == 'Earlier text'
+    model.transcribe(np.zeros(16000, dtype=np.float32), language='de')
+    assert model.model.transcribe.call_args.kwargs['language'] == 'de'
+
+def test_load_transcription_model_rejects_unknown_engine():
+    with pytest.raises(ValueError):
+        load_transcription_model('small', 'wav2vec')
+
+# Test that CPUs are grouped by physical core from sysfs, with siblings numbered N and N + cores as on x86 servers
+def test_physical_cores_groups_interleaved_siblings(tmp_path):
+    for cpu in range(16):
+        topology = tmp_path / f'cpu{cpu}' / 'topology'
+        topology.mkdir(parents=True)
+        (topology / 'thread_siblings_list').write_text(f'{cpu % 8},{cpu % 8 + 8}\n')
+
+    assert physical_cores(range(16), sysfs=str(tmp_path)) == [[core, core + 8] for core in range(8)]
+    assert physical_cores([0, 8, 3, 20], sysfs=str(tmp_path)) == [[0, 8], [3], [20]]  # Outside the cpuset, no topology
+    assert parse_cpu_list('0-2,8\n') == [0, 1, 2, 8]
+
+# Test that workers are sized by both cores and RAM, and get whole cores without sharing siblings
+def test_plan_topology():
+    cores = [[core, core + 8] for core in range(8)]  # 8 physical cores with hyperthreading, interleaved
+    cpus = list(range(16))
+
+    assert plan_topology(cores, 64000, 2500, threads_per_worker=4) == [([0, 1, 2, 3, 8, 9, 10, 11], 4), ([4, 5, 6, 7, 12, 13, 14, 15], 4)]
+    assert plan_topology(cores, 3000, 2500, threads_per_worker=2) == [(cpus, 8)]  # RAM for one worker only
+    assert plan_topology(cores, 64000, 2500, workers=4) == [([i, i + 1, i + 8, i + 9], 2) for i in range(0, 8, 2)]
+    assert plan_topology([[0], [1]], 64000, 2500, workers=8) == [([0], 1), ([1], 1)]
+
+def exit_right_away(cpus, threads):
+    pass
+
+# Test that the supervisor starts every slot and restarts workers that exit
+def test_supervisor_restarts_dead_workers():
+    supervisor = Supervisor([([0], 1), ([0], 1)], target=exit_right_away)
+    supervisor.check()
+    for process in supervisor.processes:
+        process.join(timeout=5)
+    supervisor.check()
+    supervisor.stop()
+
+    assert supervisor.restarts == 2
+    assert all(not process.is_alive() for process in supervisor.processes)
+
+# Test that a worker slot pins its cores and runs one RQ worker on the configured queues, without planning again
+def test_run_worker_pins_and_works():
+    with patch('worker.os.sched_setaffinity') as mock_affinity, patch('worker.torch.set_num_threads') as mock_threads, \
+         patch('worker.listen', ['transcribe', 'download']), patch('worker.Worker') as mock_worker, \
+         patch('worker.plan_topology') as mock_plan, patch('worker.Supervisor') as mock_supervisor:
+        run_worker([2, 3], 2)
+
+    mock_affinity.assert_called_once_with(0, [2, 3])
+    mock_threads.assert_called_once_with(2)
+    mock_worker.assert_called_once()
+    assert [queue.name for queue in mock_worker.call_args[0][0]] == ['transcribe', 'download']
+    mock_worker.return_value.work.assert_called_once_with()
+    mock_plan.assert_not_called()
+    mock_supervisor.assert_not_called()
+
+def test_word_error_rate():
+    assert word_error_rate('Ask not what your country can do for you.', 'ask not what your country can do for you') == 0
+    assert word_error_rate('one two three four', 'one too three') == 0.5  # One substitution, one deletion
+    assert word_error_rate('', '') == 0.0
+
+# Test that only slowdowns past both the threshold and the noise floor are flagged
+def test_bench_compare_flags_regressions():
+    baseline = {'fixtures': [{'name': 'talk', 'wer': 0.1, 'stages': {
+        'transcribe': {'wall_time': 10.0, 'peak_rss_mb': 900.0}, 'keywords': {'wall_time': 0.001}}}]}
+    results = {'fixtures': [{'name': 'talk', 'wer': 0.15, 'stages': {
+        'transcribe': {'wall_time': 10.5, 'peak_rss_mb': 1200.0}, 'keywords': {'wall_time': 0.01}}}]}
+
+    assert compare(results, baseline, 0.10, 0.01) == ['talk transcribe peak_rss_mb: 900.0 -> 1200.0', 'talk wer: 0.1 -> 0.15']
+
+# Test that stage timings and counters from jobs show up on /metrics with queue gauges
+def test_metrics_endpoint(stage_queues, fake_redis, tmp_path):
+    with patch('admission.max_wait_seconds', 1800):
+        api.app.test_client().post('/start_transcription', json=transcription_request)
+    with patch('app.q', Queue(connection=fake_redis)), patch('metrics.Worker.count', return_value=0):
+        queued = api.app.test_client().get('/metrics').get_data(as_text=True)
+
+    with patch('tasks.download_yt_audio', side_effect=fake_download(tmp_path)), \
+         patch('tasks.decode_audio', return_value=np.zeros(16000 * 10, dtype=np.float32)), \
+         patch('tasks.transcribe_audio', return_value=('Full transcript text', cached_transcript_timestamped, [])), \
+         patch('tasks.summarize_transcript', return_value='Mocked summary'):
+        run_stage_workers(stage_queues, fake_redis)
+    with patch('app.q', Queue(connection=fake_redis)), patch('metrics.Worker.count', return_value=0):
+        response = api.app.test_client().get('/metrics')
+    body = response.get_data(as_text=True)
+
+    assert 'av_queue_depth{queue="download"} 1' in queued
+    assert 'av_queue_deferred_jobs{queue="analyze"} 1' in queued
+    assert 'av_queue_oldest_job_age_seconds{queue="download"}' in queued
+    assert response.mimetype == 'text/plain'
+    for stage in ('download', 'convert', 'transcribe', 'sentiment', 'summarize'):
+        assert f'av_stage_duration_seconds_count{{stage="{stage}"}} 1' in body
+        assert f'av_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} 1' in body
+    assert 'av_audio_duration_seconds_sum 10.0' in body
+    assert 'av_cache_requests_total{cache="result",outcome="miss"} 1' in body
+    assert 'av_cache_requests_total{cache="transcript",outcome="miss"} 1' in body
+    assert 'av_jobs_total{outcome="finished"} 1' in body
+    assert 'av_queue_depth{queue="download"} 0' in body
+    assert 'av_queue_oldest_job_age_seconds{queue="download"} 0' in body
+
+# Test that the smallest stream at or above the floor wins, and the best one when none reach it
+def test_select_audio_stream():
+    streams = [Mock(abr='160kbps'), Mock(abr='50kbps'), Mock(abr='70kbps'), Mock(abr=None)]
+
+    assert select_audio_stream(streams, min_kbps=48).abr == '50kbps'
+    assert select_audio_stream(streams, min_kbps=64).abr == '70kbps'
+    assert select_audio_stream(streams, min_kbps=256).abr == '160kbps'
+    assert select_audio_stream([], min_kbps=48) is None
+
+# Test that parallel ranges rebuild the file and resume after dropped connections
+def test_download_ranged_resumes(range_server, tmp_path):
+    range_server.failures = 2
+    path = str(tmp_path / 'audio')
+
+    with patch('modules.time.sleep'):
+        fetched, connections = download_ranged(range_server.url, path, len(range_server.payload), connections=3)
+
+    with open(path, 'rb') as file:
+        assert file.read() == range_server.payload
+    assert connections == 3
+    assert fetched == len(range_server.payload)  # Resumed ranges don't fetch the same bytes twice
+    assert len(range_server.requests) == 5
+
+# Test that streamed ranges come back in order, with resumes, and count their bytes
+def test_iter_download_in_order(range_server):
+    range_server.failures = 2
+    stats = {}
+
+    with patch('modules.time.sleep'):
+        parts = list(iter_download(range_server.url, len(range_server.payload), part_bytes=1024 * 1024, prefetch=3, stats=stats))
+
+    assert b''.join(parts) == range_server.payload
+    assert len(parts) == 6
+    assert stats['bytes'] == len(range_server.payload)
+
+# Test that a streamed download falls back to one connection when the server ignores Range headers
+def test_iter_download_without_range_support(range_server):
+    range_server.supports_ranges = False
+    stats = {}
+
+    data = b''.join(iter_download(range_server.url, len(range_server.payload), part_bytes=1024 * 1024, prefetch=3, stats=stats))
+
+    assert data == range_server.payload
+    assert stats['bytes'] == len(range_server.payload)
+    assert stats['connections'] == 1
+
+# Test that a server ignoring Range headers still gets the whole file over one connection
+def test_download_ranged_without_range_support(range_server, tmp_path):
+    range_server.supports_ranges = False
+    path = str(tmp_path / 'audio')
+
+    fetched, connections = download_ranged(range_server.url, path, len(range_server.payload), connections=3)
+
+    with open(path, 'rb') as file:
+        assert file.read() == range_server.payload
+    assert connections == 1
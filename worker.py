@@ -1,9 +1,18 @@
 import redis
 from rq import Worker, Queue, Connection
 import os
+import time
+import threading
+import multiprocessing
+import signal
+import psutil
+from collections import OrderedDict
+import torch
+import whisper
 
-# Queues we want our workers to listen to
-listen = ['default']
+# Queues we want our workers to listen to, in priority order. Dedicated pools set e.g.
+# WORKER_QUEUES=transcribe for the transcription machines and WORKER_QUEUES=download,analyze for the rest.
+listen = [name.strip() for name in os.getenv('WORKER_QUEUES', 'analyze,transcribe,download,default').split(',') if name.strip()]
 
 # URL for our Redis server
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
@@ -11,7 +20,292 @@ redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 # Create a connection to Redis
 conn = redis.from_url(redis_url)
 
-if __name__ == '__main__':
+# Whisper model used when a job doesn't ask for a specific size
+default_model_size = os.getenv('WHISPER_MODEL', 'small')
+
+# Model sizes loaded before RQ forks its work-horses, e.g. "small" or "base,small"
+preload_model_sizes = [size.strip() for size in os.getenv('WHISPER_MODELS', default_model_size).split(',') if size.strip()]
+
+# Memory budget for resident models in MB, least recently used sizes are evicted past it
+model_memory_budget_mb = int(os.getenv('WHISPER_MODEL_BUDGET_MB', '4096'))
+
+# Redis hash holding registry counters, shared by every work-horse
+model_stats_key = 'whisper_models:stats'
+
+# Speech-to-text engine for every model the registry loads:
+#   whisper         openai-whisper on PyTorch, as trained
+#   whisper-int8    the same model with its Linear layers dynamically quantized to int8, CPU only
+#   faster-whisper  CTranslate2 build of the same weights (pip install faster-whisper), see TRANSCRIBE_COMPUTE_TYPE
+transcribe_engine = os.getenv('TRANSCRIBE_ENGINE', 'whisper')
+transcribe_compute_type = os.getenv('TRANSCRIBE_COMPUTE_TYPE', 'int8')  # faster-whisper only: int8, int8_float32, float32...
+
+# What a transcript was made with, for the caches: engines don't give the same text. Plain whisper keeps
+# the bare size, so transcripts cached before engines existed stay valid.
+def transcriber_key(size, engine=None):
+    engine = engine or transcribe_engine
+    if engine == 'whisper':
+        return size
+    if engine == 'faster-whisper':
+        return f'{size}:{engine}:{transcribe_compute_type}'
+    return f'{size}:{engine}'
+
+class FasterWhisperModel:
+    """Answers like openai-whisper's model.transcribe(), so the pipeline doesn't care which engine ran."""
+
+    def __init__(self, size, compute_type):
+        from faster_whisper import WhisperModel, download_model  # Optional, only this engine needs it
+        model_path = download_model(size)
+        self.model = WhisperModel(model_path, device='cpu', compute_type=compute_type, cpu_threads=torch.get_num_threads())
+        self.nbytes = os.path.getsize(os.path.join(model_path, 'model.bin'))  # On-disk size, close enough for the budget
+
+    def transcribe(self, audio, initial_prompt=None, language=None, **kwargs):
+        segments, info = self.model.transcribe(audio, initial_prompt=initial_prompt, language=language, beam_size=5)
+        segments = [{'start': segment.start, 'end': segment.end, 'text': segment.text} for segment in segments]  # The generator does the work
+        return {'text': ''.join(segment['text'] for segment in segments), 'segments': segments, 'language': info.language}
+
+    def spoken_language(self, audio):
+        _, info = self.model.transcribe(audio[:whisper.audio.N_SAMPLES])  # Detects eagerly, nothing is decoded until the segments are read
+        return info.language
+
+def quantize_whisper(model):
+    # Whisper subclasses nn.Linear only to cast weights for fp16, which int8 on the CPU never uses
+    for module in model.modules():
+        if isinstance(module, whisper.model.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_transcription_model(size, engine=None):
+    engine = engine or transcribe_engine
+    if engine == 'whisper':
+        return whisper.load_model(size)
+    if engine == 'whisper-int8':
+        return quantize_whisper(whisper.load_model(size, device='cpu'))
+    if engine == 'faster-whisper':
+        return FasterWhisperModel(size, transcribe_compute_type)
+    raise ValueError(f"Unknown transcription engine: {engine}")
+
+# The language of the first 30 s, what Whisper itself would detect before transcribing
+def spoken_language(model, audio):
+    if hasattr(model, 'spoken_language'):
+        return model.spoken_language(audio)
+    if not model.is_multilingual:
+        return 'en'
+    mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio[:whisper.audio.N_SAMPLES]), model.dims.n_mels).to(model.device)
+    _, probs = model.detect_language(mel)
+    return max(probs, key=probs.get)
+
+def model_nbytes(model):
+    if isinstance(model, FasterWhisperModel):
+        return model.nbytes
+    # Goes through the state dict, parameters() leaves out the packed int8 weights
+    nbytes = 0
+    for value in model.state_dict().values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(tensor, torch.Tensor):
+                nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+class ModelRegistry:
+    """Keeps Whisper models resident in the worker process.
+
+    Models loaded before the fork are shared copy-on-write with every work-horse.
+    Sizes loaded inside a work-horse live only as long as that job.
+    """
+
+    def __init__(self, memory_budget_mb, connection=None):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.connection = connection
+        self.models = OrderedDict()  # size -> (model, nbytes), least recently used first
+        self.load_times = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def preload(self, sizes):
+        for size in sizes:
+            with self._lock:
+                if size not in self.models:
+                    self._load(size)
+
+    def get(self, size):
+        with self._lock:
+            if size in self.models:
+                self.models.move_to_end(size)
+                self.hits += 1
+                self._record('hits')
+                return self.models[size][0]
+            self.misses += 1
+            self._record('misses')
+            return self._load(size)
+
+    def stats(self):
+        return {
+            'resident': list(self.models),
+            'resident_mb': round(sum(nbytes for _, nbytes in self.models.values()) / 1024 / 1024, 1),
+            'budget_mb': round(self.memory_budget / 1024 / 1024, 1),
+            'load_times': dict(self.load_times),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def _load(self, size):
+        start_time = time.perf_counter()
+        model = load_transcription_model(size)
+        load_time = time.perf_counter() - start_time
+        self.load_times[size] = load_time
+        self.models[size] = (model, model_nbytes(model))
+        self._record('loads', load_time=(size, load_time))
+        self._evict(keep=size)
+        return model
+
+    def _evict(self, keep):
+        total = sum(nbytes for _, nbytes in self.models.values())
+        for size in list(self.models):
+            if total <= self.memory_budget:
+                break
+            if size == keep:
+                continue
+            total -= self.models.pop(size)[1]
+            self.evictions += 1
+            self._record('evictions')
+
+    def _record(self, counter, load_time=None):
+        if self.connection is None:
+            return
+        try:
+            pipe = self.connection.pipeline()
+            pipe.hincrby(model_stats_key, counter, 1)
+            if load_time:
+                pipe.hset(model_stats_key, f'load_time:{load_time[0]}', round(load_time[1], 3))
+            pipe.execute()
+        except redis.RedisError:
+            pass  # Stats are best effort, never fail a transcription over them
+
+model_registry = ModelRegistry(model_memory_budget_mb, connection=conn)
+
+def get_model_stats(connection=conn):
+    stats = {key.decode(): value.decode() for key, value in connection.hgetall(model_stats_key).items()}
+    for counter in ('hits', 'misses', 'loads', 'evictions'):
+        stats[counter] = int(stats.get(counter, 0))
+    return stats
+
+# Worker Topology
+# One node runs several RQ workers, each pinned to its own block of cores with torch using exactly
+# that many threads, so they don't oversubscribe the CPU. The supervisor keeps that many alive.
+worker_count = int(os.getenv('WORKER_COUNT', '0'))  # 0 sizes it from the cores and RAM of the node
+worker_threads = int(os.getenv('WORKER_THREADS', '4'))  # Threads per worker when sizing automatically
+# RAM one transcription worker needs, in MB: the model, the decoded audio of a long video, and headroom
+worker_ram_mb = int(os.getenv('WORKER_RAM_MB', '0')) or {'tiny': 1000, 'base': 1200, 'small': 2500, 'medium': 5500}.get(default_model_size, 10000)
+supervisor_restart_delay = 5  # Seconds before a worker that died is started again
+
+# "0-3,8" as in the sysfs CPU lists
+def parse_cpu_list(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+# The allowed CPUs grouped by physical core. Sibling numbering differs between machines (0 and 1, or 0 and
+# N on most x86 servers), so it comes from the kernel. A CPU without topology information is its own core.
+def physical_cores(cpus, sysfs='/sys/devices/system/cpu'):
+    allowed = set(cpus)
+    cores = {}
+    for cpu in sorted(cpus):
+        try:
+            with open(f'{sysfs}/cpu{cpu}/topology/thread_siblings_list') as file:
+                siblings = [sibling for sibling in parse_cpu_list(file.read()) if sibling in allowed]
+        except (OSError, ValueError):
+            siblings = [cpu]
+        cores.setdefault(tuple(siblings or [cpu]), None)
+    return [list(core) for core in cores]
+
+def node_resources():
+    cores = physical_cores(os.sched_getaffinity(0))  # Honors the container's cpuset
+    return cores, psutil.virtual_memory().available // (1024 * 1024)
+
+# Returns one (cpus, threads) slot per worker. cores lists the CPUs of each physical core, every worker gets
+# whole cores, so no two workers share a core through its hyperthread siblings.
+def plan_topology(cores, available_ram_mb, ram_per_worker_mb, workers=0, threads_per_worker=4):
+    if not workers:
+        workers = max(1, min(len(cores) // max(1, threads_per_worker), available_ram_mb // max(1, ram_per_worker_mb)))
+    workers = min(workers, len(cores))
+    block = len(cores) // workers
+    return [(sorted(cpu for core in cores[i * block:(i + 1) * block] for cpu in core), block) for i in range(workers)]
+
+def run_worker(cpus, threads):
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
     with Connection(conn):
         worker = Worker(list(map(Queue, listen)))
         worker.work()
+
+class Supervisor:
+    """Starts one worker process per slot and restarts the ones that die."""
+
+    def __init__(self, topology, target=run_worker):
+        self.topology = topology
+        self.target = target
+        self.processes = [None] * len(topology)
+        self.restarts = 0
+        self.stopping = False
+
+    def start(self, slot):
+        # Forked, so every worker shares the models the supervisor preloaded
+        process = multiprocessing.get_context('fork').Process(target=self.target, args=self.topology[slot])
+        process.start()
+        self.processes[slot] = process
+
+    def check(self):
+        for slot, process in enumerate(self.processes):
+            if process is None:
+                self.start(slot)
+            elif not process.is_alive() and not self.stopping:
+                process.join()
+                self.restarts += 1
+                self.start(slot)
+
+    def stop(self, *args):
+        self.stopping = True
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()  # RQ finishes the current job on SIGTERM (warm shutdown)
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping:
+            self.check()
+            time.sleep(supervisor_restart_delay)
+
+if __name__ == '__main__':
+    # Summary server for the BART backend, forked before any model is loaded so it only holds BART
+    from modules import summary_backends, bart_server, serve_bart_summaries
+    if 'bart' in summary_backends and bart_server and {'analyze', 'default'} & set(listen):
+        multiprocessing.Process(target=serve_bart_summaries, args=(conn,), daemon=True).start()
+
+    # Go through the importable module so jobs see the same, already warm registry
+    from worker import model_registry
+    model_registry.preload(preload_model_sizes)
+    import tasks  # Import the job code up front too, so work-horses don't pay for it
+    from modules import sentiment_analyzer
+    sentiment_analyzer()  # Same for the VADER lexicon
+
+    # Playlists move on even when a work-horse was killed before it could report its video. A thread of the
+    # parent process, the work-horses and worker processes forked from it don't inherit it.
+    from playlists import sweep_playlists
+    threading.Thread(target=sweep_playlists, daemon=True).start()
+
+    cores, available_ram_mb = node_resources()
+    topology = plan_topology(cores, available_ram_mb, worker_ram_mb, worker_count, worker_threads)
+    print(f"Running {len(topology)} worker(s) with {topology[0][1]} thread(s) each on {len(cores)} cores, {available_ram_mb} MB available")
+    if len(topology) == 1:
+        run_worker(*topology[0])
+    else:
+        Supervisor(topology).run()